@@ -0,0 +1,266 @@
+"""
+In-process stand-in for the Dataverse endpoints used by universal_field_editor_V2.py
+
+FakeDataverse serves generated dataset records over HTTP from a background thread,
+so the script can be run end to end without a live server. Latency, lock
+durations and error rates are configurable, and every request is counted by
+endpoint and status code.
+
+Example:
+    with FakeDataverse(latency=0.01, lock_fraction=0.1, lock_duration=1.0) as server:
+        editor.url_base_origin = server.url
+        editor.file_loader()
+        print(server.counts)
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+DDI_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<codeBook xmlns="ddi:codebook:2_5"><dataDscr>
+<var ID="v1" name="age"><labl level="variable">Age of respondent</labl></var>
+<var ID="v2" name="income"><labl level="variable">Household income</labl></var>
+</dataDscr></codeBook>"""
+
+ROUTES = [
+    ('GET', re.compile(r'^/api/datasets/:persistentId/?$'), 'dataset'),
+    ('GET', re.compile(r'^/api/datasets/:persistentId/timestamps$'), 'timestamps'),
+    ('GET', re.compile(r'^/api/datasets/:persistentId/versions/:latest$'), 'versions/:latest'),
+    ('PUT', re.compile(r'^/api/datasets/:persistentId/editMetadata$'), 'editMetadata'),
+    ('PUT', re.compile(r'^/api/datasets/:persistentId/versions/:draft$'), 'versions/:draft'),
+    ('POST', re.compile(r'^/api/datasets/:persistentId/actions/:publish$'), 'publish'),
+    ('GET', re.compile(r'^/api/datasets/(\d+)/locks$'), 'locks'),
+    ('GET', re.compile(r'^/api/access/datafile/(\d+)/metadata$'), 'access/metadata'),
+    ('PUT', re.compile(r'^/api/edit/(\d+)$'), 'edit'),
+]
+
+
+class FakeDataverse:
+    """
+    Threaded HTTP server that behaves like the parts of Dataverse the script calls.
+
+    Datasets are created on first request for their DOI. A fraction of them start
+    locked for `lock_duration` seconds after they are first fetched.
+
+    Args:
+        latency (float): Seconds added to every response
+        latency_jitter (float): Up to this many extra seconds, chosen at random
+        lock_fraction (float): Share of datasets that start locked
+        lock_duration (float): Seconds a locked dataset stays locked
+        error_rate (float): Share of requests answered with a 500
+        overload_rate (float): Share of requests answered with a 429 (Retry-After: 0)
+        tab_files (int): Tabular files per dataset
+        seed (int): Seed for the random choices above
+    """
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, lock_fraction=0.0, lock_duration=0.0,
+                 error_rate=0.0, overload_rate=0.0, tab_files=1, seed=0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.lock_fraction = lock_fraction
+        self.lock_duration = lock_duration
+        self.error_rate = error_rate
+        self.overload_rate = overload_rate
+        self.tab_files = tab_files
+        self.counts = Counter()                                                 # (endpoint, status) -> requests
+        self.edits = Counter()                                                  # doi -> accepted editMetadata PUTs
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._datasets = {}                                                     # doi -> record
+        self._modified = {}                                                     # doi -> modification time (/timestamps)
+        self._locked_until = {}                                                 # dataset id -> monotonic time
+        self._next_id = 1000
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Start serving on a free local port."""
+        server = self
+
+        class Handler(FakeDataverseHandler):
+            fake = server
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-dataverse', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def dataset(self, doi):
+        """Return the record for a DOI, creating it on first use."""
+        with self._lock:
+            record = self._datasets.get(doi)
+            if record is None:
+                record = self._new_record(doi)
+                self._datasets[doi] = record
+                self._modified[doi] = _modification_time()
+            return record
+
+    def _new_record(self, doi):
+        dataset_id = self._next_id
+        self._next_id += 1 + self.tab_files                                    # File ids follow the dataset id
+        if self._random.random() < self.lock_fraction:
+            self._locked_until[dataset_id] = time.monotonic() + self.lock_duration
+
+        files = [{'label': f'file{n}.tab', 'dataFile': {'id': dataset_id + 1 + n, 'contentType': 'text/tab-separated-values'}}
+                 for n in range(self.tab_files)]
+        return {'status': 'OK', 'data': {'id': dataset_id, 'persistentId': doi, 'latestVersion': {
+            'versionState': 'DRAFT',
+            'lastUpdateTime': _version_time(),
+            'termsOfUse': 'CC0',
+            'fileAccessRequest': True,
+            'metadataBlocks': {'citation': {'displayName': 'Citation Metadata', 'name': 'citation', 'fields': [
+                {'typeName': 'title', 'multiple': False, 'typeClass': 'primitive', 'value': f'Dataset {dataset_id}'},
+                {'typeName': 'author', 'multiple': True, 'typeClass': 'compound', 'value': [{
+                    'authorName': {'typeName': 'authorName', 'multiple': False, 'typeClass': 'primitive', 'value': 'Doe, Jane'}}]},
+                {'typeName': 'datasetContact', 'multiple': True, 'typeClass': 'compound', 'value': [{
+                    'datasetContactEmail': {'typeName': 'datasetContactEmail', 'multiple': False,
+                                            'typeClass': 'primitive', 'value': 'jane@example.org'}}]},
+            ]}},
+            'files': files,
+        }}}
+
+    def modified(self, doi):
+        """The dataset's modification time, as /timestamps reports it."""
+        self.dataset(doi)
+        with self._lock:
+            return self._modified[doi]
+
+    def is_locked(self, dataset_id):
+        with self._lock:
+            return time.monotonic() < self._locked_until.get(dataset_id, 0)
+
+    def touch(self, doi, endpoint):
+        """Record a write to a dataset."""
+        record = self.dataset(doi)
+        with self._lock:
+            record['data']['latestVersion']['lastUpdateTime'] = _version_time()
+            self._modified[doi] = _modification_time()
+            if endpoint == 'editMetadata':
+                self.edits[doi] += 1
+
+    def draw(self):
+        """Pick the injected outcome of one request: None, 500 or 429."""
+        with self._lock:
+            roll = self._random.random()
+            jitter = self._random.random() * self.latency_jitter
+        time.sleep(self.latency + jitter)
+        if roll < self.error_rate:
+            return 500
+        if roll < self.error_rate + self.overload_rate:
+            return 429
+        return None
+
+    def count(self, endpoint, status):
+        with self._lock:
+            self.counts[(endpoint, status)] += 1
+
+
+class FakeDataverseHandler(BaseHTTPRequestHandler):
+    """Request handler bound to a FakeDataverse through the `fake` class attribute."""
+
+    protocol_version = 'HTTP/1.1'                                               # Keep-alive, like the real server
+    disable_nagle_algorithm = True                                              # Headers and body go out in separate writes
+    fake = None
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        doi = query.get('persistentId', [None])[0]
+        for route_method, pattern, endpoint in ROUTES:
+            match = pattern.match(parts.path)
+            if match and route_method == method:
+                break
+        else:
+            self.fake.count(parts.path, 404)
+            return self._send(404, {'status': 'ERROR', 'message': 'not found'})
+
+        injected = self.fake.draw()
+        if injected is not None:
+            self.fake.count(endpoint, injected)
+            headers = {'Retry-After': '0'} if injected == 429 else {}
+            return self._send(injected, {'status': 'ERROR', 'message': 'injected failure'}, headers)
+
+        if endpoint == 'dataset':
+            body = self.fake.dataset(doi)                                       # Always with files, like the real endpoint
+        elif endpoint == 'versions/:latest':
+            data = self.fake.dataset(doi)['data']
+            version = dict(data['latestVersion'], datasetId=data['id'], datasetPersistentId=doi)
+            if query.get('excludeFiles') == ['true']:
+                del version['files']
+            body = {'status': 'OK', 'data': version}
+        elif endpoint == 'timestamps':
+            body = {'status': 'OK', 'data': {'lastUpdateTime': self.fake.modified(doi)}}
+        elif endpoint == 'locks':
+            locked = self.fake.is_locked(int(match.group(1)))
+            body = {'status': 'OK', 'data': [{'lockType': 'Ingest'}] if locked else []}
+        elif endpoint == 'access/metadata':
+            self.fake.count(endpoint, 200)
+            return self._send(200, DDI_XML, {'Content-Type': 'text/xml'})
+        else:
+            if doi is not None:
+                self.fake.touch(doi, endpoint)
+            body = {'status': 'OK', 'data': {}}
+
+        self.fake.count(endpoint, 200)
+        self._send(200, body)
+
+    def _send(self, status, body, headers=None):
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        headers = dict({'Content-Type': 'application/json'}, **(headers or {}))
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def _version_time():
+    # A version's lastUpdateTime, as in the dataset JSON: whole seconds, UTC
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+
+def _modification_time():
+    # The dataset's modification time, as /timestamps reports it: ISO local date-time with a fraction
+    now = time.time_ns()
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(now // 10 ** 9)) + f'.{now % 10 ** 9:09d}'
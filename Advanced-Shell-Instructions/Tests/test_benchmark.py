@@ -0,0 +1,253 @@
+"""
+End-to-end throughput benchmark for universal_field_editor_V2.py
+
+Generates citation (and optionally terms-of-use) sheets, runs them through
+file_loader against an in-process FakeDataverse, and reports datasets per second,
+p50/p95/p99 latency per phase and request counts per endpoint.
+
+The pytest test runs a small replay and is marked slow. For larger replays run
+this file directly, e.g.:
+
+    python test_benchmark.py --rows 10000 --workers 8 --latency 0.02 --lock-fraction 0.05
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import universal_field_editor_V2 as editor
+from fake_dataverse import FakeDataverse
+
+
+# Request URL fragment -> phase reported by the benchmark (checked in order)
+PHASES = [
+    ('/timestamps', 'revalidate'),
+    ('/locks', 'lock_check'),
+    ('/editMetadata', 'edit_metadata'),
+    ('/versions/:draft', 'terms_of_use'),
+    ('/actions/:publish', 'publish'),
+    ('/api/access/datafile/', 'variable_metadata_fetch'),
+    ('/api/edit/', 'variable_metadata_push'),
+    ('/api/datasets/:persistentId/', 'fetch'),
+]
+
+
+def generate_sheets(directory, rows, datasets=None, terms_every=0):
+    """
+    Write benchmark sheets.
+
+    Args:
+        directory (str): Where the CSV files are written
+        rows (int): Rows in the citation sheet
+        datasets (int): Distinct DOIs the rows are spread over (default: one per row)
+        terms_every (int): Also write a terms-of-use row for every n-th dataset (0 = none)
+
+    Returns:
+        list: Paths of the generated sheets
+    """
+    datasets = datasets or rows
+    citation_path = os.path.join(directory, 'citation.csv')
+    with open(citation_path, 'w', encoding='utf-8') as sheet:
+        sheet.write('doi,title,subtitle,author: authorName; authorAffiliation,keyword: keywordValue,citation\n')
+        for n in range(rows):
+            sheet.write(f'doi:10.5072/FK2/BENCH{n % datasets},Title {n},Subtitle {n},'
+                        f'"Doe, Jane;University {n}+Roe, Richard;College {n}",Keyword {n}+Other {n},\n')
+    paths = [citation_path]
+
+    if terms_every:
+        terms_path = os.path.join(directory, 'terms.csv')
+        with open(terms_path, 'w', encoding='utf-8') as sheet:
+            sheet.write('doi,Point of Contact Email (MANDATORY),termsOfUse,disclaimer,terms\n')
+            for n in range(0, datasets, terms_every):
+                sheet.write(f'doi:10.5072/FK2/BENCH{n},contact{n}@example.org,Terms {n},Disclaimer {n},\n')
+        paths.append(terms_path)
+
+    return paths
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if len(sorted_values) == 0:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+@contextmanager
+def editor_settings(**settings):
+    """Temporarily override module-level settings of the editor."""
+    saved = {name: getattr(editor, name) for name in settings}
+    for name, value in settings.items():
+        setattr(editor, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(editor, name, value)
+
+
+@contextmanager
+def timed_requests(latencies):
+    """Record the latency of every Dataverse request, including retries, by phase."""
+    original = editor.dataverse_request
+
+    def timed(method, url, **kwargs):
+        phase = next((name for fragment, name in PHASES if fragment in url), 'other')
+        start = time.perf_counter()
+        try:
+            return original(method, url, **kwargs)
+        finally:
+            latencies[phase].append(time.perf_counter() - start)
+
+    editor.dataverse_request = timed
+    try:
+        yield
+    finally:
+        editor.dataverse_request = original
+
+
+def run_benchmark(rows, datasets=None, workers=8, terms_every=0, rate=1000, publish=False, **server_options):
+    """
+    Replay generated sheets through file_loader against a FakeDataverse.
+
+    Args:
+        rows (int): Rows in the citation sheet
+        datasets (int): Distinct DOIs the rows are spread over (default: one per row)
+        workers (int): max_workers for the run
+        terms_every (int): Add a terms-of-use row for every n-th dataset (0 = none)
+        rate (float): requests_per_second for the run
+        publish (bool): Publish every edited dataset (publish_after_edit)
+        **server_options: Passed to FakeDataverse (latency, lock_fraction, error_rate, ...)
+
+    Returns:
+        dict: Throughput, per-phase latency percentiles and request counts
+    """
+    datasets = datasets or rows
+    latencies = defaultdict(list)
+
+    with tempfile.TemporaryDirectory() as directory, FakeDataverse(**server_options) as server:
+        paths = generate_sheets(directory, rows, datasets, terms_every)
+        settings = dict(
+            url_base_origin=server.url, file_directory=paths, max_workers=workers,
+            requests_per_second=rate, request_burst=max(1, int(rate)), run_mode='update',
+            dataset_cache_dir=None, lock_poll_initial=0.1, lock_poll_max=1, request_retry_initial=0.05,
+            request_error_budget=None, log_level='WARNING', publish_after_edit=publish,
+            _http_session=None, _rate_limiter=None, _error_budget=None, _dataset_cache=None,
+        )
+        with editor_settings(**settings), timed_requests(latencies):
+            previous_level = editor.logger.level
+            editor.logger.setLevel(logging.WARNING)
+            try:
+                start = time.perf_counter()
+                editor.file_loader()
+                elapsed = time.perf_counter() - start
+            finally:
+                editor.logger.setLevel(previous_level)
+
+        counts = {f'{endpoint} {status}': n for (endpoint, status), n in sorted(server.counts.items())}
+        edited = len(server.edits)
+
+    phases = {}
+    for phase, values in sorted(latencies.items()):
+        values.sort()
+        phases[phase] = {'count': len(values), 'p50': percentile(values, 0.50),
+                         'p95': percentile(values, 0.95), 'p99': percentile(values, 0.99)}
+
+    return {
+        'rows': rows,
+        'datasets': datasets,
+        'datasets_edited': edited,
+        'workers': workers,
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed,
+        'datasets_per_second': datasets / elapsed,
+        'phases': phases,
+        'requests': counts,
+    }
+
+
+def format_report(report):
+    """Human-readable summary of a run_benchmark report."""
+    lines = [
+        f"{report['rows']} rows / {report['datasets']} datasets with {report['workers']} workers "
+        f"in {report['seconds']:.2f} s",
+        f"  {report['datasets_per_second']:.1f} datasets/s, {report['rows_per_second']:.1f} rows/s, "
+        f"{report['datasets_edited']} datasets edited",
+        f"  {'phase':<26}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}",
+    ]
+    for phase, stats in report['phases'].items():
+        lines.append(f"  {phase:<26}{stats['count']:>8}{stats['p50'] * 1000:>10.1f}"
+                     f"{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}")
+    lines.append('  requests: ' + ', '.join(f'{name}: {n}' for name, n in report['requests'].items()))
+    return '\n'.join(lines)
+
+
+@pytest.mark.slow
+class TestBenchmark:
+    """Small end-to-end replays against the fake server"""
+
+    def test_every_dataset_updated_once(self):
+        """Test that rows spread over datasets cost one fetch and one edit per dataset"""
+        report = run_benchmark(rows=200, datasets=100, workers=4, terms_every=10, latency=0.001)
+        print(format_report(report))
+
+        assert report['datasets_edited'] == 100
+        assert report['requests']['editMetadata 200'] == 100
+        assert report['requests']['versions/:latest 200'] == 90                # Citation edits only: no file listing
+        assert report['requests']['dataset 200'] == 10                          # Terms-of-use rows need the files
+        assert report['requests']['versions/:draft 200'] == 10
+        assert report['phases']['fetch']['p99'] is not None
+
+    def test_locks_and_errors_are_survived(self):
+        """Test that locked datasets and transient errors still end with every dataset edited"""
+        report = run_benchmark(rows=60, workers=4, lock_fraction=0.2, lock_duration=0.3,
+                               error_rate=0.02, overload_rate=0.01, seed=1)
+        print(format_report(report))
+
+        assert report['datasets_edited'] == 60
+
+    def test_edited_datasets_published_once(self):
+        """Test that the publish stage publishes each edited dataset once, after its locks clear"""
+        report = run_benchmark(rows=100, datasets=50, workers=4, terms_every=5, publish=True,
+                               latency=0.001, lock_fraction=0.2, lock_duration=0.2, seed=2)
+        print(format_report(report))
+
+        assert report['requests']['publish 200'] == 50
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark file_loader against a local fake Dataverse.')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--datasets', type=int, default=None, help='distinct DOIs (default: one per row)')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=1000, help='requests_per_second ceiling')
+    parser.add_argument('--terms-every', type=int, default=0, help='terms-of-use row for every n-th dataset')
+    parser.add_argument('--publish', action='store_true', help='publish every edited dataset')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every response')
+    parser.add_argument('--latency-jitter', type=float, default=0.0)
+    parser.add_argument('--lock-fraction', type=float, default=0.0)
+    parser.add_argument('--lock-duration', type=float, default=1.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--overload-rate', type=float, default=0.0)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    report = run_benchmark(args.rows, args.datasets, args.workers, args.terms_every, args.rate, args.publish,
+                           latency=args.latency, latency_jitter=args.latency_jitter,
+                           lock_fraction=args.lock_fraction, lock_duration=args.lock_duration,
+                           error_rate=args.error_rate, overload_rate=args.overload_rate)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,35 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import universal_field_editor_V2 as editor
 
 
+class FakeResponse:
+    """A canned 200 response carrying a JSON body"""
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def fake_record_response(record):
+    """Return a 200 response whose json() hands out a fresh copy of record"""
+    return FakeResponse(json.dumps(record))
+
+
+class FakeScheduler:
+    """A scheduler that never queues behind a running DOI and records what it parks"""
+
+    def __init__(self):
+        self.parked = []
+
+    def park_behind(self, doi, func, *args):
+        return False
+
+    def park(self, doi, dataset_id, func, *args):
+        self.parked.append(args[0])
+
+
 class TestPrimitiveFormatter:
     """Test the primitive_formatter function"""
 
@@ -143,34 +172,6 @@ class TestCompoundFormatter:
         assert result[0]["authorAffiliation"]["value"] == "University of Toronto"
 
 
-class TestRecordCheck:
-    """Test the record_check function"""
-
-    def test_empty_list_returns_empty_string(self):
-        """Test that empty list returns empty string"""
-        field = {"typeName": "title", "value": "Old"}
-        result = editor.record_check([''], field)
-        assert result == ""
-
-    def test_empty_string_returns_empty_string(self):
-        """Test that empty string returns empty string"""
-        field = {"typeName": "title", "value": "Old"}
-        result = editor.record_check('', field)
-        assert result == ""
-
-    def test_valid_string_updates_field(self):
-        """Test that valid string updates field value"""
-        field = {"typeName": "title", "value": "Old Title"}
-        result = editor.record_check("New Title", field.copy())
-        assert result["value"] == "New Title"
-
-    def test_valid_list_updates_field(self):
-        """Test that valid list updates field value"""
-        field = {"typeName": "title", "value": ["Old"]}
-        result = editor.record_check(["New1", "New2"], field.copy())
-        assert result["value"] == ["New1", "New2"]
-
-
 class TestXmlSelecter:
     """Test the xml_selecter function"""
 
@@ -240,9 +241,961 @@ class TestXmlSelecter:
         assert "dsDescription" in compound_fields
 
 
+class TestFieldLookup:
+    """Test that record fields are matched to columns by typeName"""
+
+    def test_matching_does_not_depend_on_field_order(self, monkeypatch):
+        """Test a sheet whose columns are in a different order than the record's fields"""
+        pushes = []
+        monkeypatch.setattr(editor, "API_push", lambda fields, doi: pushes.append(fields))
+
+        plan = editor.compile_column_plan(["doi", "title", "subtitle", "notesText", "citation"])
+        latest_version = {"metadataBlocks": {"citation": {"fields": [
+            {"typeName": "subtitle", "multiple": False, "typeClass": "primitive", "value": "Old Subtitle"},
+            {"typeName": "title", "multiple": False, "typeClass": "primitive", "value": "Old Title"}
+        ]}}}
+        row = ("doi:10.5072/FK2/TEST1", "New Title", "New Subtitle", "A note", "")
+
+        editor.update_metadata(latest_version, row, row[0], plan)
+
+        sent = {field["typeName"]: field["value"] for field in pushes[0]}
+        assert sent == {"title": "New Title", "subtitle": "New Subtitle", "notesText": "A note"}
+        assert "notesText" in editor.index_record_fields(latest_version)
+
+
+class TestNoOpWrites:
+    """Test that unchanged values are not pushed"""
+
+    def test_unchanged_values_are_skipped(self, monkeypatch):
+        """Test that a row matching the record (vocabulary values in any order) makes no request"""
+        pushes = []
+        monkeypatch.setattr(editor, "API_push", lambda fields, doi: pushes.append(fields))
+
+        plan = editor.compile_column_plan(["doi", "title", "subject", "author: authorName; authorAffiliation", "citation"])
+        latest_version = {
+            "metadataBlocks": {
+                "citation": {
+                    "fields": [
+                        {"typeName": "title", "multiple": False, "typeClass": "primitive", "value": "Same Title"},
+                        {"typeName": "subject", "multiple": True, "typeClass": "controlledVocabulary", "value": ["Physics", "Chemistry"]},
+                        {"typeName": "author", "multiple": True, "typeClass": "compound", "value": [
+                            {"authorName": {"typeName": "authorName", "multiple": False, "typeClass": "primitive", "value": "Doe, Jane"}},
+                            {"authorName": {"typeName": "authorName", "multiple": False, "typeClass": "primitive", "value": "Smith, John"},
+                             "authorAffiliation": {"typeName": "authorAffiliation", "multiple": False, "typeClass": "primitive", "value": "U of T"}}
+                        ]}
+                    ]
+                }
+            }
+        }
+        row = ("doi:10.5072/FK2/TEST1", "Same Title ", "Chemistry+Physics", "Doe, Jane;+Smith, John;U of T", "")
+
+        editor.update_metadata(latest_version, row, row[0], plan)
+
+        assert pushes == []
+
+        # Author order is part of the citation, so swapping authors is an edit
+        row = ("doi:10.5072/FK2/TEST1", "Same Title", "Chemistry+Physics", "Smith, John;U of T+Doe, Jane;", "")
+        editor.update_metadata(latest_version, row, row[0], plan)
+
+        assert [[field["typeName"] for field in fields] for fields in pushes] == [["author"]]
+
+    def test_changed_value_is_pushed(self, monkeypatch):
+        """Test that only the fields that differ are sent"""
+        pushes = []
+        monkeypatch.setattr(editor, "API_push", lambda fields, doi: pushes.append(fields))
+
+        plan = editor.compile_column_plan(["doi", "title", "subtitle", "citation"])
+        latest_version = {"metadataBlocks": {"citation": {"fields": [
+            {"typeName": "title", "multiple": False, "typeClass": "primitive", "value": "Same Title"},
+            {"typeName": "subtitle", "multiple": False, "typeClass": "primitive", "value": "Old Subtitle"}
+        ]}}}
+        row = ("doi:10.5072/FK2/TEST1", "Same Title", "New Subtitle", "")
+
+        editor.update_metadata(latest_version, row, row[0], plan)
+
+        assert [[field["typeName"] for field in fields] for fields in pushes] == [["subtitle"]]
+
+
+class TestStreamCsvRows:
+    """Test the single-pass CSV reader"""
+
+    def test_headers_then_rows(self, tmp_path):
+        """Test that headers come first and rows are yielded lazily as dicts"""
+        csv_path = tmp_path / "citation.csv"
+        csv_path.write_text("\ufeffdoi,title,citation\ndoi:10.5072/FK2/TEST1,Title 1,\ndoi:10.5072/FK2/TEST2,Title 2,\n", encoding="utf-8")
+
+        rows = editor.stream_csv_rows(str(csv_path))
+
+        assert next(rows) == ["doi", "title", "citation"]
+        assert next(rows) == ("doi:10.5072/FK2/TEST1", "Title 1", "")
+        assert [row[1] for row in rows] == ["Title 2"]
+
+
+class TestColumnPlan:
+    """Test the compiled per-sheet column plan"""
+
+    def test_headers_are_parsed_once_into_columns(self):
+        """Test that each header is classified with its sub-fields and multiplicity"""
+        plan = editor.compile_column_plan(["doi", "title", "author: authorName; authorAffiliation", "citation"])
+
+        assert plan.block_name == "citation"
+        assert not plan.is_terms
+        assert [column.kind for column in plan.columns] == ["doi", "primitive", "compound", "marker"]
+        author = plan.columns[2]
+        assert author.field_name == "author"
+        assert author.children == ("authorName", "authorAffiliation")
+        assert author.multiple is True
+
+    def test_new_field_payload_does_not_touch_template(self):
+        """Test that payloads are copies, so the shared templates stay pristine"""
+        plan = editor.compile_column_plan(["doi", "title", "citation"])
+        title = plan.columns[1]
+
+        payload = editor.new_field_payload(title, "New Title")
+
+        assert payload["value"] == "New Title"
+        assert title.template["value"] == ""
+
+    def test_terms_sheet(self):
+        """Test that a terms-of-use sheet is flagged"""
+        plan = editor.compile_column_plan(["doi", "termsOfUse", "terms"])
+        assert plan.is_terms
+
+
+class TestChangeBuffer:
+    """Test that update_metadata coalesces field edits into one request"""
+
+    def test_all_fields_sent_in_one_request(self, monkeypatch):
+        """Test that every changed column is pushed in a single editMetadata PUT"""
+        pushes = []
+        monkeypatch.setattr(editor, "API_push", lambda fields, doi: pushes.append((fields, doi)))
+
+        plan = editor.compile_column_plan(["doi", "title", "subtitle", "citation"])
+        latest_version = {
+            "metadataBlocks": {
+                "citation": {
+                    "fields": [
+                        {"typeName": "title", "multiple": False, "typeClass": "primitive", "value": "Old Title"},
+                        {"typeName": "subtitle", "multiple": False, "typeClass": "primitive", "value": "Old Subtitle"}
+                    ]
+                }
+            }
+        }
+        row = ("doi:10.5072/FK2/TEST1", "New Title", "New Subtitle", "")
+
+        editor.update_metadata(latest_version, row, row[0], plan)
+
+        assert len(pushes) == 1
+        fields, doi = pushes[0]
+        assert doi == "doi:10.5072/FK2/TEST1"
+        assert [field["typeName"] for field in fields] == ["title", "subtitle"]
+        assert fields[0]["value"] == "New Title"
+
+    def test_rejected_push_is_not_counted_as_updated(self, monkeypatch):
+        """Test that a dataset whose editMetadata PUT is rejected is recorded as push_failed"""
+        record = {"data": {"id": 5, "latestVersion": {"metadataBlocks": {"citation": {
+            "fields": [{"typeName": "title", "multiple": False, "typeClass": "primitive", "value": "Old Title"}]}}}}}
+
+        monkeypatch.setattr(editor, "get_dataset", lambda doi, include_files=True: fake_record_response(record))
+        monkeypatch.setattr(editor, "check_lock", lambda dataset_id, lock_status: True)
+        monkeypatch.setattr(editor, "API_push", lambda fields, doi: False)
+        editor.run_metrics.reset()
+
+        plan = editor.compile_column_plan(["doi", "title", "citation"])
+        editor.process_dataset("doi:A", [(("doi:A", "New Title", ""), plan, None)], FakeScheduler())
+
+        assert dict(editor.run_metrics.datasets) == {"push_failed": 1}
+
+
+class TestJoinSheets:
+    """Test the cross-sheet DOI join"""
+
+    def test_each_dataset_fetched_once_across_sheets(self, tmp_path, monkeypatch):
+        """Test that edits from several block sheets share one fetch and one push"""
+        citation_csv = tmp_path / "citation.csv"
+        citation_csv.write_text("doi,title,citation\nhttps://doi.org/10.5072/FK2/TEST1,New Title,\n", encoding="utf-8")
+        geospatial_csv = tmp_path / "geospatial.csv"
+        geospatial_csv.write_text("doi,geographicUnit,geospatial\ndoi:10.5072/FK2/TEST1,Province,\n", encoding="utf-8")
+
+        record = {
+            "data": {
+                "id": 1,
+                "latestVersion": {
+                    "metadataBlocks": {
+                        "citation": {
+                            "fields": [{"typeName": "title", "multiple": False, "typeClass": "primitive", "value": "Old Title"}]
+                        }
+                    }
+                }
+            }
+        }
+
+        fetched, pushes = [], []
+        monkeypatch.setattr(editor, "file_directory", [str(citation_csv), str(geospatial_csv)])
+        monkeypatch.setattr(editor, "get_dataset", lambda doi, include_files=True: fetched.append(doi) or fake_record_response(record))
+        monkeypatch.setattr(editor, "check_lock", lambda dataset_id, lock_status: True)
+        monkeypatch.setattr(editor, "API_push", lambda fields, doi: pushes.append((fields, doi)))
+
+        editor.file_loader()
+
+        assert fetched == ["doi:10.5072/FK2/TEST1"]
+        assert len(pushes) == 1
+        assert [field["typeName"] for field in pushes[0][0]] == ["title", "geographicUnit"]
+
+
+class TestWorkbookSheets:
+    """Test reading the block sheets straight from an Excel workbook"""
+
+    def test_shipped_workbook_sheets_match_their_blocks(self):
+        """Test that every sheet of All_Sheets.xlsx is matched to its block by its marker column"""
+        pytest.importorskip("openpyxl")
+        workbook = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                "CSV_Excel_Sheets", "All_Sheets.xlsx")
+
+        blocks = [editor.compile_column_plan(headers).block_name for _, headers, _ in editor.iter_sheets([workbook])]
+
+        assert blocks == ["citation", "terms", "socialscience", "geospatial", "astrophysics",
+                          "biomedical", "journal", "computationalworkflow", "3dobjects"]
+
+    def test_workbook_sheets_are_joined_by_doi(self, tmp_path, monkeypatch):
+        """Test that a workbook's sheets are read like their CSV exports and share one fetch and push"""
+        openpyxl = pytest.importorskip("openpyxl")
+        from datetime import datetime
+
+        workbook = openpyxl.Workbook()
+        citation = workbook.active
+        citation.title = "Citation"
+        citation.append(["doi", "title", "productionDate", "citation", None])
+        citation.append(["https://doi.org/10.5072/FK2/TEST1", "New Title", datetime(2024, 5, 1), None])
+        citation.append([None, None, None, None])
+        workbook.create_sheet("Vocabulary").append(["Biology", "Physics"])
+        geospatial = workbook.create_sheet("Geospatial")
+        geospatial.append(["doi", "geographicUnit", "geospatial"])
+        geospatial.append(["doi:10.5072/FK2/TEST1", 12.0])
+        path = tmp_path / "All_Sheets.xlsx"
+        workbook.save(path)
+
+        record = {"data": {"id": 1, "latestVersion": {"metadataBlocks": {"citation": {"fields": [
+            {"typeName": "title", "multiple": False, "typeClass": "primitive", "value": "Old Title"}]}}}}}
+
+        fetched, pushes = [], []
+        monkeypatch.setattr(editor, "file_directory", [str(path)])
+        monkeypatch.setattr(editor, "get_dataset", lambda doi, include_files=True: fetched.append(doi) or fake_record_response(record))
+        monkeypatch.setattr(editor, "check_lock", lambda dataset_id, lock_status: True)
+        monkeypatch.setattr(editor, "API_push", lambda fields, doi: pushes.append((fields, doi)))
+
+        editor.file_loader()
+
+        assert fetched == ["doi:10.5072/FK2/TEST1"]
+        assert [(field["typeName"], field["value"]) for field in pushes[0][0]] == [
+            ("title", "New Title"), ("productionDate", "2024-05-01"), ("geographicUnit", ["12"])]
+
+
+class TestDatasetWorkPool:
+    """Test the DOI-partitioned worker pool"""
+
+    def test_same_doi_runs_in_order(self):
+        """Test that work for one DOI keeps its order while DOIs run in parallel"""
+        import threading
+        import time
+
+        seen = {"doi:A": [], "doi:B": []}
+        active = set()
+        overlap = threading.Event()
+        lock = threading.Lock()
+
+        def work(doi, index):
+            with lock:
+                assert doi not in active
+                active.add(doi)
+                if len(active) > 1:
+                    overlap.set()
+            time.sleep(0.01)
+            seen[doi].append(index)
+            with lock:
+                active.discard(doi)
+
+        pool = editor.DatasetWorkPool(max_workers=4, max_pending=3)
+        for index in range(10):
+            pool.submit("doi:A", work, "doi:A", index)
+            pool.submit("doi:B", work, "doi:B", index)
+        pool.shutdown()
+
+        assert seen["doi:A"] == list(range(10))
+        assert seen["doi:B"] == list(range(10))
+        assert overlap.is_set()
+
+    def test_exit_in_work_does_not_strand_the_doi(self):
+        """Test that a SystemExit raised by work leaves the DOI's later work runnable"""
+        import sys as system
+        seen = []
+
+        pool = editor.DatasetWorkPool(max_workers=2, max_pending=4)
+        pool.submit("doi:A", system.exit, 1)
+        pool.wait()
+        pool.submit("doi:A", seen.append, "after")
+        pool.shutdown()
+
+        assert seen == ["after"]
+        assert not pool.busy("doi:A")
+
+
+class TestLockScheduler:
+    """Test the timed lock-wait queue"""
+
+    def test_parked_work_is_handed_back_in_order_once_unlocked(self, monkeypatch):
+        """Test that parked rows run in order after the lock clears, and stuck ones expire"""
+        polls = {"A": [True, True, False]}
+        monkeypatch.setattr(editor, "fetch_lock_state", lambda dataset_id: polls[dataset_id].pop(0) if dataset_id in polls else True)
+        monkeypatch.setattr(editor, "lock_backoff_delay", lambda attempt: 0.01)
+
+        done = []
+        pool = editor.DatasetWorkPool(max_workers=2, max_pending=4)
+        scheduler = editor.LockScheduler(pool, deadline=0.2)
+
+        scheduler.park("doi:A", "A", done.append, "first")
+        assert scheduler.park_behind("doi:A", done.append, "second")
+        assert not scheduler.park_behind("doi:C", done.append, "never")
+        scheduler.park("doi:B", "B", done.append, "stuck")
+
+        scheduler.wait()
+        pool.shutdown()
+        scheduler.close()
+
+        assert done == ["first", "second"]
+        assert scheduler.expired == ["doi:B"]
+
+    def test_unreadable_lock_status_is_not_reported_as_expired(self, monkeypatch):
+        """Test that a dataset whose locks cannot be read is dropped as unreadable, not expired"""
+        monkeypatch.setattr(editor, "fetch_lock_state", lambda dataset_id: None)
+        monkeypatch.setattr(editor, "lock_backoff_delay", lambda attempt: 0.01)
+        events = []
+        monkeypatch.setattr(editor, "log_event", lambda event, **fields: events.append(event))
+
+        done = []
+        pool = editor.DatasetWorkPool(max_workers=1, max_pending=4)
+        scheduler = editor.LockScheduler(pool, deadline=60)
+        scheduler.park("doi:A", "A", done.append, "never")
+
+        scheduler.wait()
+        pool.shutdown()
+        scheduler.close()
+
+        assert done == []
+        assert scheduler.unreadable == ["doi:A"]
+        assert scheduler.expired == []
+        assert events == ["lock_unreadable"]
+
+    def test_backoff_grows_and_is_capped(self, monkeypatch):
+        """Test that poll delays double up to lock_poll_max"""
+        monkeypatch.setattr(editor, "lock_poll_jitter", 0)
+
+        delays = [editor.lock_backoff_delay(attempt) for attempt in range(10)]
+
+        assert delays[1] == 2 * delays[0]
+        assert max(delays) == editor.lock_poll_max
+
+
+class TestPublishQueue:
+    """Test the publish stage that runs next to the edit workers"""
+
+    def test_changed_datasets_publish_once_after_their_edits(self, monkeypatch):
+        """Test that a DOI is published once its last edit is done and its lock clears"""
+        locks = {"A": [False, True], "B": [True]}
+        monkeypatch.setattr(editor, "check_lock", lambda dataset_id, lock_status: locks[dataset_id].pop(0))
+        monkeypatch.setattr(editor, "fetch_lock_state", lambda dataset_id: False)
+        monkeypatch.setattr(editor, "lock_backoff_delay", lambda attempt: 0.01)
+        published = []
+        monkeypatch.setattr(editor, "publish_dataset", lambda doi, version_type: published.append((doi, version_type)) or 200)
+
+        publisher = None
+        pool = editor.DatasetWorkPool(max_workers=2, max_pending=4, on_idle=lambda doi: publisher.dataset_idle(doi))
+        scheduler = editor.LockScheduler(pool, deadline=5)
+        publisher = editor.PublishQueue(pool, scheduler, 2, 5, "major")
+
+        for doi, dataset_id in (("doi:A", "A"), ("doi:A", "A"), ("doi:B", "B")):
+            pool.submit(doi, publisher.mark, doi, dataset_id)
+        pool.submit("doi:C", lambda: None)
+        pool.wait()
+        publisher.wait()
+        publisher.close()
+        scheduler.close()
+        pool.shutdown()
+
+        assert sorted(published) == [("doi:A", "major"), ("doi:B", "major")]
+        assert publisher.outcomes == {"doi:A": "published", "doi:B": "published"}
+
+    def test_only_accepted_writes_are_published(self, monkeypatch):
+        """Test that rejected or empty edits never queue a dataset for publishing"""
+        record = {"data": {"id": 5, "latestVersion": {"files": [], "metadataBlocks": {"citation": {
+            "fields": [{"typeName": "title", "multiple": False, "typeClass": "primitive", "value": "Old Title"}]}}}}}
+
+        class FakePublisher:
+            marked = []
+
+            def mark(self, doi, dataset_id):
+                self.marked.append(doi)
+
+        accepted = {"doi:A": True, "doi:B": False}
+        monkeypatch.setattr(editor, "get_dataset", lambda doi, include_files=True: fake_record_response(record))
+        monkeypatch.setattr(editor, "check_lock", lambda dataset_id, lock_status: True)
+        monkeypatch.setattr(editor, "API_push", lambda fields, doi: accepted[doi])
+
+        title = editor.compile_column_plan(["doi", "title", "citation"])
+        variables = editor.compile_column_plan(["doi", "file", "variable", "label", "variables"])
+        publisher = FakePublisher()
+        editor.process_dataset("doi:A", [(("doi:A", "New Title", ""), title, None)], FakeScheduler(), None, publisher)
+        editor.process_dataset("doi:B", [(("doi:B", "New Title", ""), title, None)], FakeScheduler(), None, publisher)
+        editor.process_dataset("doi:C", [(("doi:C", "missing.tab", "age", "Age", ""), variables, None)],
+                               FakeScheduler(), None, publisher)
+
+        assert publisher.marked == ["doi:A"]
+
+
+class TestHttpClient:
+    """Test the shared pooled HTTP session"""
+
+    def test_session_is_shared_and_sized_to_workers(self, monkeypatch):
+        """Test that one session is reused and its pool matches the worker count"""
+        monkeypatch.setattr(editor, "_http_session", None)
+        monkeypatch.setattr(editor, "max_workers", 8)
+        monkeypatch.setattr(editor, "pool_maxsize", None)
+
+        session = editor.get_http_session()
+
+        assert editor.get_http_session() is session
+        assert session.get_adapter("https://example.org")._pool_maxsize == 8
+        assert session.headers["X-Dataverse-key"] == editor.api_token_origin
+
+    def test_requests_use_default_timeout(self, monkeypatch):
+        """Test that dataverse_request applies request_timeout"""
+        calls = []
+
+        class FakeSession:
+            def request(self, method, url, **kwargs):
+                calls.append((method, url, kwargs))
+                return type("FakeResponse", (), {"status_code": 200, "headers": {}})()
+
+        monkeypatch.setattr(editor, "_http_session", FakeSession())
+
+        editor.dataverse_put("https://example.org/api/edit/1", data="x")
+
+        assert calls == [("PUT", "https://example.org/api/edit/1", {"data": "x", "timeout": editor.request_timeout})]
+
+    def test_overloaded_requests_slow_down_and_retry(self, monkeypatch):
+        """Test that a 429 halves the rate and limit and the request is sent again"""
+        statuses = [429, 503, 200]
+
+        class FakeSession:
+            def request(self, method, url, **kwargs):
+                return type("FakeResponse", (), {"status_code": statuses.pop(0), "headers": {"Retry-After": "0"}, "close": lambda self: None})()
+
+        limiter = editor.AdaptiveRateLimiter(max_rate=100, burst=10, max_concurrency=8, min_rate=1)
+        monkeypatch.setattr(editor, "_http_session", FakeSession())
+        monkeypatch.setattr(editor, "_rate_limiter", limiter)
+
+        resp = editor.dataverse_get("https://example.org/api/datasets/1/locks")
+
+        assert resp.status_code == 200
+        assert statuses == []
+        assert limiter.rate < 50 and limiter.limit < 4
+
+    def test_idempotent_requests_retried_and_budget_enforced(self, monkeypatch):
+        """Test that a GET is retried on 502, a POST is not, and failures use up the budget"""
+        statuses = [502, 200, 502]
+        calls = []
+
+        class FakeSession:
+            def request(self, method, url, **kwargs):
+                calls.append(method)
+                return type("FakeResponse", (), {"status_code": statuses.pop(0), "headers": {}, "close": lambda self: None})()
+
+        monkeypatch.setattr(editor, "_http_session", FakeSession())
+        monkeypatch.setattr(editor, "_rate_limiter", editor.AdaptiveRateLimiter(100, 10, 8, 1))
+        monkeypatch.setattr(editor, "_error_budget", editor.ErrorBudget(1))
+        monkeypatch.setattr(editor, "request_retry_initial", 0)
+
+        assert editor.dataverse_get("https://example.org/api/datasets/1").status_code == 200
+        assert editor.dataverse_post("https://example.org/api/datasets/1/actions/:publish").status_code == 502
+        assert calls == ["GET", "GET", "POST"]
+
+        with pytest.raises(editor.ErrorBudgetExhausted):
+            editor.dataverse_get("https://example.org/api/datasets/1")
+
+    def test_retry_after_header(self):
+        """Test that Retry-After is read in seconds or as an HTTP date"""
+        assert editor.parse_retry_after("12") == 12.0
+        assert editor.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+        assert editor.parse_retry_after(None) is None
+
+
+class TestDatasetCache:
+    """Test the on-disk dataset record cache"""
+
+    @staticmethod
+    def record_text(dataset_id, last_update):
+        return json.dumps({"status": "OK", "data": {"id": dataset_id, "latestVersion": {
+            "lastUpdateTime": last_update, "versionNumber": 1, "versionMinorNumber": 0, "metadataBlocks": {}}}})
+
+    def test_lru_eviction_and_id_mapping(self, tmp_path):
+        """Test that the least recently used record is evicted and ids are remembered"""
+        cache = editor.DatasetCache(str(tmp_path), max_entries=2, max_bytes=10 ** 6)
+        cache.put("doi:A", self.record_text(1, "t1"))
+        cache.put("doi:B", self.record_text(2, "t1"))
+        cache.get("doi:A")
+        cache.put("doi:C", self.record_text(3, "t1"))
+        cache.save()
+
+        reopened = editor.DatasetCache(str(tmp_path), max_entries=2, max_bytes=10 ** 6)
+        assert reopened.get("doi:B") is None
+        assert reopened.dataset_id("doi:A") == 1
+        assert json.loads(reopened.get("doi:C")[0])["data"]["id"] == 3
+
+    def test_get_dataset_revalidates_with_last_update_time(self, tmp_path, monkeypatch):
+        """Test that unchanged datasets are served locally and changed ones refetched"""
+        # /timestamps reports the dataset's modification time, not in the version's format
+        server_time = {"value": "2024-05-01T10:00:00.123"}
+        requests_made = []
+
+        def fake_get(url, **kwargs):
+            requests_made.append(url.rsplit("/", 1)[-1])
+            if url.endswith("/timestamps"):
+                return fake_record_response({"data": {"lastUpdateTime": server_time["value"]}})
+            return FakeResponse(self.record_text(7, server_time["value"][:19] + "Z"))
+
+        monkeypatch.setattr(editor, "dataverse_get", fake_get)
+        monkeypatch.setattr(editor, "dataset_cache_dir", str(tmp_path))
+        monkeypatch.setattr(editor, "_dataset_cache", None)
+
+        editor.get_dataset("doi:A")
+        cached = editor.get_dataset("doi:A")
+        server_time["value"] = "2024-05-02T09:30:00.456"
+        refreshed = editor.get_dataset("doi:A")
+
+        assert isinstance(cached, editor.CachedResponse)
+        assert refreshed.json()["data"]["latestVersion"]["lastUpdateTime"] == "2024-05-02T09:30:00Z"
+        assert requests_made == ["timestamps", "", "timestamps", "timestamps", ""]
+
+    def test_offline_cache_only_serves_plan_runs(self, tmp_path, monkeypatch):
+        """Test that dataset_cache_offline never hands an unchecked record to an update run"""
+        requests_made = []
+
+        def fake_get(url, **kwargs):
+            requests_made.append(url.rsplit("/", 1)[-1])
+            if url.endswith("/timestamps"):
+                return fake_record_response({"data": {"lastUpdateTime": "t1"}})
+            return FakeResponse(self.record_text(7, "t1"))
+
+        monkeypatch.setattr(editor, "dataverse_get", fake_get)
+        monkeypatch.setattr(editor, "dataset_cache_dir", str(tmp_path))
+        monkeypatch.setattr(editor, "_dataset_cache", None)
+        monkeypatch.setattr(editor, "dataset_cache_offline", True)
+        editor.get_dataset_cache().put("doi:A", self.record_text(7, "t0"), last_update_time="t0")
+
+        monkeypatch.setattr(editor, "run_mode", "plan")
+        assert isinstance(editor.get_dataset("doi:A"), editor.CachedResponse)
+        assert requests_made == []
+
+        monkeypatch.setattr(editor, "run_mode", "update")
+        editor.get_dataset("doi:A")
+        assert requests_made == ["timestamps", ""]
+
+    def test_files_fetched_only_for_sheets_that_need_them(self, tmp_path, monkeypatch):
+        """Test that field edits fetch the latest version without files and a cached metadata-only record is not reused for terms"""
+        from fake_dataverse import FakeDataverse
+
+        citation = editor.compile_column_plan(["doi", "title", "citation"])
+        terms = editor.compile_column_plan(["doi", "termsOfUse", "terms"])
+
+        with FakeDataverse(tab_files=3) as server:
+            for name, value in dict(url_base_origin=server.url, dataset_cache_dir=str(tmp_path), request_error_budget=None,
+                                    _dataset_cache=None, _http_session=None, _rate_limiter=None, _error_budget=None).items():
+                monkeypatch.setattr(editor, name, value)
+
+            metadata_only = editor.get_dataset("doi:A", include_files=editor.edits_need_files([((), citation, None)])).json()
+            cached = editor.get_dataset("doi:A", include_files=editor.edits_need_files([((), citation, None)]))
+            complete = editor.get_dataset("doi:A", include_files=editor.edits_need_files([((), terms, None)])).json()
+
+            assert server.counts[("versions/:latest", 200)] == 1
+            assert server.counts[("dataset", 200)] == 1
+
+        assert isinstance(cached, editor.CachedResponse)
+        assert metadata_only["data"]["id"] == complete["data"]["id"]
+        assert "files" not in metadata_only["data"]["latestVersion"]
+        assert len(complete["data"]["latestVersion"]["files"]) == 3
+        assert metadata_only["data"]["latestVersion"]["metadataBlocks"] == complete["data"]["latestVersion"]["metadataBlocks"]
+
+
+class TestChangePlan:
+    """Test the plan/apply split"""
+
+    def test_plan_then_apply(self, tmp_path, monkeypatch):
+        """Test that planning sends nothing and applying sends the planned fields"""
+        record = {"data": {"id": 5, "latestVersion": {"lastUpdateTime": "t1", "metadataBlocks": {"citation": {
+            "fields": [{"typeName": "title", "multiple": False, "typeClass": "primitive", "value": "Old Title"}]}}}}}
+
+        pushes = []
+        monkeypatch.setattr(editor, "get_dataset", lambda doi, include_files=True: fake_record_response(record))
+        monkeypatch.setattr(editor, "API_push", lambda fields, doi: pushes.append((fields, doi)))
+        monkeypatch.setattr(editor, "check_lock", lambda dataset_id, lock_status: True)
+        monkeypatch.setattr(editor, "fetch_version_update_time", lambda doi: "t1")
+
+        plan_path = str(tmp_path / "plan.jsonl")
+        plan = editor.compile_column_plan(["doi", "title", "citation"])
+        writer = editor.ChangePlanWriter(plan_path)
+        editor.process_dataset("doi:A", [(("doi:A", "New Title", ""), plan, None)], FakeScheduler(), writer)
+        editor.process_dataset("doi:B", [(("doi:B", "Old Title", ""), plan, None)], FakeScheduler(), writer)
+        writer.close()
+
+        entries = list(editor.iter_change_plan(plan_path))
+        assert pushes == []
+        assert [entry["doi"] for entry in entries] == ["doi:A"]
+        assert entries[0]["before"] == {"title": "Old Title"}
+
+        editor.apply_planned_changes(entries[0], FakeScheduler())
+        assert pushes == [(entries[0]["fields"], "doi:A")]
+        assert pushes[0][0][0]["value"] == "New Title"
+
+    def test_plan_and_apply_against_fake_server(self, tmp_path, monkeypatch):
+        """Test that a plan applies cleanly with Dataverse's timestamp formats and one line per dataset"""
+        from fake_dataverse import FakeDataverse
+
+        sheet = tmp_path / "citation.csv"
+        sheet.write_text("doi,title,subtitle,citation\ndoi:A,New Title,,\ndoi:A,,New Subtitle,\n")
+        plan_path = str(tmp_path / "plan.jsonl")
+
+        with FakeDataverse() as server:
+            for name, value in dict(url_base_origin=server.url, file_directory=[str(sheet)], change_plan_path=plan_path,
+                                    dataset_cache_dir=None, request_error_budget=None, publish_after_edit=False,
+                                    _http_session=None, _rate_limiter=None, _error_budget=None).items():
+                monkeypatch.setattr(editor, name, value)
+
+            monkeypatch.setattr(editor, "run_mode", "plan")
+            editor.file_loader()
+            entries = list(editor.iter_change_plan(plan_path))
+
+            monkeypatch.setattr(editor, "run_mode", "apply")
+            editor.file_loader()
+
+            assert server.modified("doi:A") != server.dataset("doi:A")["data"]["latestVersion"]["lastUpdateTime"]
+            assert server.edits["doi:A"] == 1
+
+        assert [[field["typeName"] for field in entry["fields"]] for entry in entries] == [["title", "subtitle"]]
+        assert dict(editor.run_metrics.datasets) == {"updated": 1}
+
+    def test_locked_dataset_parks_a_plan_reference(self, tmp_path, monkeypatch):
+        """Test that a locked dataset keeps only its plan offset while parked and rereads the plan after"""
+        plan_path = tmp_path / "plan.jsonl"
+        plan_path.write_text("\n".join(json.dumps({"doi": doi, "id": n, "lastUpdateTime": None, "before": {},
+                                                   "fields": [{"typeName": "title", "value": f"Title {n}"}],
+                                                   "terms": [], "variables": []})
+                                        for n, doi in enumerate(["doi:A", "doi:B"])) + "\n")
+
+        pushes, locked, loaded = [], {1}, []
+        monkeypatch.setattr(editor, "API_push", lambda fields, doi: pushes.append((fields[0]["value"], doi)))
+        monkeypatch.setattr(editor, "check_lock", lambda dataset_id, lock_status: dataset_id not in locked)
+        load_planned_change = editor.load_planned_change
+        monkeypatch.setattr(editor, "load_planned_change", lambda planned: loaded.append(planned.doi) or load_planned_change(planned))
+
+        scheduler = FakeScheduler()
+        for planned, entry in editor.iter_planned_changes(str(plan_path)):
+            editor.apply_planned_changes(planned, scheduler, None, entry)
+        assert pushes == [("Title 0", "doi:A")]
+        assert loaded == []
+        assert scheduler.parked == [editor.PlannedChange(str(plan_path), plan_path.read_bytes().index(b'{"doi": "doi:B"'), "doi:B", 1, None)]
+
+        locked.clear()
+        editor.apply_planned_changes(scheduler.parked[0], scheduler)
+        assert pushes[-1] == ("Title 1", "doi:B")
+        assert loaded == ["doi:B"]
+
+
+class TestTabFileSync:
+    """Test the variable metadata sync around a terms-of-use update"""
+
+    @staticmethod
+    def codebook(*variables):
+        body = "".join(f'<var ID="{var_id}" name="{name}"><labl level="variable">{label}</labl></var>'
+                       for var_id, name, label in variables)
+        return f'<codeBook xmlns="ddi:codebook:2_5"><dataDscr>{body}</dataDscr></codeBook>'.encode("utf-8")
+
+    @staticmethod
+    def fake_get(ddi):
+        class FakeDownload:
+            status_code = 200
+
+            def __init__(self, content):
+                self.content = content
+
+            def iter_content(self, chunk_size):
+                return (self.content[i:i + 7] for i in range(0, len(self.content), 7))
+
+            def close(self):
+                pass
+
+        return lambda url, **kwargs: FakeDownload(ddi[int(url.split("/")[-2])])
+
+    def test_variables_streamed_in_small_chunks(self):
+        """Test that variables are parsed incrementally and detached from the tree"""
+        xml = self.codebook(("v1", "age", "Age"), ("v2", "income", "Income"))
+        chunks = (xml[i:i + 5] for i in range(0, len(xml), 5))
+
+        names = [var.get("name") for var in editor.iter_ddi_variables(chunks)]
+
+        assert names == ["age", "income"]
+
+    def test_fragment_uses_default_namespace_without_global_registration(self):
+        """Test that fragments carry no ns0: prefix and ElementTree's global serialization is untouched"""
+        import xml.etree.ElementTree as ET
+
+        var = next(editor.iter_ddi_variables([self.codebook(("v1", "age", "Age"))]))
+        fragment = editor.ddi_fragment([var])
+
+        assert b"ns0:" not in fragment
+        assert [element.tag for element in ET.fromstring(fragment).iter()][2:] == ["{ddi:codebook:2_5}var", "{ddi:codebook:2_5}labl"]
+        assert var.tag == "{ddi:codebook:2_5}var"
+        plain = ET.Element("{ddi:codebook:2_5}var")
+        ET.SubElement(plain, "plain")
+        assert b"<plain />" in ET.tostring(plain) and b"ns0:var" in ET.tostring(plain)
+
+    def test_only_changed_variables_restored(self, monkeypatch):
+        """Test that only variables reset by the version PUT are sent back"""
+        ddi = {1: self.codebook(("v1", "age", "Age")), 2: self.codebook(("v2", "x", "X"), ("v3", "y", "Y"))}
+        restored = []
+
+        def fake_push_version(version, doi):
+            ddi[2] = self.codebook(("v2", "x", "X"), ("v3", "y", ""))          # The PUT resets one variable of file 2
+            return True
+
+        monkeypatch.setattr(editor, "dataverse_get", self.fake_get(ddi))
+        monkeypatch.setattr(editor, "API_push_terms_of_use", fake_push_version)
+        monkeypatch.setattr(editor, "var_update_dataset", lambda doi, file_id, xml: restored.append((file_id, xml)) or True)
+        monkeypatch.setattr(editor, "_tab_file_executor", None)
+
+        editor.push_terms_of_use({}, "doi:A", [1, 2])
+        editor.shutdown_tab_file_executor()
+
+        assert len(restored) == 1 and restored[0][0] == 2
+        assert b'name="y"' in restored[0][1] and b'name="x"' not in restored[0][1]
+
+    def test_failed_restore_does_not_stop_the_others(self, monkeypatch, caplog):
+        """Test that a restore raising after the version PUT is logged and the other files are still restored"""
+        restored = []
+
+        def fake_restore(doi, file_id, snapshot):
+            if file_id == 1:
+                raise editor.ErrorBudgetExhausted("budget used up")
+            restored.append(file_id)
+            return "restored"
+
+        monkeypatch.setattr(editor, "snapshot_variable_metadata", lambda file_id: ((), {}))
+        monkeypatch.setattr(editor, "API_push_terms_of_use", lambda version, doi: True)
+        monkeypatch.setattr(editor, "restore_variable_metadata", fake_restore)
+        monkeypatch.setattr(editor, "_tab_file_executor", None)
+
+        with caplog.at_level("WARNING", logger="universal_field_editor.terms"):
+            assert editor.push_terms_of_use({}, "doi:A", [1, 2, 3]) is True
+        editor.shutdown_tab_file_executor()
+
+        assert sorted(restored) == [2, 3]
+        assert "not restored for file(s) [1]" in caplog.text
+
+    def test_variable_labels_from_sheet(self, monkeypatch):
+        """Test that a variables sheet only sends the variables whose label changes"""
+        ddi = {7: self.codebook(("v1", "age", "Age"), ("v2", "income", "Income"))}
+        files = [{"label": "survey.tab", "dataFile": {"id": 7, "contentType": "text/tab-separated-values"}}]
+        rows = [{"file": "survey.tab", "variable": "age", "label": "Age"},
+                {"file": "7", "variable": "income", "label": "Household income"}]
+
+        monkeypatch.setattr(editor, "dataverse_get", self.fake_get(ddi))
+        monkeypatch.setattr(editor, "_tab_file_executor", None)
+
+        edits = editor.edit_variable_labels("doi:A", files, rows, push=False)
+        editor.shutdown_tab_file_executor()
+
+        assert [edit["file_id"] for edit in edits] == [7]
+        assert "Household income" in edits[0]["xml"] and 'name="age"' not in edits[0]["xml"]
+
+
+class TestColumnFormatting:
+    """Test batched column formatting"""
+
+    def test_matches_cell_formatting(self):
+        """Test that a formatted column matches formatting each cell and shares repeated values"""
+        plan = editor.compile_column_plan(["doi", "author: authorName; authorAffiliation", "citation"])
+        column = plan.columns[1]
+        cells = ["Doe, J;Univ+Roe, R;College", "Doe, J;Univ+Roe, R;College", "", "REMOVE"]
+
+        values = editor.format_column(column, cells)
+
+        assert values == [editor.format_cell(column.kind, column.children, cell, column.multiple) for cell in cells]
+        assert values[0] is values[1]
+        assert values[2] is None
+
+    def test_malformed_cell_raises_when_applied(self):
+        """Test that a malformed cell only fails the row that holds it"""
+        plan = editor.compile_column_plan(["doi", "author: authorName; authorAffiliation", "citation"])
+        rows = [("doi:A", "Doe, J;Univ", ""), ("doi:B", "a;b;c", "")]
+
+        formatted = [values for _, values in editor.iter_formatted_rows(rows, plan)]
+
+        assert editor.formatted_value(formatted[0][1])[0]["authorName"]["value"] == "Doe, J"
+        with pytest.raises(ValueError):
+            editor.formatted_value(formatted[1][1])
+
+
+class TestSchemaRegistry:
+    """Test metadata block schemas loaded from an /api/metadatablocks snapshot"""
+
+    BLOCK = {"name": "custom", "displayName": "Custom Metadata", "fields": {
+        "topic": {"name": "topic", "typeClass": "controlledVocabulary", "multiple": True,
+                  "controlledVocabularyValues": ["Biology", "Physics"]},
+        "grant": {"name": "grant", "typeClass": "compound", "multiple": True, "childFields": {
+            "grantAgency": {"name": "grantAgency", "typeClass": "primitive", "multiple": False}}},
+        "grantAgency": {"name": "grantAgency", "typeClass": "primitive", "multiple": False},
+    }}
+
+    def test_snapshot_drives_column_plans(self, tmp_path, monkeypatch):
+        """Test that a snapshot's blocks, child fields and vocabularies are indexed by name"""
+        path = tmp_path / "metadatablocks.json"
+        path.write_text(json.dumps({"format": editor.SCHEMA_SNAPSHOT_FORMAT, "blocks": [self.BLOCK]}))
+        monkeypatch.setattr(editor, "metadata_block_schema_path", str(path))
+        monkeypatch.setattr(editor, "_schema_registry", None)
+
+        registry = editor.get_schema_registry()
+        plan = editor.compile_column_plan(["doi", "topic", "grant: grantAgency", "custom"])
+
+        assert registry.field("grantAgency").parent == "grant"
+        assert registry.field("topic").vocabulary == frozenset(["Biology", "Physics"])
+        assert list(registry.block_fields("custom")) == ["topic", "grant"]
+        assert [column.kind for column in plan.columns] == ["doi", "primitive", "compound", "marker"]
+        assert editor.metadatablock_generator("custom") == {"custom": {"displayName": "Custom Metadata", "name": "custom", "fields": []}}
+
+    def test_refresh_writes_snapshot(self, tmp_path, monkeypatch):
+        """Test that a refresh downloads every block once and is reused without the network"""
+        responses = {
+            "/api/metadatablocks": [{"name": "custom"}],
+            "/api/metadatablocks/custom": self.BLOCK,
+            "/api/info/version": {"version": "6.5"},
+        }
+        requested = []
+
+        def fake_get(url, **kwargs):
+            requested.append(url)
+            body = {"status": "OK", "data": responses[url[len(editor.url_base_origin):]]}
+            return type("Response", (), {"status_code": 200, "json": lambda self: body})()
+
+        path = tmp_path / "metadatablocks.json"
+        monkeypatch.setattr(editor, "dataverse_get", fake_get)
+        monkeypatch.setattr(editor, "metadata_block_schema_path", str(path))
+        monkeypatch.setattr(editor, "_schema_registry", None)
+
+        editor.refresh_schema_registry()
+        monkeypatch.setattr(editor, "_schema_registry", None)
+        registry = editor.get_schema_registry()
+
+        assert len(requested) == 3
+        assert json.loads(path.read_text())["dataverseVersion"] == "6.5"
+        assert registry.block_names == ("custom",)
+
+
+class TestStartup:
+    """Test the command line and the cost of importing the script"""
+
+    def test_import_does_not_load_pydataverse(self):
+        """Test that pyDataverse is only imported when a client is asked for"""
+        import subprocess
+
+        code = ("import importlib.util, sys; "
+                f"spec = importlib.util.spec_from_file_location('editor', {editor.__file__!r}); "
+                "module = importlib.util.module_from_spec(spec); spec.loader.exec_module(module); "
+                "print('pyDataverse' in sys.modules)")
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+
+        assert result.stdout.strip() == "False"
+
+    def test_command_line_overrides_environment(self, monkeypatch):
+        """Test that options override environment variables, which override the file's settings"""
+        for name in ("url_base_origin", "api_token_origin", "file_directory", "publish_after_edit", "run_mode", "max_workers"):
+            monkeypatch.setattr(editor, name, getattr(editor, name))
+
+        arguments = editor.parse_arguments(["a.csv", "b.csv", "--url", "https://example.org", "--workers", "4"])
+        editor.apply_settings(arguments, {"DATAVERSE_BASE_URL": "https://env.example.org", "DATAVERSE_API_TOKEN": "secret",
+                                          "CSV_FILE_PATHS": "c.csv, d.csv", "AUTO_PUBLISH": "true"})
+
+        assert editor.url_base_origin == "https://example.org"
+        assert editor.dataverse_config() == editor.DataverseConfig("https://example.org", "secret")
+        assert editor.file_directory == ["a.csv", "b.csv"]
+        assert editor.publish_after_edit is True
+        assert editor.max_workers == 4
+        assert editor.run_mode == "update"
+
+
+class TestRunMetrics:
+    """Test phase timings, request counts and the run report"""
+
+    def test_report_and_prometheus_textfile(self, tmp_path, monkeypatch):
+        """Test that recorded metrics are written as JSON and in the Prometheus format"""
+        metrics = editor.RunMetrics()
+        monkeypatch.setattr(editor, "run_metrics", metrics)
+        monkeypatch.setattr(editor, "run_report_path", str(tmp_path / "report.json"))
+        monkeypatch.setattr(editor, "prometheus_textfile_path", str(tmp_path / "editor.prom"))
+
+        for seconds in (0.001, 0.02, 0.02, 3.0):
+            metrics.observe("fetch", seconds)
+        metrics.count_request("GET", editor.endpoint_name(editor.url_base_origin + "/api/datasets/42/locks"), 200, 0.01)
+        editor.log_event("dataset", doi="doi:A", outcome="updated")
+        editor.write_run_report()
+
+        report = json.loads((tmp_path / "report.json").read_text())
+        assert report["phases"]["fetch"]["count"] == 4
+        assert report["phases"]["fetch"]["p50"] == 0.025
+        assert report["phases"]["fetch"]["p99"] == 5
+        assert report["requests"] == [{"method": "GET", "endpoint": "/api/datasets/{id}/locks", "status": 200, "count": 1}]
+        assert report["datasets"] == {"updated": 1}
+
+        textfile = (tmp_path / "editor.prom").read_text()
+        assert 'field_editor_phase_seconds_bucket{phase="fetch",le="+Inf"} 4' in textfile
+        assert 'field_editor_requests_total{method="GET",endpoint="/api/datasets/{id}/locks",status="200"} 1' in textfile
+
+
+class TestLogging:
+    """Test lazy log arguments and the JSONL event log"""
+
+    def test_lazy_argument_not_formatted_below_level(self, monkeypatch):
+        """Test that a Lazy argument is only evaluated when the message is emitted"""
+        calls = []
+        monkeypatch.setattr(editor.edit_logger, "level", editor.logging.INFO)
+        editor.edit_logger.debug("%s", editor.Lazy(calls.append, "formatted"))
+        assert calls == []
+
+    def test_events_written_as_json_lines(self, tmp_path):
+        """Test that log_event writes one JSON object per event"""
+        handler = editor.JsonlEventHandler(str(tmp_path / "events.jsonl"))
+        editor.event_logger.addHandler(handler)
+        editor.event_logger.setLevel(editor.logging.INFO)
+        try:
+            editor.log_event("dataset", doi="doi:A", fields=2)
+            editor.log_event("parked", doi="doi:B")
+        finally:
+            editor.event_logger.removeHandler(handler)
+            handler.close()
+
+        lines = (tmp_path / "events.jsonl").read_text().splitlines()
+        events = [json.loads(line) for line in lines]
+        assert [event["event"] for event in events] == ["dataset", "parked"]
+        assert events[0]["doi"] == "doi:A" and events[0]["fields"] == 2
+
+
 class TestCheckLock:
     """Test the check_lock function"""
 
+    def test_unavailable_server_does_not_end_the_run(self, monkeypatch):
+        """Test that a 503 reports the dataset as locked instead of exiting"""
+        monkeypatch.setattr(editor, "dataverse_get", lambda url, **kwargs: type("FakeResponse", (), {"status_code": 503})())
+
+        assert editor.check_lock("1", 0) is False
+
     @pytest.mark.integration
     def test_check_lock_with_locked_dataset(self):
         """
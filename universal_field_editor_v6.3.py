@@ -11,19 +11,33 @@ Automatically generated by Colab and enhanced with proper documentation.
 """
 
 import xml.etree.ElementTree as ET
-from datetime import datetime
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager
+from bisect import bisect_left
+import threading
+import itertools
+import argparse
+import logging
+import random
+import re
+import heapq
+import hashlib
+import zlib
+import copy
+import os
 import sys
 import time
 import csv
 import json
 
-import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 
-# Dataverse API imports
+# Dataverse API clients (pyDataverse) are imported on first use, see get_native_api
 # Documentation: https://pydataverse.readthedocs.io/en/latest/
-import pyDataverse.utils as utils
-from pyDataverse.api import NativeApi, DataAccessApi
 
 # ============================================================================
 # CONFIGURATION SETTINGS
@@ -46,6 +60,8 @@ file_directory = ['/Citation Fields CSV - Citation.csv',
 """
 
 # if using windows, put an r before your copied path string, as demonstrated below
+# An Excel workbook (.xlsx, e.g. CSV_Excel_Sheets/All_Sheets.xlsx) can be listed instead of
+# its exported CSV files: every sheet with a marker column is read (needs openpyxl)
 file_directory = [r"directory/to/data/file.csv"]
 
 
@@ -54,604 +70,3494 @@ api_token_origin = "ENTER_API_KEY_HERE"                 # Dataverse API token
 url_base_origin = 'https://borealisdata.ca'             # Demo base URL (e.g., https://demo.borealisdata.ca)
 
 
-# API headers and client initialization
-headers_origin = {'X-Dataverse-key': api_token_origin}
-api_origin = NativeApi(url_base_origin, api_token_origin)
-data_api_origin = DataAccessApi(url_base_origin, api_token_origin)
+# pyDataverse clients for interactive use are created on first use from these settings
+# (see get_native_api); the script's own calls go through get_http_session
+
+
+# Concurrency settings
+"""
+Rows are partitioned by DOI: all edits to the same dataset run in order on one
+worker, while different datasets are fetched, lock-checked and pushed in parallel.
+Keep max_workers modest when targeting a shared instance such as Borealis.
+"""
+max_workers = 1                                         # Datasets processed at once (1 = sequential)
+pending_rows_per_worker = 4                             # Rows read ahead per worker before the CSV reader waits
+join_sheets_by_doi = True                               # With several sheets, fetch each dataset once and apply all its rows together
+format_batch_size = 256                                 # Rows whose cells are formatted together, column by column
+tab_file_workers = 4                                    # Tabular files whose variable metadata is synced at once (terms of use)
+tab_file_skip_unchanged = True                          # Only send back variable metadata that the terms-of-use update changed
+
+
+# Run mode settings
+"""
+run_mode = 'update' reads the sheets, fetches each dataset and pushes its changes.
+run_mode = 'plan' does the same reading, fetching and formatting but sends nothing:
+every dataset's changes are written to change_plan_path instead, one JSON line per
+dataset (all of its rows, from every sheet) with the fields to send and their values
+before the edit, for review.
+run_mode = 'apply' sends a plan written earlier without reading the sheets or
+fetching the records again. With apply_skip_changed = True, a dataset that was
+modified after the plan was made is skipped (re-run the plan for it).
+"""
+run_mode = 'update'                                     # 'update', 'plan' or 'apply'
+change_plan_path = r"directory/to/change_plan.jsonl"    # Written by 'plan', read by 'apply'
+apply_skip_changed = True                               # Skip datasets whose version lastUpdateTime changed since the plan
+
+
+# Metadata block schema settings
+"""
+Field definitions (typeClass, multiple, child fields, controlled vocabularies) are
+read from a snapshot of the installation's /api/metadatablocks, so custom blocks
+and fields added on the server are recognised without editing the script. The
+snapshot is only downloaded when refresh_metadata_block_schema = True (or when
+refresh_schema_registry() is called); otherwise starting a run needs no network.
+Without a snapshot the built-in definitions of the standard blocks are used.
+"""
+metadata_block_schema_path = None                       # e.g. r"directory/to/metadatablocks.json" (None = built-in definitions)
+refresh_metadata_block_schema = False                   # Download a new snapshot at the start of the run
+
+
+# Publish settings
+"""
+With publish_after_edit = True every dataset that was changed is published once
+all of its edits are done. Edited DOIs are queued as the workers finish with them,
+and a separate pool of publish_workers waits for each dataset's locks (from the
+edit itself, file ingest, ...) and publishes it while other datasets are still
+being edited. publish_type selects a 'minor' (1.1 -> 1.2) or 'major' (1.1 -> 2.0)
+version. Nothing is published in 'plan' mode, and a dataset is only published if
+the server accepted every change sent for it (a partly applied one stays a draft).
+"""
+publish_after_edit = False                              # Publish datasets after their edits
+publish_type = 'minor'                                  # 'minor' or 'major'
+publish_workers = 2                                     # Datasets published at once
+
+
+# Logging settings
+"""
+At INFO a run logs one compact line per dataset; DEBUG adds full records, rows
+and request payloads. Set event_log_path to also write one JSON object per event
+(dataset updated, request sent, dataset parked, ...) for later analysis.
+"""
+log_level = 'INFO'                                      # DEBUG, INFO, WARNING or ERROR
+log_file = None                                         # Also write the log to this file (None = console only)
+event_log_path = None                                   # Structured JSONL event log (None = off)
+
+
+# Run report settings
+"""
+Every run times its phases (reading the sheets, fetching datasets, lock checks and
+waits, formatting, pushes) and counts requests by endpoint and status. Set
+run_report_path to write the totals and latency histograms as JSON when the run
+ends, and prometheus_textfile_path to also write them in the Prometheus text
+format (e.g. for node_exporter's textfile collector).
+"""
+run_report_path = None                                  # e.g. r"directory/to/run_report.json" (None = off)
+prometheus_textfile_path = None                         # e.g. r"/var/lib/node_exporter/field_editor.prom" (None = off)
+
+
+# Lock wait settings
+"""
+Locked datasets are parked in a timed queue and re-polled with exponential backoff
+and jitter, so unlocked work keeps flowing while they wait. A dataset that is still
+locked after lock_wait_deadline seconds is reported and skipped.
+"""
+lock_poll_initial = 2                                   # First re-poll delay in seconds
+lock_poll_max = 60                                      # Longest delay between polls in seconds
+lock_poll_jitter = 0.5                                  # Fraction of each delay that is randomized
+lock_wait_deadline = 3600                               # Give up on a locked dataset after this many seconds
+
+
+# HTTP client settings
+"""
+Every Dataverse call goes through one shared keep-alive session, so TCP/TLS
+handshakes are paid once per connection instead of once per request.
+"""
+request_timeout = (10, 120)                             # (connect, read) timeout in seconds
+request_max_retries = 3                                 # Retries of a GET/PUT after a timeout, connection error or 5xx
+request_retry_initial = 1                               # First retry delay in seconds (doubled on every retry)
+request_retry_max = 30                                  # Longest delay between retries in seconds
+request_error_budget = 50                               # Failed requests tolerated before the run stops (None = no limit)
+pool_connections = 4                                    # Number of hosts to keep connection pools for
+pool_maxsize = None                                     # Connections kept per host (None = max_workers)
+
+
+# Rate limit settings
+"""
+Every Dataverse call draws from one shared token bucket and counts against an
+adaptive limit on requests in flight. When the server answers 429 or 503 all
+callers pause (for Retry-After seconds if the server sends it), the request rate
+and the in-flight limit are halved, and the request is retried; while the server
+keeps answering they grow back step by step, up to requests_per_second and
+max_workers.
+"""
+requests_per_second = 10                                # Ceiling on the request rate
+request_burst = 10                                      # Requests that may be sent back to back
+min_requests_per_second = 0.5                           # Floor the rate is never cut below
+overload_pause = 30                                     # Pause in seconds on 429/503 without Retry-After
+overload_max_retries = 5                                # Times one request is retried on 429/503 before giving up
+
+
+# Dataset cache settings
+"""
+When dataset_cache_dir is set, dataset records are kept on disk between runs and
+revalidated against the dataset's lastUpdateTime (/timestamps) before being reused,
+so only datasets that changed since the last run are downloaded again. With
+dataset_cache_offline = True cached records are used without asking the server
+(useful for repeated 'plan' runs on the same sheets). It is ignored in 'update'
+mode, where edits must be computed against the current record.
+"""
+dataset_cache_dir = None                                # e.g. r"directory/to/cache" (None = no cache)
+dataset_cache_max_entries = 10000                       # Least recently used records are evicted past this count
+dataset_cache_max_bytes = 512 * 1024 * 1024             # ...or past this total size on disk
+dataset_cache_offline = False                           # Serve cached records without revalidating ('plan' mode only)
+
+
+# Dataset fetch settings
+"""
+Field edits never look at a dataset's files, which make up most of the record of a
+large deposit. With fetch_files_when_needed = True datasets are fetched from
+/versions/:latest without their file listing (excludeFiles) unless one of their rows
+is on a terms-of-use or variables sheet, which needs the tabular files. Servers that
+do not know the parameter simply send the files as before.
+"""
+fetch_files_when_needed = True                          # Leave file listings out of fetches that do not need them
 
 
 # ============================================================================
-# CORE FUNCTIONS
+# LOGGING
 # ============================================================================
 
+# One logger per part of the script, so each can be turned up or down on its own
+logger = logging.getLogger('universal_field_editor')
+http_logger = logger.getChild('http')
+lock_logger = logger.getChild('locks')
+edit_logger = logger.getChild('edits')
+terms_logger = logger.getChild('terms')
+event_logger = logger.getChild('events')
+event_logger.propagate = False
 
-def check_lock(dataset_id, lock_status):
+_logging_configured = False
+
+
+class Lazy:
+    """
+    Defer an expensive log argument (a full record, a JSON dump, ...) until the
+    message is actually emitted, e.g. logger.debug('%s', Lazy(json.dumps, record)).
     """
-    Check if a dataset is locked and wait for lock to be released.
 
-    Dataset locks can occur during various operations like file ingestion or
-    publishing. This function polls the lock status until the dataset is unlocked.
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class JsonlEventHandler(logging.Handler):
+    """Write each event as one JSON object per line."""
+
+    def __init__(self, path):
+        super().__init__()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def emit(self, record):
+        try:
+            event = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                     'event': record.getMessage()}
+            event.update(getattr(record, 'fields', {}))
+            self._file.write(json.dumps(event, default=str) + '\n')
+            self._file.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def configure_logging():
+    """
+    Attach the console, file and event handlers described by the logging settings.
+    Safe to call more than once; only the first call has an effect.
+    """
+    global _logging_configured
+
+    if _logging_configured:
+        return
+    _logging_configured = True
+
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_file is not None:
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    logger.setLevel(log_level)
+
+    if event_log_path is not None:
+        event_logger.addHandler(JsonlEventHandler(event_log_path))
+        event_logger.setLevel(logging.INFO)
+
+
+def log_event(event, **fields):
+    """
+    Record a structured event in the JSONL event log (a no-op when it is off).
 
     Args:
-        dataset_id (str): The ID of the dataset to check
+        event (str): Event name, e.g. 'dataset', 'publish' or 'request'
+        **fields: JSON-serializable details of the event
+    """
+    if event == 'dataset':
+        run_metrics.count_dataset(fields.get('outcome'))
+    elif event == 'publish':
+        run_metrics.count_publish(fields.get('outcome'))
+    if event_logger.handlers:
+        event_logger.info(event, extra={'fields': fields})
+
+
+
+# ============================================================================
+# RUN METRICS
+# ============================================================================
+
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket is +Inf
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+_EXHAUSTED = object()
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram with count, sum and max."""
+
+    __slots__ = ('buckets', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of observations."""
+        rank = fraction * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                return HISTOGRAM_BUCKETS[index] if index < len(HISTOGRAM_BUCKETS) else self.max
+        return None
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+            'max': round(self.max, 6),
+            'p50': self.quantile(0.50),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': {str(bound): n for bound, n in zip(HISTOGRAM_BUCKETS + ('+Inf',), self.buckets)},
+        }
+
+
+class RunMetrics:
+    """
+    Phase timings, request counts and dataset outcomes for one run.
+
+    Phases are timed with `timer` (or `observe` for durations measured elsewhere),
+    requests are recorded by dataverse_request, and dataset outcomes by log_event.
+    Safe to share between worker threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start a new run."""
+        with self._lock:
+            self.started = time.time()
+            self.phases = {}                                                    # phase -> LatencyHistogram
+            self.request_latency = {}                                           # (method, endpoint) -> LatencyHistogram
+            self.requests = Counter()                                           # (method, endpoint, status) -> requests
+            self.datasets = Counter()                                           # outcome -> datasets
+            self.published = Counter()                                          # outcome -> datasets (publish stage)
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, phase):
+        """Time the enclosed block as one observation of `phase`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def timed_iter(self, iterable, phase):
+        """Yield from iterable, timing how long each item takes to produce."""
+        iterator = iter(iterable)
+        while True:
+            with self.timer(phase):
+                item = next(iterator, _EXHAUSTED)
+            if item is _EXHAUSTED:
+                return
+            yield item
+
+    def count_request(self, method, endpoint, status, seconds):
+        with self._lock:
+            self.requests[(method, endpoint, status)] += 1
+            histogram = self.request_latency.get((method, endpoint))
+            if histogram is None:
+                histogram = self.request_latency[(method, endpoint)] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def count_dataset(self, outcome):
+        with self._lock:
+            self.datasets[outcome] += 1
+
+    def count_publish(self, outcome):
+        with self._lock:
+            self.published[outcome] += 1
+
+    def report(self):
+        """
+        Summary of the run so far.
+
+        Returns:
+            dict: JSON-serializable run report
+        """
+        with self._lock:
+            finished = time.time()
+            return {
+                'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                'finished': datetime.fromtimestamp(finished).isoformat(timespec='seconds'),
+                'seconds': round(finished - self.started, 3),
+                'run_mode': run_mode,
+                'max_workers': max_workers,
+                'datasets': dict(self.datasets),
+                'published': dict(self.published),
+                'phases': {phase: histogram.summary() for phase, histogram in sorted(self.phases.items())},
+                'requests': [{'method': method, 'endpoint': endpoint, 'status': status, 'count': n}
+                             for (method, endpoint, status), n in sorted(self.requests.items(), key=str)],
+                'request_latency': {f'{method} {endpoint}': histogram.summary()
+                                    for (method, endpoint), histogram in sorted(self.request_latency.items())},
+            }
+
+    def prometheus_text(self):
+        """The run's metrics in the Prometheus text exposition format."""
+        report = self.report()
+        lines = [
+            '# HELP field_editor_run_seconds Duration of the last run.',
+            '# TYPE field_editor_run_seconds gauge',
+            f"field_editor_run_seconds {report['seconds']}",
+            '# HELP field_editor_run_finished_timestamp_seconds When the last run finished.',
+            '# TYPE field_editor_run_finished_timestamp_seconds gauge',
+            f'field_editor_run_finished_timestamp_seconds {time.time():.3f}',
+            '# HELP field_editor_datasets_total Datasets processed, by outcome.',
+            '# TYPE field_editor_datasets_total counter',
+        ]
+        lines += [f'field_editor_datasets_total{{outcome="{outcome}"}} {n}' for outcome, n in sorted(report['datasets'].items(), key=str)]
+        lines += ['# HELP field_editor_publish_total Datasets through the publish stage, by outcome.',
+                  '# TYPE field_editor_publish_total counter']
+        lines += [f'field_editor_publish_total{{outcome="{outcome}"}} {n}' for outcome, n in sorted(report['published'].items(), key=str)]
+        lines += ['# HELP field_editor_requests_total Dataverse requests, by endpoint and status.',
+                  '# TYPE field_editor_requests_total counter']
+        lines += [f'field_editor_requests_total{{method="{r["method"]}",endpoint="{r["endpoint"]}",status="{r["status"]}"}} {r["count"]}'
+                  for r in report['requests']]
+
+        with self._lock:
+            histograms = [('field_editor_phase_seconds', 'Time spent per phase.',
+                           [(f'phase="{phase}"', h) for phase, h in sorted(self.phases.items())]),
+                          ('field_editor_request_seconds', 'Dataverse request latency, by endpoint.',
+                           [(f'method="{method}",endpoint="{endpoint}"', h)
+                            for (method, endpoint), h in sorted(self.request_latency.items())])]
+            for name, help_text, series in histograms:
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for labels, histogram in series:
+                    cumulative = 0
+                    for bound, n in zip(HISTOGRAM_BUCKETS + ('+Inf',), histogram.buckets):
+                        cumulative += n
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{labels}}} {histogram.sum:.6f}')
+                    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+run_metrics = RunMetrics()
+
+
+def endpoint_name(url):
+    """
+    Group a request URL by endpoint: drop the host and query string and replace
+    numeric ids, e.g. '/api/datasets/{id}/locks'.
+    """
+    path = url.split('?', 1)[0]
+    if path.startswith(url_base_origin):
+        path = path[len(url_base_origin):]
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+
+def write_run_report():
+    """Write the run report and Prometheus textfile, if configured, and log a summary."""
+    report = run_metrics.report()
+    logger.info("Run finished in %.1f sec: %s", report['seconds'],
+                ', '.join(f'{n} {outcome}' for outcome, n in sorted(report['datasets'].items(), key=str)) or 'no datasets')
+
+    if run_report_path is not None:
+        with open(run_report_path, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    if prometheus_textfile_path is not None:
+        # Written to a temporary file first so the collector never reads half a file
+        temporary_path = prometheus_textfile_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as textfile:
+            textfile.write(run_metrics.prometheus_text())
+        os.replace(temporary_path, prometheus_textfile_path)
+
+
+
+# ============================================================================
+# HTTP CLIENT
+# ============================================================================
+
+_http_session = None
+_http_session_lock = threading.Lock()
+_rate_limiter = None
+_error_budget = None
+_pydataverse_clients = {}                                                       # (client class name, DataverseConfig) -> client
+
+OVERLOAD_STATUS_CODES = (429, 503)
+RETRYABLE_STATUS_CODES = (500, 502, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+
+# Where and as whom to connect; clients and the session are built from one of these
+DataverseConfig = namedtuple('DataverseConfig', ['base_url', 'api_token'])
+
+
+def dataverse_config():
+    """The connection settings as they are now (url_base_origin, api_token_origin)."""
+    return DataverseConfig(url_base_origin, api_token_origin)
+
+
+def max_concurrent_requests():
+    """Most requests the script can have in flight: one per worker, or per tabular file sync."""
+    return max(1, max_workers, tab_file_workers)
+
+
+def get_pydataverse_client(class_name, config=None):
+    """
+    Return a pyDataverse API client, importing pyDataverse and creating the client
+    the first time it is asked for with this config.
+
+    Args:
+        class_name (str): 'NativeApi' or 'DataAccessApi'
+        config (DataverseConfig): Server and token (default: dataverse_config())
 
     Returns:
-        bool: True if dataset is unlocked, False if an error occurred
+        The shared pyDataverse client
+    """
+    config = config or dataverse_config()
+    key = (class_name, config)
+    client = _pydataverse_clients.get(key)
+    if client is None:
+        with _http_session_lock:
+            client = _pydataverse_clients.get(key)
+            if client is None:
+                import pyDataverse.api
+                client = getattr(pyDataverse.api, class_name)(config.base_url, config.api_token)
+                _pydataverse_clients[key] = client
+    return client
 
-    Note:
-        Documentation on dataset locks:
-        https://guides.dataverse.org/en/latest/api/native-api.html#dataset-locks
+
+def get_native_api(config=None):
+    """pyDataverse NativeApi client, created on first use (see get_pydataverse_client)."""
+    return get_pydataverse_client('NativeApi', config)
+
+
+def get_data_access_api(config=None):
+    """pyDataverse DataAccessApi client, created on first use (see get_pydataverse_client)."""
+    return get_pydataverse_client('DataAccessApi', config)
+
+
+def __getattr__(name):
+    # The clients and token header used to be built at import time under these names
+    if name == 'api_origin':
+        return get_native_api()
+    if name == 'data_api_origin':
+        return get_data_access_api()
+    if name == 'headers_origin':
+        return {'X-Dataverse-key': api_token_origin}
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+
+def get_http_session():
     """
-    time_start = datetime.now()
-    print("Start check_lock")
+    Return the shared requests session used for every Dataverse call.
 
-    try:
-        url = f"{url_base_origin}/api/datasets/{dataset_id}/locks"
-        lock = requests.get(url, headers=headers_origin)
+    The session is created on first use with a connection pool sized to the
+    worker count, and carries the API token header on every request.
 
-        if lock.status_code == 503:
-            print("503 - Server is unavailable")
-            sys.exit()
+    Returns:
+        requests.Session: The shared keep-alive session
+    """
+    global _http_session
 
-        if lock_status != 0:
-            attempt_count = 0
-            while len(lock.json()['data']) > 0:
-                print(f"Lock {attempt_count} times {dataset_id} {lock.json()}")
-                print(lock.json())
-                time.sleep(10)
-                attempt_count += 1
-                lock = requests.get(url, headers=headers_origin)
-                
-                if lock.status_code == 503:
-                    print("503 - Server is unavailable")
-                    sys.exit()
-                if lock.status_code != 200:
-                    print(f"check_lock func: lock status {lock.status_code} for {dataset_id}")
-                    return False
-        else:
-            if len(lock.json()['data']) > 0:
-                print(f"check_lock func: lock status {lock.status_code} for {dataset_id}")
-                return False
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                maxsize = pool_maxsize or max_concurrent_requests()
+                adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=maxsize)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({'X-Dataverse-key': dataverse_config().api_token})
+                _http_session = session
 
-    except Exception as e:
-        print(f"check_lock Error: {str(e)}, dataset {dataset_id}")
-        return False
+    return _http_session
 
-    time_end = datetime.now()
-    elapsed_time = (time_end - time_start).total_seconds()
-    print(f"Dataset {dataset_id} was locked {elapsed_time} sec")
 
-    return True
+class AdaptiveRateLimiter:
+    """
+    Token bucket plus AIMD concurrency limit shared by every Dataverse call.
 
+    acquire() blocks until a token is available, fewer than `limit` requests are
+    in flight and no overload pause is running. release() reports the outcome: an
+    overload (429/503) starts a pause and halves both the rate and the limit, once
+    per pause; every other answer from the server raises the rate by about one
+    request per second, and the limit by one, per window of successful requests.
 
+    Args:
+        max_rate (float): Ceiling on requests per second
+        burst (int): Bucket size, i.e. requests that may be sent back to back
+        max_concurrency (int): Ceiling on requests in flight
+        min_rate (float): Floor on requests per second
+    """
 
-def var_update_dataset(dataset_id, datafile_id, xml):
-    print("Start var_update_dataset")
-    print(xml)
-    url = f'{url_base_origin}/api/edit/{str(datafile_id)}'                      # curl -H "X-Dataverse-key:xxxxxxxxxx" -X PUT 
+    def __init__(self, max_rate, burst, max_concurrency, min_rate):
+        self.max_rate = float(max_rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.max_concurrency = max(1, max_concurrency)
+        self.burst = max(1, burst)
+        self.rate = self.max_rate
+        self.limit = float(self.max_concurrency)
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def acquire(self):
+        """Wait until a request may be sent."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._in_flight >= int(self.limit):
+                    wait = None                                                 # Until a request is released
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+
+                self._cond.wait(wait)
+
+    def release(self, status_code, retry_after=None):
+        """
+        Report the outcome of a request sent after acquire().
+
+        Args:
+            status_code (int): Response status, or None if no response was received
+            retry_after (float): Seconds the server asked to wait, if it said
+        """
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+
+            if status_code in OVERLOAD_STATUS_CODES:
+                pause = overload_pause if retry_after is None else retry_after
+                if now >= self._paused_until:                                   # Requests already in flight do not cut again
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    self.limit = max(1.0, self.limit / 2)
+                    self._tokens = 0.0
+                self._paused_until = max(self._paused_until, now + pause)
+            elif status_code is not None:
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+            self._cond.notify_all()
+
+
+
+def get_rate_limiter():
+    """
+    Return the limiter shared by every Dataverse call, creating it on first use.
+
+    Returns:
+        AdaptiveRateLimiter: The shared limiter
+    """
+    global _rate_limiter
+
+    if _rate_limiter is None:
+        with _http_session_lock:
+            if _rate_limiter is None:
+                _rate_limiter = AdaptiveRateLimiter(requests_per_second, request_burst,
+                                                    max_concurrent_requests(), min_requests_per_second)
+
+    return _rate_limiter
+
+
+
+class ErrorBudgetExhausted(RuntimeError):
+    """Raised for every request once the run has used up its error budget."""
+
+
+
+class ErrorBudget:
+    """
+    Count of requests that failed for good (after their retries) in this run.
+
+    Once `limit` failures are recorded the budget is exhausted: no further requests
+    are sent, and the datasets still to do are reported instead of each timing out.
+
+    Args:
+        limit (int): Failures tolerated, or None for no limit
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    @property
+    def exhausted(self):
+        return self.limit is not None and self.failures >= self.limit
+
+    def record(self, method, url, reason):
+        """Record a failed request."""
+        with self._lock:
+            self.failures += 1
+            http_logger.warning("%s %s failed: %s (%d failed request(s) so far)", method, url, reason, self.failures)
+            if self.failures == self.limit:
+                http_logger.error("Error budget of %d failed requests used up - stopping the run", self.limit)
+
+    def check(self):
+        """Raise ErrorBudgetExhausted if no more requests may be sent."""
+        if self.exhausted:
+            raise ErrorBudgetExhausted(f"{self.failures} requests failed, error budget is {self.limit}")
+
+
+
+def get_error_budget():
+    """
+    Return the error budget of the current run, creating it on first use.
+
+    Returns:
+        ErrorBudget: The shared error budget
+    """
+    global _error_budget
+
+    if _error_budget is None:
+        with _http_session_lock:
+            if _error_budget is None:
+                _error_budget = ErrorBudget(request_error_budget)
+
+    return _error_budget
+
+
+
+def retry_delay(attempt):
+    """
+    Delay before retrying a failed request: exponential backoff capped at
+    request_retry_max, with full jitter so workers do not retry in lockstep.
+
+    Args:
+        attempt (int): Number of retries already made for this request
+
+    Returns:
+        float: Seconds to wait
+    """
+    return random.uniform(0, min(request_retry_max, request_retry_initial * (2 ** attempt)))
+
+
+
+def parse_retry_after(value):
+    """
+    Read a Retry-After header, given either in seconds or as an HTTP date.
+
+    Args:
+        value (str): Header value, or None
 
+    Returns:
+        float or None: Seconds to wait, or None if the header is missing or unreadable
+    """
+    if value is None:
+        return None
     try:
-        resp = requests.put(url, headers=headers_origin, data=xml)              # Fetch request information, assign to the variable 'resp'
-        if resp.status_code != 200:                                             # If access is unsuccessful
-            print(resp.json())                                                  # Print failure information
-            return False                                                        # Return False
-        else:                                                                   # If access is successful
-            print("Updated")                                                    # Print status
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
 
-    except Exception as e:                                                      # In the event of an exception (not sure when this actually happens)
-        print(f"var_update_dataset: {str(e)} {url}")                            # print url related to the exception
-        return False                                                            # Return False
 
-    return True  
 
+def dataverse_request(method, url, **kwargs):
+    """
+    Send a request to the Dataverse instance through the shared session.
 
+    Every request has a connect and read timeout (request_timeout) and is paced
+    by the shared AdaptiveRateLimiter. A 429 or 503 answer slows every caller down
+    and the request is sent again, up to overload_max_retries times. Idempotent
+    requests (GET, PUT, ...) that time out, lose their connection or get a 500,
+    502 or 504 are retried up to request_max_retries times with exponential backoff.
+    A request that still fails counts against the run's error budget.
 
+    Args:
+        method (str): HTTP method ('GET', 'PUT', 'POST', ...)
+        url (str): Full request URL
+        **kwargs: Passed through to requests (data, params, headers, ...)
 
-def update_terms_of_use(complete_record, latest_version, row, doi, header):
-    
-    primitive_dictionary = {}
-    primitive_dictionary['typeName'] = 'datasetContactEmail'
-    primitive_dictionary['multiple'] = False
-    primitive_dictionary['typeClass'] = "primitive"
-    primitive_dictionary['value'] = row["Point of Contact Email (MANDATORY)"]
-    
-    main_block = latest_version
-    fields = main_block['metadataBlocks']['citation']['fields']
-    new_fields_val = []
-    for dictionary in fields:
-        if dictionary['typeName'] == 'datasetContact':
-            current_val = dictionary['value'][0]
-            new_contact_val = current_val
-            new_contact_val['datasetContactEmail'] = primitive_dictionary
-        else:
-            new_fields_val.append(dictionary)
+    Returns:
+        requests.Response: The server response
+
+    Raises:
+        requests.RequestException: If the request still fails after its retries
+        ErrorBudgetExhausted: If the run has used up its error budget
+    """
+    kwargs.setdefault('timeout', request_timeout)
+    limiter = get_rate_limiter()
+    budget = get_error_budget()
+    overloads = 0
+    failures = 0
+
+    while True:
+        budget.check()
+        limiter.acquire()
+        resp = None
+        error = None
+        retry_after = None
+        start = time.perf_counter()
+        try:
+            resp = get_http_session().request(method, url, **kwargs)
+            if resp.status_code in OVERLOAD_STATUS_CODES:
+                retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+        except requests.RequestException as e:                                 # Timeouts and connection errors
+            error = e
+        finally:
+            limiter.release(resp.status_code if resp is not None else None, retry_after)
+            run_metrics.count_request(method, endpoint_name(url), resp.status_code if resp is not None else 'error',
+                                      time.perf_counter() - start)
+
+        status_code = resp.status_code if resp is not None else None
+
+        if status_code in OVERLOAD_STATUS_CODES and overloads < overload_max_retries:
+            resp.close()                                                        # Release the connection of a streamed response
+            overloads += 1
+            http_logger.warning("%s %s: server overloaded (%s), slowing down to %.2f requests/s",
+                                method, url, status_code, limiter.rate)
+            log_event('overloaded', method=method, url=url, status=status_code, retry_after=retry_after,
+                      rate=round(limiter.rate, 3), limit=int(limiter.limit))
             continue
-    
-    print('%%%%%%%%%%%%%%%%%%%%%%%%%%%%')
-    print(main_block)
-    print(row)
-    print('%%%%%%%%%%%%%%%%%%%%%%%%%%%%')
 
-    field_overwrite = {}
-    count = 0
-    for field in header:
-        if field == "doi":
+        failed = error is not None or status_code >= 500
+        if failed and method in IDEMPOTENT_METHODS and failures < request_max_retries \
+                and status_code not in OVERLOAD_STATUS_CODES:
+            if resp is not None:
+                resp.close()
+            delay = retry_delay(failures)
+            failures += 1
+            http_logger.warning("%s %s failed (%s), retry %d of %d in %.1f sec",
+                                method, url, error or status_code, failures, request_max_retries, delay)
+            log_event('retry', method=method, url=url, status=status_code, error=error and str(error), attempt=failures)
+            time.sleep(delay)
             continue
-        elif field == "terms":
-            continue 
-        else:
-            if row[field] == '':
-                continue
-            else:
-                field_overwrite[field] = row[field]
-    
-    for k, v in field_overwrite.items():
-        if k in main_block:
-            print("UPDATING EXISTING RECORD")
-            print(f"CURRENT VALUE: {main_block[k]}")
-            
-            if v == "REMOVE":
-                print(f'VALUE TO REMOVE: {main_block[k]}')
-                del main_block[k]
-                print('ENTRY DELETED -- PROCEEDING')
-                print()
-                continue
-            else:
-                if main_block[k] == v:
-                    print('SAME VALUE -- NO NEED TO UPDATE RECORD')
-                    print()
-                    continue
-                else:
-                    if v == "REMOVE":
-                        print('SKIPPING SINCE V == REMOVE')
-                        print()
-                        continue
-                    else:
-                        print(f'NEW VALUE: {v}')
+
+        if failed:
+            budget.record(method, url, error or status_code)
+            log_event('request_failed', method=method, url=url, status=status_code, error=error and str(error))
+        if error is not None:
+            raise error
+        return resp
+
+
+def dataverse_get(url, **kwargs):
+    return dataverse_request('GET', url, **kwargs)
+
+
+def dataverse_put(url, **kwargs):
+    return dataverse_request('PUT', url, **kwargs)
+
+
+def dataverse_post(url, **kwargs):
+    return dataverse_request('POST', url, **kwargs)
+
+
+# ============================================================================
+# DATASET CACHE
+# ============================================================================
+
+
+class CachedResponse:
+    """
+    Stand-in for requests.Response when a dataset record is served from the cache
+    (or was reshaped from a version response, see dataset_record_from_version).
+    A record that was already parsed is handed out by the first json() call instead
+    of being parsed again.
+    """
+
+    status_code = 200
+
+    def __init__(self, text, record=None):
+        self.text = text
+        self._record = record
+
+    def json(self):
+        record, self._record = self._record, None
+        if record is not None:
+            return record
+        return json.loads(self.text)                                            # Fresh copy: callers edit the record in place
+
+
+class DatasetCache:
+    """
+    On-disk cache of dataset records keyed by DOI.
+
+    Each record is stored as its own JSON file; a small index keeps, per DOI, the
+    database id, the dataset's /timestamps lastUpdateTime read before the record was
+    downloaded (used to revalidate), the version number, whether the record lists
+    the dataset's files, and the file size. Entries are evicted least recently used
+    first once there are more than `max_entries` of them or they take more than
+    `max_bytes` on disk.
+
+    Args:
+        directory (str): Folder holding the cached records
+        max_entries (int): Maximum number of records kept
+        max_bytes (int): Maximum total size of the records on disk
+    """
+
+    def __init__(self, directory, max_entries, max_bytes):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(directory, 'index.json')
+        self._dirty = False
+
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self._index_path, encoding='utf-8') as index_file:
+                self._index = OrderedDict(json.load(index_file))
+        except (OSError, ValueError):
+            self._index = OrderedDict()                                         # doi -> entry, least recently used first
+        self._total_bytes = sum(entry['size'] for entry in self._index.values())
+
+    def _record_path(self, doi):
+        return os.path.join(self.directory, hashlib.sha1(doi.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, doi):
+        """Return (text, entry) for a cached record, or None."""
+        with self._lock:
+            entry = self._index.get(doi)
+            if entry is None:
+                return None
+            try:
+                with open(self._record_path(doi), encoding='utf-8') as record_file:
+                    text = record_file.read()
+            except OSError:
+                self._forget(doi)
+                return None
+            self._index.move_to_end(doi)
+            self._dirty = True
+            return text, entry
+
+    def put(self, doi, text, record=None, files=True, last_update_time=None):
+        """
+        Store the raw JSON text of a dataset record.
+
+        Args:
+            doi (str): Dataset DOI
+            text (str): The record as downloaded
+            record (dict): The same record already parsed, if the caller has it
+            files (bool): False if the record was fetched without its file listing
+            last_update_time (str): The /timestamps lastUpdateTime read before the
+                download (None = the record is never reused without downloading it again)
+        """
+        data = (record if record is not None else json.loads(text))['data']
+        version = data.get('latestVersion', {})
+        entry = {
+            'id': data.get('id'),
+            'lastUpdateTime': last_update_time,
+            'version': f"{version.get('versionNumber')}.{version.get('versionMinorNumber')}",
+            'versionState': version.get('versionState'),
+            'files': files,
+            'size': len(text.encode('utf-8'))
+        }
+
+        with self._lock:
+            with open(self._record_path(doi), 'w', encoding='utf-8') as record_file:
+                record_file.write(text)
+            if doi in self._index:
+                self._total_bytes -= self._index[doi]['size']
+            self._index[doi] = entry
+            self._index.move_to_end(doi)
+            self._total_bytes += entry['size']
+            self._dirty = True
+
+            while len(self._index) > 1 and (len(self._index) > self.max_entries or self._total_bytes > self.max_bytes):
+                self._forget(next(iter(self._index)))
+
+    def dataset_id(self, doi):
+        """Database id of a cached DOI, or None."""
+        with self._lock:
+            entry = self._index.get(doi)
+            return entry['id'] if entry is not None else None
+
+    def invalidate(self, doi):
+        """Mark a record as stale, e.g. after it was edited. Its DOI -> id mapping is kept."""
+        with self._lock:
+            if doi in self._index:
+                self._index[doi]['lastUpdateTime'] = None
+                self._dirty = True
+
+    def _forget(self, doi):
+        entry = self._index.pop(doi)
+        self._total_bytes -= entry['size']
+        self._dirty = True
+        try:
+            os.remove(self._record_path(doi))
+        except OSError:
+            pass
+
+    def save(self):
+        """Write the index to disk if it changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            temp_path = self._index_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as index_file:
+                json.dump(self._index, index_file)
+            os.replace(temp_path, self._index_path)
+            self._dirty = False
+
+
+
+_dataset_cache = None
+_dataset_cache_lock = threading.Lock()
+
+
+def get_dataset_cache():
+    """
+    Return the shared DatasetCache, or None when dataset_cache_dir is not set.
+    """
+    global _dataset_cache
+
+    if dataset_cache_dir is None:
+        return None
+    if _dataset_cache is None:
+        with _dataset_cache_lock:
+            if _dataset_cache is None:
+                _dataset_cache = DatasetCache(dataset_cache_dir, dataset_cache_max_entries, dataset_cache_max_bytes)
+    return _dataset_cache
+
+
+
+# ============================================================================
+# CORE FUNCTIONS
+# ============================================================================
+
+
+def get_dataset(doi, include_files=True):
+    """
+    Fetch the JSON representation of a dataset through the shared HTTP session.
+
+    If the dataset cache is enabled, a cached record is reused when the dataset's
+    /timestamps lastUpdateTime still matches the one read when it was cached (or
+    without asking the server when dataset_cache_offline is set in 'plan' mode);
+    otherwise the record is downloaded and cached along with that timestamp.
+
+    Args:
+        doi (str): Dataset DOI (doi:... format)
+        include_files (bool): Whether the record must list the dataset's files; when
+            False (and fetch_files_when_needed is set) only the latest version is
+            fetched, without its files, and returned in the same shape
+
+    Returns:
+        requests.Response or CachedResponse: Response whose json()['data'] holds the dataset record
+    """
+    cache = get_dataset_cache()
+
+    last_update_time = None
+
+    if cache is not None:
+        cached = cache.get(doi)
+        usable = (cached is not None and cached[1]['lastUpdateTime'] is not None
+                  and (cached[1].get('files', True) or not include_files))
+        if usable and dataset_cache_offline and run_mode == 'plan':
+            return CachedResponse(cached[0])
+
+        # Read before the download, so a change made while downloading is caught next time
+        last_update_time = fetch_last_update_time(doi)
+        if usable and last_update_time is not None and cached[1]['lastUpdateTime'] == last_update_time:
+            return CachedResponse(cached[0])
+
+    url = f'{url_base_origin}/api/datasets/:persistentId/'
+    params = {'persistentId': doi}
+    exclude_files = fetch_files_when_needed and not include_files
+    if exclude_files:
+        # The dataset endpoint always lists the files; only the version endpoint can leave them out
+        url = f'{url_base_origin}/api/datasets/:persistentId/versions/:latest'
+        params['excludeFiles'] = 'true'
+    resp = dataverse_get(url, params=params)
+
+    if resp.status_code != 200 or (cache is None and not exclude_files):
+        return resp
+
+    # Parsed once, for the cache index and for the caller
+    record, text = resp.json(), resp.text
+    if exclude_files:
+        record = dataset_record_from_version(record)
+        text = json.dumps(record)
+    if cache is not None:
+        # A server that ignored excludeFiles sent the files anyway
+        files = not exclude_files or 'files' in record['data']['latestVersion']
+        cache.put(doi, text, record, files=files, last_update_time=last_update_time)
+    return CachedResponse(text, record)
+
+
+
+def dataset_record_from_version(version_response):
+    """
+    Reshape a /versions/:latest response into the dataset record get_dataset returns,
+    so callers find data.id and data.latestVersion whichever endpoint was used.
+
+    Args:
+        version_response (dict): Parsed /api/datasets/:persistentId/versions/:latest response
+
+    Returns:
+        dict: {'status', 'data': {'id', 'persistentId', 'latestVersion'}}
+    """
+    version = version_response['data']
+    return {'status': version_response.get('status'),
+            'data': {'id': version.get('datasetId'), 'persistentId': version.get('datasetPersistentId'),
+                     'latestVersion': version}}
+
+
+
+def edits_need_files(edits):
+    """Whether any edit is on a terms-of-use or variables sheet, which need the dataset's file listing."""
+    return any(plan.is_terms or plan.block_name == 'variables' for _, plan, _ in edits)
+
+
+
+def fetch_last_update_time(doi):
+    """
+    Ask the server when a dataset was last updated, without downloading its metadata.
+
+    Args:
+        doi (str): Dataset DOI
+
+    Returns:
+        str or None: The lastUpdateTime timestamp, or None if it could not be read
+    """
+    url = f'{url_base_origin}/api/datasets/:persistentId/timestamps'
+
+    try:
+        resp = dataverse_get(url, params={'persistentId': doi})
+    except Exception as e:
+        http_logger.warning("fetch_last_update_time error for %s: %s", doi, e)
+        return None
+
+    if resp.status_code != 200:
+        return None
+    return resp.json()['data'].get('lastUpdateTime')
+
+
+
+def fetch_version_update_time(doi):
+    """
+    Read the lastUpdateTime of a dataset's latest version, without its file listing.
+
+    This is the timestamp stored in a change plan. It is not comparable with the
+    /timestamps lastUpdateTime, which is the dataset's modification time in another
+    format.
+
+    Args:
+        doi (str): Dataset DOI
+
+    Returns:
+        str or None: The version's lastUpdateTime, or None if it could not be read
+    """
+    url = f'{url_base_origin}/api/datasets/:persistentId/versions/:latest'
+
+    try:
+        resp = dataverse_get(url, params={'persistentId': doi, 'excludeFiles': 'true'})
+    except Exception as e:
+        http_logger.warning("fetch_version_update_time error for %s: %s", doi, e)
+        return None
+
+    if resp.status_code != 200:
+        return None
+    return resp.json()['data'].get('lastUpdateTime')
+
+
+
+def check_lock(dataset_id, lock_status):
+    """
+    Check if a dataset is locked and wait for lock to be released.
+
+    Dataset locks can occur during various operations like file ingestion or
+    publishing. This function polls the lock status until the dataset is unlocked.
+
+    Args:
+        dataset_id (str): The ID of the dataset to check
+
+    Returns:
+        bool: True if dataset is unlocked, False if an error occurred
+
+    Note:
+        Documentation on dataset locks:
+        https://guides.dataverse.org/en/latest/api/native-api.html#dataset-locks
+    """
+    time_start = datetime.now()
+    lock_logger.debug("check_lock %s", dataset_id)
+
+    try:
+        url = f"{url_base_origin}/api/datasets/{dataset_id}/locks"
+        lock = dataverse_get(url)
+
+        if lock_status != 0:
+            # An unavailable server is waited out like a lock instead of ending the run
+            attempt_count = 0
+            while lock.status_code == 503 or len(lock.json()['data']) > 0:
+                if lock.status_code == 503:
+                    lock_logger.warning("503 - Server is unavailable, checking %s again (attempt %d)", dataset_id, attempt_count)
+                else:
+                    lock_logger.info("Dataset %s locked (attempt %d): %s", dataset_id, attempt_count, Lazy(lock.json))
+                time.sleep(lock_backoff_delay(attempt_count))
+                attempt_count += 1
+                lock = dataverse_get(url)
+                
+                if lock.status_code not in (200, 503):
+                    lock_logger.warning("check_lock: lock status %s for %s", lock.status_code, dataset_id)
+                    return False
+        else:
+            # Reported as locked, so the dataset is parked and checked again later
+            if lock.status_code == 503:
+                lock_logger.warning("503 - Server is unavailable, %s will be checked again", dataset_id)
+                return False
+            if len(lock.json()['data']) > 0:
+                lock_logger.debug("Dataset %s is locked: %s", dataset_id, Lazy(lock.json))
+                return False
+
+    except ErrorBudgetExhausted:
+        raise
+    except Exception as e:
+        lock_logger.warning("check_lock error for %s: %s", dataset_id, e)
+        return False
+
+    time_end = datetime.now()
+    elapsed_time = (time_end - time_start).total_seconds()
+    lock_logger.debug("Dataset %s was locked %s sec", dataset_id, elapsed_time)
+
+    return True
+
+
+
+def lock_backoff_delay(attempt):
+    """
+    Delay before the next lock poll: exponential backoff capped at lock_poll_max,
+    with part of the delay randomized so parked datasets do not poll in lockstep.
+
+    Args:
+        attempt (int): Number of polls already made for this dataset
+
+    Returns:
+        float: Seconds to wait
+    """
+    delay = min(lock_poll_max, lock_poll_initial * (2 ** attempt))
+    return delay * (1 - lock_poll_jitter * random.random())
+
+
+
+def fetch_lock_state(dataset_id):
+    """
+    Poll the lock status of a dataset once, without waiting.
+
+    Args:
+        dataset_id (str): The ID of the dataset to check
+
+    Returns:
+        bool or None: True if locked (or the server is temporarily unavailable),
+        False if unlocked, None if the locks could not be read
+    """
+    url = f"{url_base_origin}/api/datasets/{dataset_id}/locks"
+
+    try:
+        lock = dataverse_get(url)
+    except ErrorBudgetExhausted:
+        return None
+    except Exception as e:
+        lock_logger.warning("fetch_lock_state error for %s: %s", dataset_id, e)
+        return True
+
+    if lock.status_code == 503:
+        return True
+    if lock.status_code != 200:
+        lock_logger.warning("fetch_lock_state: lock status %s for %s", lock.status_code, dataset_id)
+        return None
+
+    return len(lock.json()['data']) > 0
+
+
+
+class LockScheduler:
+    """
+    Timed queue for datasets that were locked when a worker reached them.
+
+    Parked datasets are re-polled from a single background thread with exponential
+    backoff and jitter (see lock_backoff_delay). As soon as a dataset unlocks, its
+    parked work is handed back to the DatasetWorkPool in the order it was parked.
+    Datasets still locked after `deadline` seconds are dropped and listed in `expired`;
+    datasets whose lock status cannot be read are dropped and listed in `unreadable`.
+
+    Args:
+        pool (DatasetWorkPool): Pool that receives work for unlocked datasets
+        deadline (float): Seconds to wait for a single dataset before giving up
+    """
+
+    def __init__(self, pool, deadline):
+        self._pool = pool
+        self._deadline = deadline
+        self._lock = threading.Condition()
+        self._heap = []                                                         # (next poll time, sequence, doi)
+        self._parked = {}                                                       # doi -> parked entry
+        self._sequence = itertools.count()
+        self._thread = None
+        self._closed = False
+        self.expired = []
+        self.unreadable = []
+
+    def park(self, doi, dataset_id, func, *args):
+        """Park func(*args) until the dataset unlocks."""
+        with self._lock:
+            entry = self._parked.get(doi)
+            if entry is None:
+                now = time.monotonic()
+                entry = {'dataset_id': dataset_id, 'tasks': [], 'attempt': 0, 'since': now}
+                self._parked[doi] = entry
+                heapq.heappush(self._heap, (now + lock_backoff_delay(0), next(self._sequence), doi))
+                self._start()
+                self._lock.notify_all()
+            entry['tasks'].append((func, args))
+
+    def park_behind(self, doi, func, *args):
+        """
+        Park func(*args) behind work already waiting on this DOI, so edits to a
+        locked dataset keep their order. Returns False if nothing is parked for it.
+        """
+        with self._lock:
+            if doi not in self._parked:
+                return False
+            self._parked[doi]['tasks'].append((func, args))
+            return True
+
+    def pending(self):
+        """Number of datasets currently parked."""
+        with self._lock:
+            return len(self._parked)
+
+    def is_parked(self, doi):
+        """Whether work for this DOI is waiting on a lock."""
+        with self._lock:
+            return doi in self._parked
+
+    def wait(self):
+        """Block until every parked dataset was handed back or expired."""
+        with self._lock:
+            while len(self._parked) > 0:
+                self._lock.wait()
+
+    def close(self):
+        """Stop the polling thread."""
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='lock-scheduler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._closed and (len(self._heap) == 0 or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if len(self._heap) > 0 else None
+                    self._lock.wait(timeout)
+                if self._closed:
+                    return
+                _, _, doi = heapq.heappop(self._heap)
+                entry = self._parked[doi]
+
+            locked = fetch_lock_state(entry['dataset_id'])
+
+            with self._lock:
+                waited = time.monotonic() - entry['since']
+                if locked == False:
+                    run_metrics.observe('lock_wait', waited)
+                    lock_logger.info("%s unlocked after %.1f sec", doi, waited)
+                    log_event('unlocked', doi=doi, waited=round(waited, 3))
+                    del self._parked[doi]
+                    for func, args in entry['tasks']:
+                        self._pool.resubmit(doi, func, *args)
+                elif locked is None:
+                    lock_logger.error("Lock status unreadable - not updated: %s", doi)
+                    log_event('lock_unreadable', doi=doi, waited=round(waited, 3))
+                    del self._parked[doi]
+                    self.unreadable.append(doi)
+                elif waited >= self._deadline:
+                    run_metrics.observe('lock_wait', waited)
+                    lock_logger.error("Gave up waiting for lock after %.1f sec - not updated: %s", waited, doi)
+                    log_event('lock_expired', doi=doi, waited=round(waited, 3))
+                    del self._parked[doi]
+                    self.expired.append(doi)
+                else:
+                    entry['attempt'] += 1
+                    next_poll = time.monotonic() + lock_backoff_delay(entry['attempt'])
+                    heapq.heappush(self._heap, (next_poll, next(self._sequence), doi))
+                self._lock.notify_all()
+
+
+
+# ============================================================================
+# DDI VARIABLE METADATA
+# ============================================================================
+
+DDI_NAMESPACE = 'ddi:codebook:2_5'
+DDI_CHUNK_SIZE = 64 * 1024                                                      # Bytes read from a DDI stream at a time
+
+
+def local_name(tag):
+    """Tag name without its {namespace}."""
+    return tag.rsplit('}', 1)[-1]
+
+
+
+def iter_ddi_variables(chunks):
+    """
+    Incrementally parse a DDI codebook and yield its <var> elements one at a time.
+
+    Each variable is complete when yielded and is detached from the tree right
+    after, so memory stays bounded however many variables the file has. Callers
+    must not keep references to yielded elements past the next iteration unless
+    they are done with the stream.
+
+    Args:
+        chunks (iterable): Bytes chunks of the DDI XML
+
+    Yields:
+        xml.etree.ElementTree.Element: One <var> element
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    parents = []
+
+    def read_events():
+        for event, elem in parser.read_events():
+            if event == 'start':
+                parents.append(elem)
+                continue
+            parents.pop()
+            if local_name(elem.tag) == 'var':
+                yield elem
+                if len(parents) > 0:
+                    parents[-1].remove(elem)
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from read_events()
+    parser.close()
+    yield from read_events()
+
+
+
+def serialize_variable(var):
+    """
+    Serialize a <var> element without namespace prefixes (no ns0:).
+
+    DDI tags are written unqualified, so inside the codeBook wrapper of
+    ddi_fragment_from_strings (which declares DDI as the default namespace) they
+    stay in the DDI namespace. The element's tags are restored afterwards, and
+    ElementTree's global namespace registry is left alone. (ET.tostring's
+    default_namespace cannot be used: it rejects the unqualified ID and name
+    attributes of every <var>.)
+    """
+    var.tail = None
+    prefix = '{' + DDI_NAMESPACE + '}'
+    elements = [element for element in var.iter() if isinstance(element.tag, str) and element.tag.startswith(prefix)]
+    for element in elements:
+        element.tag = element.tag[len(prefix):]
+    try:
+        return ET.tostring(var)
+    finally:
+        for element in elements:
+            element.tag = prefix + element.tag
+
+
+
+def variable_digest(var):
+    """Digest of a <var> element, used to tell whether a variable changed."""
+    return hashlib.sha1(serialize_variable(var)).digest()
+
+
+
+def ddi_fragment(variables):
+    """
+    Build the XML sent to /api/edit/{id}: a codebook holding only the given variables.
+
+    Args:
+        variables (iterable): <var> elements
+
+    Returns:
+        bytes: DDI XML fragment
+    """
+    return ddi_fragment_from_strings([serialize_variable(var) for var in variables])
+
+
+
+def ddi_fragment_from_strings(serialized):
+    """ddi_fragment for variables that are already serialized."""
+    return b''.join([f'<codeBook xmlns="{DDI_NAMESPACE}"><dataDscr>'.encode('utf-8')] + serialized
+                    + [b'</dataDscr></codeBook>'])
+
+
+
+def decompress_chunks(compressed):
+    """Decompress zlib data in DDI_CHUNK_SIZE pieces."""
+    decompressor = zlib.decompressobj()
+    for start in range(0, len(compressed), DDI_CHUNK_SIZE):
+        yield decompressor.decompress(compressed[start:start + DDI_CHUNK_SIZE])
+    yield decompressor.flush()
+
+
+
+def resolve_file_id(files, file_ref):
+    """
+    Find a datafile of the dataset by id, label or original file name.
+
+    Args:
+        files (list): The version's 'files' entries
+        file_ref (str): Datafile id, label or file name from the sheet
+
+    Returns:
+        int or None: The datafile id
+    """
+    file_ref = file_ref.strip()
+    for entry in files:
+        data_file = entry['dataFile']
+        if file_ref in (str(data_file['id']), entry.get('label'), data_file.get('filename')):
+            return data_file['id']
+    return None
+
+
+
+def relabel_variables(file_id, labels):
+    """
+    Stream a file's DDI and build a fragment with the variables whose label changes.
+
+    Args:
+        file_id (int): Datafile id
+        labels (dict): variable name -> new label
+
+    Returns:
+        tuple: (DDI fragment or None if nothing changes, number of variables changed)
+    """
+    resp = open_variable_metadata(file_id)
+    if resp is None:
+        terms_logger.warning("Could not read the variable metadata of file %s", file_id)
+        return None, 0
+
+    changed = []
+    seen = set()
+    try:
+        for var in iter_ddi_variables(resp.iter_content(DDI_CHUNK_SIZE)):
+            name = var.get('name')
+            if name not in labels:
+                continue
+            seen.add(name)
+
+            namespace = var.tag[:-len(local_name(var.tag))]
+            labl = next((child for child in var if local_name(child.tag) == 'labl'), None)
+            if labl is not None and (labl.text or '') == labels[name]:
+                continue
+            if labl is None:
+                labl = ET.SubElement(var, namespace + 'labl', level='variable')
+            labl.text = labels[name]
+            changed.append(serialize_variable(var))                             # Only changed variables are kept
+    finally:
+        resp.close()
+
+    missing = set(labels) - seen
+    if len(missing) > 0:
+        terms_logger.warning("File %s has no variable(s) named %s", file_id, sorted(missing))
+    if len(changed) == 0:
+        return None, 0
+
+    return ddi_fragment_from_strings(changed), len(changed)
+
+
+
+def edit_variable_labels(doi, files, rows, push=True):
+    """
+    Apply the rows of a variables sheet to a dataset's tabular files.
+
+    Files are processed concurrently on the tabular file pool, and each file's DDI
+    is streamed, so only the variables that change are held in memory.
+
+    Args:
+        doi (str): Dataset DOI
+        files (list): The version's 'files' entries
+        rows (list): Variables sheet rows (dicts with file, variable and label)
+        push (bool): Send the changes (False only builds them, for a change plan)
+
+    Returns:
+        list: {'file_id', 'xml'} for every file with changed labels; when pushed, each
+        also has 'sent': whether the server accepted it
+    """
+    labels_by_file = {}
+    for row in rows:
+        file_id = resolve_file_id(files, row['file'])
+        if file_id is None:
+            terms_logger.warning("%s: no file %r - variable %s not updated", doi, row['file'], row['variable'])
+            continue
+        labels_by_file.setdefault(file_id, {})[row['variable'].strip()] = row['label']
+
+    def sync(file_id, labels):
+        fragment, count = relabel_variables(file_id, labels)
+        sent = fragment is not None and push and var_update_dataset(doi, file_id, fragment)
+        terms_logger.debug("%s: %d variable label(s) changed in file %s", doi, count, file_id)
+        return fragment, sent
+
+    executor = get_tab_file_executor()
+    futures = [(file_id, executor.submit(sync, file_id, labels)) for file_id, labels in labels_by_file.items()]
+
+    edits = []
+    for file_id, future in futures:
+        fragment, sent = future.result()
+        if fragment is not None:
+            edit = {'file_id': file_id, 'xml': fragment.decode('utf-8')}
+            if push:
+                edit['sent'] = sent
+            edits.append(edit)
+    return edits
+
+
+
+def var_update_dataset(dataset_id, datafile_id, xml):
+    terms_logger.debug("var_update_dataset %s file %s: %s", dataset_id, datafile_id, xml)
+    url = f'{url_base_origin}/api/edit/{str(datafile_id)}'                      # curl -H "X-Dataverse-key:xxxxxxxxxx" -X PUT 
+
+    try:
+        resp = dataverse_put(url, data=xml)                                     # Fetch request information, assign to the variable 'resp'
+        if resp.status_code != 200:                                             # If access is unsuccessful
+            terms_logger.warning("var_update_dataset failed for file %s: %s %s", datafile_id, resp.status_code, resp.text)
+            return False                                                        # Return False
+        else:                                                                   # If access is successful
+            terms_logger.debug("File %s updated", datafile_id)                  # Log status
+
+    except Exception as e:                                                      # In the event of an exception (not sure when this actually happens)
+        terms_logger.warning("var_update_dataset: %s %s", e, url)              # log url related to the exception
+        return False                                                            # Return False
+
+    return True  
+
+
+
+
+def update_terms_of_use(complete_record, latest_version, row, doi, header, push=True):
+    """
+    Apply a terms-of-use row to the dataset version and replace the draft with it.
+
+    Args:
+        complete_record (dict): Full dataset JSON response
+        latest_version (dict): Latest version metadata from Dataverse
+        row (dict): Terms-of-use row, keyed by header
+        doi (str): Dataset DOI
+        header (list): Column headers of the terms-of-use sheet
+        push (bool): Send the new version (False only builds it, for a change plan)
+
+    Returns:
+        tuple: (version payload, ids of the tabular files whose variable metadata is re-sent)
+    """
+    
+    primitive_dictionary = {}
+    primitive_dictionary['typeName'] = 'datasetContactEmail'
+    primitive_dictionary['multiple'] = False
+    primitive_dictionary['typeClass'] = "primitive"
+    primitive_dictionary['value'] = row["Point of Contact Email (MANDATORY)"]
+    
+    main_block = latest_version
+    fields = main_block['metadataBlocks']['citation']['fields']
+    new_fields_val = []
+    for dictionary in fields:
+        if dictionary['typeName'] == 'datasetContact':
+            current_val = dictionary['value'][0]
+            new_contact_val = current_val
+            new_contact_val['datasetContactEmail'] = primitive_dictionary
+        else:
+            new_fields_val.append(dictionary)
+            continue
+    
+    terms_logger.debug("Terms of use for %s, row %s, record %s", doi, row, main_block)
+
+    field_overwrite = {}
+    count = 0
+    for field in header:
+        if field == "doi":
+            continue
+        elif field == "terms":
+            continue 
+        else:
+            if row[field] == '':
+                continue
+            else:
+                field_overwrite[field] = row[field]
+    
+    for k, v in field_overwrite.items():
+        if k in main_block:
+            terms_logger.debug("%s: updating existing entry, current value %s", k, main_block[k])
+            
+            if v == "REMOVE":
+                del main_block[k]
+                terms_logger.debug("%s: entry deleted", k)
+                continue
+            else:
+                if main_block[k] == v:
+                    terms_logger.debug("%s: same value -- no need to update record", k)
+                    continue
+                else:
+                    if v == "REMOVE":
+                        terms_logger.debug("%s: skipping since value == REMOVE", k)
+                        continue
+                    else:
                         main_block[k] = v
-                        print(f"RECORD UPDATED")
-                        print()
+                        terms_logger.debug("%s: record updated, new value %s", k, v)
         else:
             if v == "REMOVE":
-                print('SKIPPING SINCE v == "REMOVE"')
-                print()
+                terms_logger.debug("%s: skipping since value == REMOVE", k)
+                continue
+            else:
+                pos = list(main_block.keys()).index('fileAccessRequest')
+                items = list(main_block.items())
+                items.insert(pos, (f'{k}', f'{v}'))
+                main_block = dict(items)
+                terms_logger.debug("%s: entry added to record, value %s", k, v)
+    
+    complete_record['data']['latestVersion'] = main_block
+    terms_logger.debug("Updated record for %s: %s", doi, complete_record)
+    
+    files_block = main_block.pop("files")
+    tab_file_ids = [files['dataFile']['id'] for files in files_block
+                    if files['dataFile']['contentType'] == 'text/tab-separated-values']
+
+    if push:
+        push_terms_of_use(main_block, doi, tab_file_ids)
+    return main_block, tab_file_ids
+
+
+
+_tab_file_executor = None
+_tab_file_executor_lock = threading.Lock()
+
+
+def get_tab_file_executor():
+    """
+    Return the thread pool shared by every tabular file sync, creating it on first use.
+
+    Returns:
+        ThreadPoolExecutor: Pool of tab_file_workers threads
+    """
+    global _tab_file_executor
+
+    if _tab_file_executor is None:
+        with _tab_file_executor_lock:
+            if _tab_file_executor is None:
+                _tab_file_executor = ThreadPoolExecutor(max_workers=max(1, tab_file_workers),
+                                                        thread_name_prefix='tab-file')
+    return _tab_file_executor
+
+
+
+def shutdown_tab_file_executor():
+    """Stop the tabular file pool (it is recreated if needed again)."""
+    global _tab_file_executor
+
+    with _tab_file_executor_lock:
+        if _tab_file_executor is not None:
+            _tab_file_executor.shutdown(wait=True)
+            _tab_file_executor = None
+
+
+
+def open_variable_metadata(file_id):
+    """
+    Start streaming the DDI variable metadata of a tabular file.
+
+    Args:
+        file_id (int): Datafile id
+
+    Returns:
+        requests.Response or None: Streaming response (close it when done), or None
+        if the metadata could not be read
+    """
+    url = f"{url_base_origin}/api/access/datafile/{file_id}/metadata"
+    resp = dataverse_get(url, stream=True)                                      # Assign access information to the variable 'resp'
+    terms_logger.debug("Fetched variable metadata of file %s (%s)", file_id, resp.status_code)
+
+    if resp.status_code != 200:
+        resp.close()
+        return None
+    return resp
+
+
+
+def snapshot_variable_metadata(file_id):
+    """
+    Keep a compressed copy of a file's variable metadata to restore later.
+
+    The DDI is streamed once: each chunk is compressed as it arrives while the
+    variables are digested one by one, so the whole document is never held in memory.
+
+    Returns:
+        tuple or None: (zlib-compressed DDI XML, variable ID -> digest), or None
+    """
+    resp = open_variable_metadata(file_id)
+    if resp is None:
+        return None
+
+    compressor = zlib.compressobj()
+    compressed = []
+
+    def compress_as_read(chunks):
+        for chunk in chunks:
+            compressed.append(compressor.compress(chunk))
+            yield chunk
+
+    try:
+        digests = {var.get('ID'): variable_digest(var)
+                   for var in iter_ddi_variables(compress_as_read(resp.iter_content(DDI_CHUNK_SIZE)))}
+    finally:
+        resp.close()
+
+    compressed.append(compressor.flush())
+    return b''.join(compressed), digests
+
+
+
+def current_variable_digests(file_id):
+    """
+    Digest every variable of a file's current DDI, streaming it.
+
+    Returns:
+        dict or None: variable ID -> digest, or None if the metadata could not be read
+    """
+    resp = open_variable_metadata(file_id)
+    if resp is None:
+        return None
+    try:
+        return {var.get('ID'): variable_digest(var) for var in iter_ddi_variables(resp.iter_content(DDI_CHUNK_SIZE))}
+    finally:
+        resp.close()
+
+
+
+def restore_variable_metadata(doi, file_id, snapshot):
+    """
+    Send back the variables of a file that the terms-of-use update changed.
+
+    With tab_file_skip_unchanged the current DDI is compared with the snapshot
+    variable by variable, and only the variables that differ are sent.
+
+    Args:
+        doi (str): Dataset DOI
+        file_id (int): Datafile id
+        snapshot (tuple): Result of snapshot_variable_metadata
+
+    Returns:
+        str: 'unchanged', 'restored' or 'failed'
+    """
+    compressed, digests = snapshot
+    changed = None                                                              # None = every variable
+
+    if tab_file_skip_unchanged:
+        current = current_variable_digests(file_id)
+        if current is not None:
+            changed = {var_id for var_id, digest in digests.items() if current.get(var_id) != digest}
+            if len(changed) == 0:
+                return 'unchanged'
+
+    variables = (var for var in iter_ddi_variables(decompress_chunks(compressed))
+                 if changed is None or var.get('ID') in changed)
+    return 'restored' if var_update_dataset(doi, file_id, ddi_fragment(variables)) else 'failed'
+
+
+
+def push_terms_of_use(version, doi, tab_file_ids):
+    """
+    Replace the draft version and restore the variable metadata of its tabular files.
+
+    Replacing the version can reset the DDI variable metadata of tabular files, so
+    it is read before the PUT and sent back afterwards. Both steps run on a bounded
+    pool of tab_file_workers threads shared by all datasets. Snapshots are kept
+    compressed until they are restored, and with tab_file_skip_unchanged only files
+    whose variable metadata actually changed are sent back. A file whose restore
+    fails or raises is logged by id, and the other files are still restored.
+
+    Args:
+        version (dict): Version payload built by update_terms_of_use
+        doi (str): Dataset DOI
+        tab_file_ids (list): Ids of the dataset's tabular files
+
+    Returns:
+        bool: True if the server accepted the new version
+    """
+    executor = get_tab_file_executor()
+
+    snapshots = {}
+    for file_id, snapshot in zip(tab_file_ids, executor.map(snapshot_variable_metadata, tab_file_ids)):
+        if snapshot is not None:
+            snapshots[file_id] = snapshot
+
+    # A rejected PUT left the draft (and its variable metadata) as it was
+    if not API_push_terms_of_use(version, doi):
+        return False
+
+    restores = [(file_id, executor.submit(restore_variable_metadata, doi, file_id, snapshot))
+                for file_id, snapshot in snapshots.items()]
+    snapshots.clear()                                                           # Each restore holds its own snapshot
+
+    # The draft is already replaced: collect every restore, even after one raises
+    outcomes = Counter()
+    failed = []
+    for file_id, future in restores:
+        try:
+            outcome = future.result()
+        except Exception as e:
+            terms_logger.warning("%s: restoring variable metadata of file %s failed: %s", doi, file_id, e)
+            outcome = 'failed'
+        outcomes[outcome] += 1
+        if outcome == 'failed':
+            failed.append(file_id)
+
+    if len(failed) > 0:
+        terms_logger.warning("%s: variable metadata not restored for file(s) %s", doi, failed)
+        log_event('variables_not_restored', doi=doi, files=failed)
+    if len(tab_file_ids) > 0:
+        terms_logger.debug("%s: %d tabular file(s): %d restored, %d unchanged, %d failed, %d unreadable", doi,
+                           len(tab_file_ids), outcomes['restored'], outcomes['unchanged'], outcomes['failed'],
+                           len(tab_file_ids) - sum(outcomes.values()))
+    return True
+
+
+
+def update_metadata(latest_version, row, doi, plan, change_buffer=None, record_fields=None, formatted=None):
+    """
+    Update dataset metadata by parsing CSV row values and pushing changes via API.
+
+    This function processes metadata fields from a CSV row, formats them appropriately
+    (primitive or compound), and collects them in a per-dataset change buffer. Every
+    buffered field is then sent to the Dataverse API in a single editMetadata request,
+    so one row costs one PUT (and one draft revision) no matter how many columns it fills.
+    Fields whose new value matches the current record are left out (see buffer_change),
+    so re-running an already-applied sheet makes no request at all.
+
+    Header parsing and field classification come from the sheet's compiled column
+    plan, so the only per-row work is splitting the cell values. Record fields are
+    matched to columns by typeName through an index (see index_record_fields), so the
+    sheet's column order does not have to follow the record's field order.
+
+    When a change_buffer is passed in, fields are only added to it and the caller is
+    responsible for pushing it; this lets edits from several sheets share one request.
+    Cell values already formatted for the whole sheet (see format_sheet_batch) are
+    used as they are; only cells that must follow the record's own field type are
+    formatted here.
+
+    Args:
+        latest_version (dict): Latest version metadata from Dataverse
+        row (tuple): Current CSV row, indexed by the column plan
+        doi (str): Dataset DOI
+        plan (SheetPlan): Compiled column plan of the sheet (see compile_column_plan)
+        change_buffer (dict): Optional shared buffer of typeName -> field to fill instead of pushing
+        record_fields (dict): Optional typeName -> field index of the record, shared by every
+            edit to the same dataset; built from latest_version when not given
+        formatted (tuple): Optional pre-formatted value of each column, from format_sheet_batch
+    """
+    metadata_blocks = latest_version['metadataBlocks']
+    block = plan.block_name
+
+    if block not in metadata_blocks:
+        generated_record = metadatablock_generator(block)
+        metadata_blocks[block] = generated_record[block]
+    fields = metadata_blocks[block]['fields']
+
+    if record_fields is None:
+        record_fields = index_record_fields(latest_version)
+    edit_logger.debug("%s fields in record: %s", doi, Lazy(list, record_fields))
+
+    push_at_end = change_buffer is None
+    if push_at_end:
+        change_buffer = ChangeBuffer()                                          # typeName -> formatted field, pushed once at the end
+
+    for position, column in enumerate(plan.columns):
+        if column.kind == 'doi':
+            continue
+
+        cell = row[column.index]
+        field_name = column.field_name
+        current_field = record_fields.get(field_name)
+
+        # Handle new fields not in existing record
+        if current_field is None:
+            if cell == '' or cell == 'REMOVE' or column.template is None:
                 continue
+
+            edit_logger.debug("%s: not in existing record, record to add: %s", field_name, cell)
+            if formatted is not None:
+                value = formatted_value(formatted[position])
             else:
-                print("ENTRY MUST BE ADDED")
-                pos = list(main_block.keys()).index('fileAccessRequest')
-                items = list(main_block.items())
-                items.insert(pos, (f'{k}', f'{v}'))
-                print(f'{k}: {v}')
-                print("ENTRY ADDED TO RECORD")
-                main_block = dict(items)
-                print()
-    
-    complete_record['data']['latestVersion'] = main_block
-    print(complete_record)
-    
-    files_block = main_block.pop("files")
-    tab_dictionary = {}
-    for files in files_block:
-        dataFile = files['dataFile']
-        
-        if dataFile['contentType'] == 'text/tab-separated-values':
-            file_id = dataFile['id']
-            url = f"{url_base_origin}/api/access/datafile/{file_id}/metadata"
-            resp = requests.get(url, headers=headers_origin)                    # Assign access information to the variable 'resp'
-
-            if resp.status_code == 200:                # If access is successful
-                tree = resp.content                      # Assign string json() data to tree (creates a new json?)
-                tab_dictionary[file_id] = tree
-            
-            print(tab_dictionary)
-            print(file_id)
-            print(files)
-            
-    print()
-    API_push_terms_of_use(main_block, doi)
-    
-    for k, v in tab_dictionary.items():
-        var_update_dataset(doi, k, v)
+                value = format_cell(column.kind, column.children, cell, column.multiple)
+            if value is None:
+                continue
+
+            # Later rows for this dataset see the new field as part of the record
+            new_field = new_field_payload(column, value)
+            fields.append(new_field)
+            record_fields[field_name] = new_field
+            buffer_change(change_buffer, new_field, None)
+            continue
+
+        # Handle existing fields
+        before_value = copy.deepcopy(current_field['value'])                    # The record's field is edited in place
+        edit_logger.debug("%s: updating existing field from column %s", field_name, column.header)
+
+        # Fields to remove follow the record's own type; updates follow the sheet's
+        kind = column.kind
+        if cell == 'REMOVE' and current_field['typeClass'] in ('primitive', 'compound'):
+            kind = current_field['typeClass']
+
+        if formatted is not None and kind == column.kind and current_field['multiple'] == column.multiple:
+            value = formatted_value(formatted[position])
+        else:
+            value = format_cell(kind, column.children, cell, current_field['multiple'])
+        if value is None:
+            continue
+
+        current_field['value'] = value
+        buffer_change(change_buffer, current_field, before_value)
+
+        # A removed field is no longer part of the record for later rows
+        if cell == 'REMOVE':
+            del record_fields[field_name]
+            fields[:] = [field for field in fields if field is not current_field]
+
+    # Send every buffered field for this dataset in one editMetadata request
+    if push_at_end:
+        push_change_buffer(change_buffer, doi)
+
+
+
+def index_record_fields(latest_version):
+    """
+    Index every field of a dataset version by typeName.
+
+    typeNames are unique across metadata blocks, so one index covers the whole
+    record. It is built once per dataset and kept up to date by update_metadata.
+
+    Args:
+        latest_version (dict): Latest version metadata from Dataverse
+
+    Returns:
+        dict: typeName -> field entry (the same dicts as in latest_version)
+    """
+    return {
+        field['typeName']: field
+        for block in latest_version['metadataBlocks'].values()
+        for field in block['fields']
+    }
+
+
+
+def format_cell(kind, children, cell, multiple):
+    """
+    Turn one CSV cell into a field value.
+
+    Args:
+        kind (str): 'primitive' or 'compound' (anything else is never updated)
+        children (tuple): Sub-field names of a compound column
+        cell (str): Raw cell text
+        multiple (bool): Whether the field holds a list of values
+
+    Returns:
+        The new field value, or None if the cell does not update the record
+    """
+    if kind == 'primitive':
+        return format_primitive_value(cell, multiple)
+    if kind == 'compound':
+        value = format_compound_value(children, cell)
+        if value is False:
+            return None
+        return value if multiple else value[0]
+    return None
+
+
+
+def format_column(column, cells):
+    """
+    Format a whole column of cells in one pass.
+
+    Each distinct cell text is split and validated once and the result is shared
+    by every row holding that text, so repeated values (controlled vocabularies,
+    affiliations, REMOVE, empty cells) cost a dict lookup. The returned values are
+    shared between rows and must be treated as read-only.
+
+    Args:
+        column (ColumnSpec): The compiled column
+        cells: The column's cells - a list, a pandas Series or a pyarrow Array
+
+    Returns:
+        list: The formatted value of each cell (None if it does not update the record,
+        a ValueError if the cell is malformed)
+    """
+    if hasattr(cells, 'to_pylist'):                                             # pyarrow Array
+        cells = cells.to_pylist()
+    elif hasattr(cells, 'tolist'):                                              # pandas Series / numpy array
+        cells = cells.tolist()
+    cells = ['' if cell is None or cell != cell else str(cell) for cell in cells]   # cell != cell: NaN
+
+    if column.kind not in ('primitive', 'compound'):
+        return [None] * len(cells)
+
+    values = {}
+    for cell in dict.fromkeys(cells):
+        try:
+            values[cell] = format_cell(column.kind, column.children, cell, column.multiple)
+        except ValueError as error:
+            values[cell] = error                                                # Raised when the row is applied
+    return [values[cell] for cell in cells]
+
+
+
+def format_sheet_batch(plan, rows):
+    """
+    Format a batch of rows column by column (see format_column).
+
+    Args:
+        plan (SheetPlan): The sheet's compiled column plan
+        rows (list): Row tuples of the sheet
+
+    Returns:
+        list: One tuple per row with the formatted value of each column of the plan
+    """
+    columns = [format_column(column, [row[column.index] for row in rows]) for column in plan.columns]
+    return list(zip(*columns)) if len(columns) > 0 else [()] * len(rows)
+
+
+
+def iter_formatted_rows(rows, plan):
+    """
+    Pair each row with its pre-formatted values, formatting format_batch_size rows at a time.
+
+    Args:
+        rows (iterable): Row tuples of the sheet
+        plan (SheetPlan): The sheet's compiled column plan
+
+    Yields:
+        tuple: (row, formatted values), formatted is None for terms-of-use and variables sheets
+    """
+    if len(plan.columns) == 0:
+        for row in rows:
+            yield row, None
+        return
+
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, max(1, format_batch_size)))
+        if len(batch) == 0:
+            return
+        yield from zip(batch, format_sheet_batch(plan, batch))
+
+
+
+def formatted_value(value):
+    """Value of a pre-formatted cell, raising the error of a malformed one."""
+    if isinstance(value, ValueError):
+        raise value
+    return value
+
+
+
+def new_field_payload(column, value):
+    """Copy-on-write payload for a field that is not in the record yet."""
+    return dict(column.template, value=value)
+
+
+
+# Multi-value fields compared as unordered sets besides controlled vocabularies: their
+# order carries no meaning, unlike e.g. author or contributor order in the citation
+UNORDERED_FIELDS = frozenset({'keyword', 'topicClassification'})
+
+
+def normalize_field_value(value, ordered=True):
+    """
+    Canonical form of a field value, used to decide whether an edit changes anything.
+
+    Strings are stripped, empty entries are ignored and primitive sub-field dicts are
+    reduced to their value. Multi-value lists keep their order unless `ordered` is
+    False, in which case ['a', 'b'] and ['b ', 'a'] are considered equal.
+
+    Args:
+        value: A field value (str, list, or compound dict) from the record or a formatter
+        ordered (bool): Whether the order of multiple values is significant
+
+    Returns:
+        str or tuple: Hashable representation of the value
+    """
+    if isinstance(value, dict):
+        if 'typeName' in value and 'value' in value:                            # Primitive sub-field of a compound entry
+            return normalize_field_value(value['value'], ordered)
+        entry = [(key, normalize_field_value(sub_value, ordered)) for key, sub_value in value.items()]
+        return tuple(sorted(item for item in entry if item[1] not in ('', ())))
+    if isinstance(value, list):
+        items = [normalize_field_value(item, ordered) for item in value]
+        items = [item for item in items if item not in ('', ())]
+        return tuple(items) if ordered else tuple(sorted(items, key=repr))
+    if value is None:
+        return ''
+    return str(value).strip()
+
+
+
+class ChangeBuffer(dict):
+    """
+    typeName -> formatted field for one dataset. `before` keeps each buffered field's
+    value from before the first edit, so a change plan can show what is replaced.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.before = {}
+
+
+
+def buffer_change(change_buffer, field, before_value):
+    """
+    Add a formatted field to the change buffer unless it leaves the record unchanged.
+
+    Args:
+        change_buffer (ChangeBuffer): typeName -> formatted field
+        field (dict): Formatted field to send
+        before_value: The field's value in the current record, or None if it is not in the record
+    """
+    ordered = field.get('typeClass') != 'controlledVocabulary' and field['typeName'] not in UNORDERED_FIELDS
+    if normalize_field_value(before_value, ordered) == normalize_field_value(field['value'], ordered):
+        edit_logger.debug("%s: same value -- no need to update record", field['typeName'])
+        return
+    change_buffer[field['typeName']] = field
+    change_buffer.before.setdefault(field['typeName'], before_value)
+
+
+
+def push_change_buffer(change_buffer, doi):
+    """
+    Send every buffered field for a dataset in one editMetadata request.
+
+    Args:
+        change_buffer (ChangeBuffer): typeName -> formatted field
+        doi (str): Dataset DOI
+
+    Returns:
+        int or None: Number of fields sent (0 if there was nothing to change), or
+        None if the server rejected the request
+    """
+    if len(change_buffer) == 0:
+        edit_logger.debug("%s: no changes to push", doi)
+        return 0
+
+    if not API_push(list(change_buffer.values()), doi):
+        return None
+    return len(change_buffer)
+
+
+
+# What sending one dataset's changes did: the fields in its editMetadata request, and
+# how many requests (editMetadata, terms-of-use versions, variable metadata) the server
+# accepted and rejected. In 'plan' mode only `fields` is set, to the fields planned.
+PushOutcome = namedtuple('PushOutcome', ['fields', 'accepted', 'rejected'])
+
+
+
+# ============================================================================
+# CHANGE PLAN
+# ============================================================================
+
+class ChangePlanWriter:
+    """
+    Write a change plan: one JSON line per dataset that has something to change.
+
+    Each line holds the dataset's DOI and id, its latest version's lastUpdateTime
+    when it was planned, the fields that would be sent in its editMetadata request,
+    their values before the edit, any terms-of-use version payloads and any variable
+    label fragments. Datasets with no changes are left out. Safe to share between
+    worker threads.
+
+    Args:
+        path (str): Plan file to (over)write
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+        self.datasets = 0
+        self.fields = 0
+
+    def write(self, complete_record, doi, change_buffer, terms, variables=()):
+        """
+        Add a dataset's planned changes to the plan.
+
+        Args:
+            complete_record (dict): Full dataset JSON response
+            doi (str): Dataset DOI
+            change_buffer (ChangeBuffer): Fields that would be sent
+            terms (list): {'version', 'tab_files'} dicts from update_terms_of_use
+            variables (list): {'file_id', 'xml'} dicts from edit_variable_labels
+
+        Returns:
+            int: Number of fields planned
+        """
+        if len(change_buffer) == 0 and len(terms) == 0 and len(variables) == 0:
+            return 0
+
+        data = complete_record['data']
+        entry = {
+            'doi': doi,
+            'id': data['id'],
+            'lastUpdateTime': data['latestVersion'].get('lastUpdateTime'),
+            'fields': list(change_buffer.values()),
+            'before': {name: change_buffer.before.get(name) for name in change_buffer},
+            'terms': terms,
+            'variables': list(variables),
+        }
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+
+        with self._lock:
+            self._file.write(line)
+            self.datasets += 1
+            self.fields += len(change_buffer)
+        return len(change_buffer)
+
+    def close(self):
+        self._file.close()
+
+
+
+def iter_change_plan(plan_path):
+    """
+    Read a change plan one dataset at a time.
+
+    Args:
+        plan_path (str): Plan file written in 'plan' mode
+
+    Yields:
+        dict: One planned dataset (see ChangePlanWriter)
+    """
+    for _, entry in iter_change_plan_lines(plan_path):
+        yield entry
+
+
+
+def iter_change_plan_lines(plan_path):
+    """Read a change plan one dataset at a time, with the byte offset of each line."""
+    with open(plan_path, 'rb') as plan_file:
+        offset = 0
+        for line in plan_file:
+            if line.strip():
+                yield offset, json.loads(line)
+            offset += len(line)
+
+
+
+# Where one dataset's planned changes sit in the plan file, plus what is needed to
+# decide whether to send them. Parked instead of the entry, which can hold whole
+# terms-of-use versions and variable metadata.
+PlannedChange = namedtuple('PlannedChange', ['plan_path', 'offset', 'doi', 'dataset_id', 'last_update_time'])
+
+
+def iter_planned_changes(plan_path):
+    """
+    Read a change plan one dataset at a time, parsing each line once.
+
+    Args:
+        plan_path (str): Plan file written in 'plan' mode
+
+    Yields:
+        tuple: (PlannedChange reference to the dataset, the planned dataset itself);
+        only the reference is kept if the dataset has to wait for a lock
+    """
+    for offset, entry in iter_change_plan_lines(plan_path):
+        yield PlannedChange(plan_path, offset, entry['doi'], entry['id'], entry.get('lastUpdateTime')), entry
+
+
+
+def load_planned_change(planned):
+    """Read the planned dataset a PlannedChange points at."""
+    with open(planned.plan_path, 'rb') as plan_file:
+        plan_file.seek(planned.offset)
+        return json.loads(plan_file.readline())
+
+
+
+def apply_planned_changes(planned, scheduler, publisher=None, entry=None):
+    """
+    Send one dataset's planned changes. Runs on a DatasetWorkPool worker.
+
+    Nothing is parsed or formatted here: the payloads are sent as they were planned.
+    A locked dataset is parked in the scheduler like in 'update' mode; only the
+    PlannedChange reference is kept while it waits, and the payloads are read from
+    the plan again once it unlocks.
+
+    Args:
+        planned (PlannedChange or dict): Reference to one planned dataset, or the
+            planned dataset itself (see ChangePlanWriter)
+        scheduler (LockScheduler): Where work for locked datasets is parked
+        publisher (PublishQueue): Where changed datasets are queued for publishing
+        entry (dict): The planned dataset `planned` refers to, if it was already read
+    """
+    if isinstance(planned, PlannedChange):
+        doi, dataset_id, last_update_time = planned.doi, planned.dataset_id, planned.last_update_time
+    else:
+        entry = planned
+        doi, dataset_id, last_update_time = entry['doi'], entry['id'], entry.get('lastUpdateTime')
+
+    # Parked work keeps only `planned`: the entry is dropped and read again when it runs
+    if scheduler.park_behind(doi, apply_planned_changes, planned, scheduler, publisher):
+        return
+
+    if apply_skip_changed and last_update_time is not None:
+        current = fetch_version_update_time(doi)
+        if current is not None and current != last_update_time:
+            logger.warning("%s: changed since the plan was made - not updated (plan it again)", doi)
+            log_event('dataset', doi=doi, outcome='stale')
+            return
+
+    if timed_check_lock(dataset_id) != True:
+        scheduler.park(doi, dataset_id, apply_planned_changes, planned, scheduler, publisher)
+        lock_logger.info("%s: locked - will try again once the lock clears", doi)
+        log_event('parked', doi=doi)
+        return
+
+    if entry is None:
+        entry = load_planned_change(planned)
+
+    results = []
+    for terms in entry['terms']:
+        with run_metrics.timer('terms_of_use'):
+            results.append(push_terms_of_use(terms['version'], doi, terms['tab_files']))
+    if len(entry['fields']) > 0:
+        with run_metrics.timer('push'):
+            results.append(API_push(entry['fields'], doi))
+    for variables in entry.get('variables', []):
+        with run_metrics.timer('variables'):
+            results.append(var_update_dataset(doi, variables['file_id'], variables['xml'].encode('utf-8')))
+
+    cache = get_dataset_cache()
+    if cache is not None:
+        cache.invalidate(doi)
+
+    if not all(results):
+        logger.warning("%s: %d of %d planned request(s) rejected by the server", doi, results.count(False), len(results))
+        log_event('dataset', doi=doi, outcome='push_failed', fields=len(entry['fields']))
+        return
+
+    if publisher is not None and len(results) > 0:
+        publisher.mark(doi, dataset_id)
+
+    logger.info("%s: %d planned field(s) sent", doi, len(entry['fields']))
+    log_event('dataset', doi=doi, outcome='updated', fields=len(entry['fields']))
+
+
+
+
+
+def primitive_formatter(change_area, row, field):
+    """
+    Format primitive metadata field values for updates.
+
+    Handles single or multiple values, including splitting on '+' delimiter
+    for multiple values in a single CSV cell.
+
+    Args:
+        change_area (str): Name of the field being updated
+        row (dict): CSV row containing the new values
+        field (dict): Field definition from the directory
+
+    Returns:
+        dict or str: Formatted field ready for API update
+    """
+    new_value = format_primitive_value(row[change_area], field['multiple'])
+    if new_value is None:
+        edit_logger.debug("%s: not updated in the record", change_area)
+        return ''
+
+    edit_logger.debug("%s: %s -> %s", change_area, field['value'], new_value)
+    field['value'] = new_value
+    return field
+
+
+
+def format_primitive_value(cell, multiple):
+    """
+    Split a primitive cell into its new value.
+
+    Values separated by '+' become a list; 'REMOVE' clears the field.
+
+    Args:
+        cell (str): Raw cell text
+        multiple (bool): Whether the field holds a list of values
+
+    Returns:
+        str or list: The new value, or None if the cell is empty
+    """
+    # Handle multiple values separated by '+'
+    if '+' in cell:
+        return cell.split('+')
+    if cell == 'REMOVE':
+        return [''] if multiple else ''
+    if cell == '':
+        return None
+    return [cell] if multiple else cell
+
+
+def compound_formatter(header, row):
+    """
+    Format compound metadata field values for updates.
+
+    Compound fields contain multiple primitive sub-fields. This function
+    parses the header to identify sub-fields and formats the values accordingly.
+
+    Args:
+        header (str): CSV column header containing field and sub-field definitions
+        row (dict): CSV row with the values to update
+
+    Returns:
+        list or bool: List of formatted compound values, or False if no update needed
+    """
+    value = format_compound_value(parse_compound_children(header), row[header])
+    if value is False:
+        edit_logger.debug("%s: not updated in the record", header)
+    return value
+
+
+
+def parse_compound_children(header):
+    """Sub-field names of a compound column header, e.g. 'author: authorName; authorAffiliation'."""
+    if ':' not in header:
+        return ()
+    return tuple(child.strip() for child in header.split(':')[1].split(';'))
 
 
 
-def update_metadata(latest_version, row, doi, header, directory, master_list, block):
+def format_compound_value(children, cell):
     """
-    Update dataset metadata by parsing CSV row values and pushing changes via API.
+    Split a compound cell into a list of compound entries.
 
-    This function processes metadata fields from a CSV row, formats them appropriately
-    (primitive or compound), and sends updates to the Dataverse API.
+    Entries are separated by '+' and sub-field values by ';', in the order of
+    `children`. 'REMOVE' (without '+') clears the field.
 
     Args:
-        latest_version (dict): Latest version metadata from Dataverse
-        row (dict): Current CSV row containing update values
-        doi (str): Dataset DOI
-        header (list): CSV column headers
-        directory (dict): Field definitions for the metadata block
-        master_list (list): Contains [primitive_fields, compound_fields, controlled_vocab_fields]
-        block (str): Metadata block name (e.g., 'citation', 'socialscience')
+        children (tuple): Sub-field names from the column header
+        cell (str): Raw cell text
+
+    Returns:
+        list or bool: One {subField: primitive dict} entry per '+' group, or False if the cell is empty
     """
-    metadata_blocks = latest_version['metadataBlocks']
+    if cell == '':
+        return False
 
-    if block not in metadata_blocks:
-        generated_record = metadatablock_generator(block)
-        metadata_blocks[block] = generated_record[block]
-        fields = metadata_blocks[block]['fields']
+    if '+' in cell:
+        entries = [group.split(';') for group in cell.split('+')]
+        remove = False
     else:
-        fields = metadata_blocks[block]['fields']
+        entries = [cell.split(';')]
+        remove = entries[0][0] == 'REMOVE'
 
-    print('%%%%%%%%%%%%%%%%%%%%%%%%%%%%')
-    print(fields)
-    print('%%%%%%%%%%%%%%%%%%%%%%%%%%%%')
+    value = []
+    for parts in entries:
+        if len(parts) > len(children):
+            raise ValueError(f"{len(parts)} values for {len(children)} sub-fields {children}: {cell}")
 
-    existing_fields = [field for field in fields]
-    existing_field_names = [field['typeName'] for field in fields]
-    print(existing_fields)
-    print(existing_field_names)
+        entry = {}
+        for child, part in zip(children, parts):
+            entry[child] = {
+                'typeName': child,
+                'multiple': False,
+                'typeClass': "primitive",
+                'value': '' if remove else part.strip()
+            }
+        value.append(entry)
 
-    field_index = 0
-    for change_area in header:
-        field_name = change_area.split(":")[0]
-        print(field_name)
+    return value
 
-        # Handle new fields not in existing record
-        if field_name not in existing_field_names and field_name != 'doi':
-            print(f"{field_name} -- NOT IN EXISTING RECORD")
-            
-            if row[change_area] != '' and row[change_area] != 'REMOVE':
-                print(f'RECORD TO ADD: {row[change_area]}')
-                field = directory[field_name]
 
-                # Process primitive fields
-                if field_name in master_list[0]:
-                    output = primitive_formatter(change_area, row, field)
 
-                    if output == '':
-                        field_index += 1
-                        continue
-                    else:
-                        API_push(field, doi)
 
-                # Process compound fields
-                elif field_name in master_list[1]:
-                    output = compound_formatter(change_area, row)
-                    print(f'OUTPUT: {output}')
 
-                    if output == False:
-                        print()
-                        field_index += 1
-                        continue
-                    else:
-                        if field['multiple'] == True:
-                            field['value'] = output
-                        else:
-                            field['value'] = output[0]
-                    API_push(field, doi)
-            else:
-                print('-- NO RECORD TO ADD --')
-                print()
-                continue
+WORKBOOK_EXTENSIONS = ('.xlsx', '.xlsm')
 
-        # Handle existing fields
-        elif field_name in existing_field_names:
-            current_field = existing_fields[field_index]
-            print(f'Change_area = {change_area}')
-            print(f'Fields = {current_field["typeName"]}')
-            
-            # Fields to remove
-            if row[change_area] == 'REMOVE':
-                print()
-                print(f'current_field: {current_field}')
-                
-                if current_field['typeClass'] == 'primitive':
-                    primitive_formatter(change_area, row, current_field)
-                    print(f'NEW FIELD VALUE: {current_field}')
-                    print()
-                    
-                    API_push(current_field, doi)
-                    field_index += 1
-                    continue                
-            
-                elif current_field['typeClass'] == 'compound':
-                    field_format = compound_formatter(change_area, row)
-                    
-                    if current_field['multiple']:
-                        current_field['value'] = field_format
-                    else:
-                        current_field['value'] = field_format[0]
-                 
-                    API_push(current_field, doi)
-                    field_index += 1
-                    continue                    
-            
-        
-            # Update primitive fields
-            if current_field['typeName'] == change_area and current_field['typeName'] in master_list[0]:
-                output = primitive_formatter(change_area, row, current_field)
-                #print(f' {output}')
-
-                if output == '':
-                    field_index += 1
-                    continue
-                else:
-                    API_push(current_field, doi)
 
-            # Update compound fields
-            elif current_field['typeName'] in change_area and current_field['typeName'] in master_list[1]:
-                field_format = compound_formatter(change_area, row)
-                print(f'FIELD FORMAT: {field_format}')
 
-                if field_format == False:
-                    print()
-                    field_index += 1
-                    continue
-                else:
-                    if current_field['multiple']:
-                        current_field['value'] = field_format
-                    else:
-                        current_field['value'] = field_format[0]
+def file_loader():
+    """
+    Main entry point for processing CSV files and updating dataset metadata.
+
+    Iterates through configured CSV files and hands the edits for each dataset to a
+    DatasetWorkPool keyed by DOI so that up to `max_workers` datasets are updated
+    concurrently. When several sheets are configured they are first joined on the
+    DOI column (see join_sheets), so every dataset is fetched and lock-checked once.
+    Datasets that are locked are parked in a LockScheduler and handed back to the
+    pool as soon as they unlock.
+
+    In 'plan' mode the changes are written to change_plan_path instead of being
+    sent; in 'apply' mode that plan is sent without reading the sheets (see run_mode).
+    With publish_after_edit, changed datasets are published by a PublishQueue
+    running next to the edit workers.
+    Phase timings and request counts are reported when the run ends (see
+    write_run_report).
+    """
+    configure_logging()
+    run_metrics.reset()
+    if dataset_cache_offline and dataset_cache_dir is not None and run_mode == 'update':
+        logger.warning("dataset_cache_offline is ignored in 'update' mode - cached records are revalidated")
+    if refresh_metadata_block_schema:
+        refresh_schema_registry()
+    publisher = None
+    pool = DatasetWorkPool(max_workers, max_workers * pending_rows_per_worker,
+                           on_idle=lambda doi: publisher.dataset_idle(doi) if publisher is not None else None)
+    scheduler = LockScheduler(pool, lock_wait_deadline)
+    change_plan = ChangePlanWriter(change_plan_path) if run_mode == 'plan' else None
+    if publish_after_edit and run_mode != 'plan':
+        publisher = PublishQueue(pool, scheduler, publish_workers, lock_wait_deadline, publish_type)
+
+    try:
+        budget = get_error_budget()
+        if run_mode == 'apply':
+            work = ((planned.doi, apply_planned_changes, planned, scheduler, publisher, entry)
+                    for planned, entry in run_metrics.timed_iter(iter_planned_changes(change_plan_path), 'read_plan'))
+        else:
+            units = iter_dataset_edits(file_directory, group_by_doi=change_plan is not None)
+            work = ((doi, process_dataset, doi, edits, scheduler, change_plan, publisher)
+                    for doi, edits in run_metrics.timed_iter(units, 'read_sheets'))
 
-                    API_push(current_field, doi)
+        for doi, func, *args in work:
+            if budget.exhausted:
+                logger.error("Error budget used up - stopped before %s; the remaining rows were not processed", doi)
+                break
+            pool.submit(doi, func, *args)
 
-            field_index += 1
+        # Work handed back by the scheduler may find its dataset locked again and re-park
+        while True:
+            pool.wait()
+            if scheduler.pending() == 0:
+                break
+            logger.info("Waiting for %d locked dataset(s) - this may take a while if they are still locked", scheduler.pending())
+            scheduler.wait()
 
+        if len(scheduler.expired) > 0:
+            logger.warning("Datasets not updated because they stayed locked: %s", scheduler.expired)
+        if len(scheduler.unreadable) > 0:
+            logger.warning("Datasets not updated because their lock status could not be read: %s", scheduler.unreadable)
 
+        if publisher is not None:
+            publisher.wait()
+            failed = sorted(doi for doi, outcome in publisher.outcomes.items() if outcome != 'published')
+            if len(failed) > 0:
+                logger.warning("Datasets not published: %s", failed)
+    finally:
+        scheduler.close()
+        pool.shutdown()
 
+        if publisher is not None:
+            publisher.close()
 
+        if change_plan is not None:
+            change_plan.close()
+            logger.info("Change plan written to %s: %d dataset(s), %d field(s)",
+                        change_plan_path, change_plan.datasets, change_plan.fields)
 
-def primitive_formatter(change_area, row, field):
+        shutdown_tab_file_executor()
+
+        cache = get_dataset_cache()
+        if cache is not None:
+            cache.save()
+
+        write_run_report()
+
+
+
+def stream_csv_rows(csv_path):
     """
-    Format primitive metadata field values for updates.
+    Read a CSV sheet in a single streaming pass.
 
-    Handles single or multiple values, including splitting on '+' delimiter
-    for multiple values in a single CSV cell.
+    The first item yielded is the list of column headers, taken from the first
+    line of the file; every following item is one row as a compact tuple, in
+    header order and padded to the header width. Rows are read lazily, so memory
+    use does not grow with the size of the sheet.
 
     Args:
-        change_area (str): Name of the field being updated
-        row (dict): CSV row containing the new values
-        field (dict): Field definition from the directory
+        csv_path (str): Path to the CSV file
 
-    Returns:
-        dict or str: Formatted field ready for API update
+    Yields:
+        list, then tuple: The headers, followed by one tuple per row
     """
-    current_value = field['value']
-    print(f"Unit to replace = {current_value}")
+    with open(csv_path, newline='', encoding='utf-8-sig') as csvfile:
+        reader = csv.reader(csvfile)
+        headers = next(reader, [])
+        yield headers
+
+        width = len(headers)
+        for values in reader:
+            if len(values) == 0:
+                continue
+            if len(values) != width:
+                values = (values + [''] * width)[:width]
+            yield tuple(values)
 
-    # Handle multiple values separated by '+'
-    if '+' in row[change_area]:
-        new_values = row[change_area].split('+')
-        print(f'New unit (plural): {new_values}')
-        return record_check(new_values, field)
-
-    else:                                       # Handle single value
-        if field['multiple']:
-            new_values = [row[change_area]]
-            
-            if new_values == ['REMOVE']:
-                field['value'] = ['']
-                return field
-            
-            print(f'New unit (singular): {new_values}')
-            return record_check(new_values, field)
-        else:
-            new_value = row[change_area]
-            if new_value == 'REMOVE':
-                field['value'] = ''
-                return field
-                
-            print(f'New unit (singular): {new_value}')
-            return record_check(new_value, field)
+
+
+def is_workbook(path):
+    """Whether a configured sheet path is an Excel workbook rather than a CSV file."""
+    return str(path).lower().endswith(WORKBOOK_EXTENSIONS)
 
 
 
+def workbook_cell_text(value):
+    """Text of a workbook cell as it appears in the sheet's CSV export."""
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.date().isoformat() if value.time() == datetime.min.time() else value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
 
 
-def record_check(new_value, field):
+def stream_workbook_sheets(workbook_path):
     """
-    Validate and assign new value to field.
+    Read every sheet of an Excel workbook in a single streaming pass.
 
-    Helper function to avoid code duplication in primitive_formatter.
-    Checks if the new value is empty and handles field assignment.
+    The workbook is opened once, read-only, and each sheet's rows are read lazily
+    as the caller iterates them, like stream_csv_rows. A sheet's block is detected
+    from its marker column (see xml_selecter); sheets without one, such as lists of
+    vocabulary terms, are skipped. Empty rows left over from sheet formatting are
+    skipped too.
 
     Args:
-        new_value: The new value to assign (string or list)
-        field (dict): Field dictionary to update
+        workbook_path (str): Path to the .xlsx workbook
 
-    Returns:
-        dict or str: Updated field or empty string if no update needed
+    Yields:
+        tuple: (sheet name, headers, iterator of row tuples), one per sheet
+
+    Raises:
+        ImportError: If openpyxl is not installed
     """
-    if new_value == [''] or new_value == '':
-        print('NOT UPDATED IN THE RECORD')
-        return ''
-    else:
-        field['value'] = new_value
-        return field
+    try:
+        import openpyxl
+    except ImportError as error:
+        raise ImportError(f"Reading {workbook_path} needs openpyxl (pip install openpyxl), "
+                          f"or export its sheets to CSV") from error
+
+    workbook = openpyxl.load_workbook(workbook_path, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            rows = worksheet.iter_rows(values_only=True)
+            headers = [workbook_cell_text(value) for value in next(rows, ())]
+            while len(headers) > 0 and headers[-1] == '':                      # Formatted but unused columns
+                headers.pop()
+
+            try:
+                xml_selecter(headers)
+            except ValueError:
+                logger.info("Sheet %s of %s has no marker column - skipped", worksheet.title, workbook_path)
+                continue
 
+            yield f"{workbook_path} [{worksheet.title}]", headers, workbook_rows(rows, len(headers))
+    finally:
+        workbook.close()
 
 
-def compound_formatter(header, row):
+
+def workbook_rows(rows, width):
+    """Workbook rows as CSV-like tuples of text, padded or cut to the header width."""
+    for values in rows:
+        values = tuple(workbook_cell_text(value) for value in values[:width])
+        if not any(values):
+            continue
+        if len(values) < width:
+            values += ('',) * (width - len(values))
+        yield values
+
+
+
+def iter_sheets(paths):
     """
-    Format compound metadata field values for updates.
+    Yield every configured sheet: one per CSV file, one per marked sheet of a workbook.
+
+    Args:
+        paths (list): Paths to CSV files and .xlsx workbooks
+
+    Yields:
+        tuple: (sheet name, headers, iterator of row tuples)
+    """
+    for path in paths:
+        if is_workbook(path):
+            yield from stream_workbook_sheets(path)
+        else:
+            rows = stream_csv_rows(path)
+            headers = next(rows)
+            yield path, headers, rows
+
+
+
+def standardize_doi(doi):
+    """Convert a https://doi.org/ link into the doi:... form used by the API."""
+    if 'https://doi.org/' in doi:
+        doi = doi.replace('https://doi.org/', 'doi:')
+    return doi
+
 
-    Compound fields contain multiple primitive sub-fields. This function
-    parses the header to identify sub-fields and formats the values accordingly.
+
+def iter_dataset_edits(csv_paths, group_by_doi=False):
+    """
+    Yield the edits to apply to each dataset, one unit of work per DOI.
+
+    An edit is a (row, plan, formatted) tuple, where formatted holds the row's
+    cell values already formatted for the API (see iter_formatted_rows). With a
+    single CSV sheet, or when join_sheets_by_doi is off, rows are streamed and each
+    row is its own unit. Otherwise, or with group_by_doi, the sheets (including
+    every sheet of a workbook) are joined on DOI first.
 
     Args:
-        header (str): CSV column header containing field and sub-field definitions
-        row (dict): CSV row with the values to update
+        csv_paths (list): Paths to the CSV sheets and .xlsx workbooks
+        group_by_doi (bool): Always yield every row of a DOI in one unit. A change
+            plan needs this: each of its lines is computed against one fetch of the
+            record, so two lines for the same dataset would miss each other's edits.
+
+    Yields:
+        tuple: (doi, list of edits)
+    """
+    if group_by_doi or (join_sheets_by_doi and (len(csv_paths) > 1 or any(is_workbook(path) for path in csv_paths))):
+        yield from join_sheets(csv_paths).items()
+        return
+
+    for sheet_name, headers, rows in iter_sheets(csv_paths):
+        # Compile the sheet's column plan once
+        plan = compile_column_plan(headers)
+        logger.info("Sheet %s: %s block, %d columns", sheet_name, plan.block_name, len(headers))
+
+        for row, formatted in iter_formatted_rows(rows, plan):
+            yield standardize_doi(row[0]), [(row, plan, formatted)]
+
+
+
+def join_sheets(csv_paths):
+    """
+    Planning stage: join every configured sheet on its DOI column.
+
+    Args:
+        csv_paths (list): Paths to the CSV sheets (one metadata block each) and
+            .xlsx workbooks (one metadata block per sheet)
 
     Returns:
-        list or bool: List of formatted compound values, or False if no update needed
+        dict: doi -> list of (row, plan, formatted), in sheet order, with DOIs
+        in order of first appearance
     """
-    first_list = header.split(":")
+    joined = {}
+    sheet_count = 0
 
-    if ';' in first_list[1]:
-        compound_list = [i.strip() for i in first_list[1].split(';')]
-    else:
-        compound_list = [first_list[1].strip()]
+    for sheet_name, headers, rows in iter_sheets(csv_paths):
+        # Compile the sheet's column plan once
+        plan = compile_column_plan(headers)
+        logger.info("Sheet %s: %s block, %d columns", sheet_name, plan.block_name, len(headers))
+        sheet_count += 1
 
-    citation_dictionary = {}
-    citation_dictionary[f'{first_list[0]}'] = compound_list
-    print(f"Citation dictionary = {citation_dictionary}")
-    print(f'Compound list = {compound_list}')
+        for row, formatted in iter_formatted_rows(rows, plan):
+            joined.setdefault(standardize_doi(row[0]), []).append((row, plan, formatted))
 
+    logger.info("%d datasets to update from %d sheets", len(joined), sheet_count)
+    return joined
 
-    if row[header] != '':
-        if '+' in row[header]:
-            val_list = row[header].split('+')
-            value_list = []
-            for i in val_list:
-                value = i.split(';')
-                value_list.append(value)
-        else:
-            value_list = row[header].split(';')
-        print(f"Value list = {value_list}")
-    else:
-        value_list = []
 
-    counter = 0
-    list_of_list = []
 
-    for types in citation_dictionary[f'{first_list[0]}']:
-        populated_dictionary = {}
-        if counter >= len(value_list):
-            break
-        if value_list == [''] or value_list == []:
-            counter += 1
-            continue
+def process_dataset(doi, edits, scheduler, change_plan=None, publisher=None):
+    """
+    Fetch, lock-check and update a single dataset with all of its edits.
+
+    Runs on a DatasetWorkPool worker. Work for the same DOI is never processed
+    concurrently, so each unit sees the record left by the previous one. If the
+    dataset is locked, the unit is parked in the scheduler instead of blocking the
+    worker, and runs again (with a fresh fetch) once the lock clears.
+
+    Args:
+        doi (str): Dataset DOI (already standardized to doi:...)
+        edits (list): (row, plan, formatted) tuples to apply to this dataset
+        scheduler (LockScheduler): Where work for locked datasets is parked
+        change_plan (ChangePlanWriter): Write the changes here instead of sending them
+        publisher (PublishQueue): Where changed datasets are queued for publishing
+    """
+    # Planning sends nothing, so locks do not matter
+    if change_plan is not None:
+        plan_dataset(doi, edits, change_plan)
+        return
+
+    # Keep edits in order behind earlier work that is waiting on a lock
+    if scheduler.park_behind(doi, process_dataset, doi, edits, scheduler, None, publisher):
+        return
+
+    # A cached DOI -> id mapping lets a locked dataset be parked without downloading it
+    cache = get_dataset_cache()
+    known_id = cache.dataset_id(doi) if cache is not None else None
+    if known_id is not None and timed_check_lock(known_id) != True:
+        scheduler.park(doi, known_id, process_dataset, doi, edits, scheduler, None, publisher)
+        lock_logger.info("%s: locked - will try again once the lock clears", doi)
+        log_event('parked', doi=doi)
+        return
+
+    with run_metrics.timer('fetch'):
+        resp = get_dataset(doi, include_files=edits_need_files(edits))
+
+    if resp.status_code != 200:
+        logger.warning("%s: could not fetch dataset (status %s)", doi, resp.status_code)
+        log_event('dataset', doi=doi, outcome='fetch_failed', status=resp.status_code)
+        return
+
+    complete_record = resp.json()
+    dataset_id = complete_record['data']['id']
+    latest_version = complete_record['data']['latestVersion']
+    edit_logger.debug("Fetched %s: %s", doi, Lazy(json.dumps, complete_record))
+    status = True if dataset_id == known_id else timed_check_lock(dataset_id)
+
+    if status == True:
+        result = apply_dataset_edits(complete_record, latest_version, doi, edits)
+        if result.rejected > 0:
+            logger.warning("%s: %d row(s), %d of %d request(s) rejected by the server", doi, len(edits),
+                           result.rejected, result.accepted + result.rejected)
+            log_event('dataset', doi=doi, outcome='push_failed', rows=len(edits), fields=result.fields)
         else:
-            list_of_list = []
-            counter_2 = 0
-            for items in value_list:
-                val_setup = {}
-                if type(items) is list:
-                    count = 0
-                    for i in items:
-                        i = i.strip()
-                        if value_list[0] == 'REMOVE':
-                            i == ''
-                        primitive_dictionary = {}
-                        primitive_dictionary['typeName'] = compound_list[count].strip()
-                        primitive_dictionary['multiple'] = False
-                        primitive_dictionary['typeClass'] = "primitive"
-                        primitive_dictionary['value'] = i
-
-                        val_setup[compound_list[count].strip()] = primitive_dictionary
-                        count += 1
-                else:
-                    items = items.strip()
-                    if value_list[0] == 'REMOVE':
-                        items = ''
-                    primitive_dictionary = {}
-                    primitive_dictionary['typeName'] = compound_list[counter_2].strip()
-                    primitive_dictionary['multiple'] = False
-                    primitive_dictionary['typeClass'] = "primitive"
-                    primitive_dictionary['value'] = items
-
-                    populated_dictionary[compound_list[counter_2].strip()] = primitive_dictionary
-                    counter_2 += 1
-                if val_setup != {}:
-                    list_of_list.append(val_setup)
-        if val_setup == {}:
-            list_of_list.append(populated_dictionary)
-        counter += 1
-    if list_of_list == []:
-        print("NOT UPDATED IN THE RECORD")
-        return False
+            logger.info("%s: %d row(s), %d field(s) sent", doi, len(edits), result.fields)
+            log_event('dataset', doi=doi, outcome='updated' if result.accepted > 0 else 'unchanged',
+                      rows=len(edits), fields=result.fields)
+
+        # The cached record no longer matches the edited draft
+        if cache is not None:
+            cache.invalidate(doi)
+
+        # Only a draft the server accepted every write for is published; a partly
+        # applied one is left as a draft
+        if publisher is not None and result.accepted > 0 and result.rejected == 0:
+            publisher.mark(doi, dataset_id)
+
     else:
-        return list_of_list
+        scheduler.park(doi, dataset_id, process_dataset, doi, edits, scheduler, None, publisher)
+        lock_logger.info("%s: locked - will try again once the lock clears", doi)
+        log_event('parked', doi=doi)
 
 
 
+def timed_check_lock(dataset_id):
+    """Non-blocking check_lock, timed as the 'lock_check' phase."""
+    with run_metrics.timer('lock_check'):
+        return check_lock(dataset_id, 0)
 
 
-def file_loader():
+
+def plan_dataset(doi, edits, change_plan):
     """
-    Main entry point for processing CSV files and updating dataset metadata.
+    Fetch and format a dataset's edits, writing them to the change plan unsent.
 
-    Iterates through configured CSV files, reads each row, and updates
-    corresponding dataset metadata in Dataverse.
-    """
-    lock_status = 0
-    compilation_skipped_entries = []
-
-    for csv_path in file_directory:
-        df = pd.read_csv(csv_path)
-        headers = list(df.columns)
-        print(headers)
-
-        # Get metadata block configuration
-        block_info = xml_selecter(headers)
-        field_directory = block_info[0]
-        block_name = block_info[1]
-        master_lists = block_info[2]
-
-        with open(csv_path, newline='', encoding='utf-8-sig') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                print(row)
-                doi = row[headers[0]]
-
-                # Standardize DOI format
-                if 'https://doi.org/' in doi:
-                    doi = doi.replace('https://doi.org/', 'doi:')
-                print(doi)
-                resp = api_origin.get_dataset(doi, version="2.0")
-                print(resp.json())
-
-                if resp.status_code == 200:
-                    dataset_id = resp.json()['data']['id']
-                    complete_record = resp.json()
-                    latest_version = resp.json()['data']['latestVersion']
-                    status = check_lock(dataset_id, lock_status)
-
-                    if status == True:
-                        if master_lists == "use":
-                            update_terms_of_use(complete_record, latest_version, row, doi, headers)
-                            field_directory = 'NA'
-                            master_lists = "NA"
-                            block_name = "datasetVersion"
-                        else:
-                            # Update metadata
-                            update_metadata(latest_version, row, doi, headers, field_directory, master_lists, block_name)
-                    else:
-                        # Document data for update at end of task
-                        skipped_entry_data = [latest_version, row, doi, headers, field_directory, master_lists, block_name, dataset_id]
-                        compilation_skipped_entries.append(skipped_entry_data)
-                        print(f'SKIPPED ENTRY DUE TO LOCK ISSUE - WILL TRY AGAIN AT END OF TASK: {skipped_entry_data}')
-                        print()
-                        continue
+    Args:
+        doi (str): Dataset DOI (already standardized to doi:...)
+        edits (list): (row, plan, formatted) tuples to apply to this dataset
+        change_plan (ChangePlanWriter): Where the dataset's changes are written
+    """
+    with run_metrics.timer('fetch'):
+        resp = get_dataset(doi, include_files=edits_need_files(edits))
+
+    if resp.status_code != 200:
+        logger.warning("%s: could not fetch dataset (status %s)", doi, resp.status_code)
+        log_event('dataset', doi=doi, outcome='fetch_failed', status=resp.status_code)
+        return
+
+    complete_record = resp.json()
+    latest_version = complete_record['data']['latestVersion']
+    planned = apply_dataset_edits(complete_record, latest_version, doi, edits, change_plan).fields
+    logger.info("%s: %d row(s), %d field(s) planned", doi, len(edits), planned)
+    log_event('dataset', doi=doi, outcome='planned' if planned > 0 else 'unchanged', rows=len(edits), fields=planned)
+
+
+
+def apply_dataset_edits(complete_record, latest_version, doi, edits, change_plan=None):
+    """
+    Apply every edit for one dataset, sending all field changes in one request.
+
+    Terms-of-use rows replace the whole draft version, so they are applied first;
+    field edits from every other sheet are then collected in one change buffer and
+    pushed together. Rows of a variables sheet relabel variables of the dataset's
+    tabular files (see edit_variable_labels).
+
+    Args:
+        complete_record (dict): Full dataset JSON response
+        latest_version (dict): Latest version metadata from Dataverse
+        doi (str): Dataset DOI
+        edits (list): (row, plan, formatted) tuples to apply
+        change_plan (ChangePlanWriter): Write the changes here instead of sending them
+
+    Returns:
+        PushOutcome: Fields sent (or planned) in the editMetadata request, and the
+        requests the server accepted and rejected
+    """
+    change_buffer = ChangeBuffer()
+    record_fields = None
+    terms = []
+    variable_rows = []
+    files = latest_version.get('files') or []                                   # update_terms_of_use drops 'files' from the version
+    push = change_plan is None
+    accepted = rejected = 0
+
+    for row, plan, formatted in sorted(edits, key=lambda edit: not edit[1].is_terms):
+        edit_logger.debug("%s row: %s", doi, row)
+
+        if plan.block_name == 'variables':
+            variable_rows.append(row_as_dict(plan, row))
+        elif plan.is_terms:
+            with run_metrics.timer('terms_of_use'):
+                version, tab_file_ids = update_terms_of_use(complete_record, latest_version, row_as_dict(plan, row),
+                                                            doi, list(plan.headers), push=False)
+                if push and push_terms_of_use(version, doi, tab_file_ids):
+                    accepted += 1
+                elif push:
+                    rejected += 1
+            terms.append({'version': version, 'tab_files': tab_file_ids})
+        else:
+            with run_metrics.timer('format'):
+                # Index the record once, after any terms-of-use edit, and share it between sheets
+                if record_fields is None:
+                    record_fields = index_record_fields(latest_version)
+                update_metadata(latest_version, row, doi, plan, change_buffer, record_fields, formatted)
+
+    variables = []
+    if len(variable_rows) > 0:
+        with run_metrics.timer('variables'):
+            variables = edit_variable_labels(doi, files, variable_rows, push)
+
+    if not push:
+        with run_metrics.timer('plan_write'):
+            return PushOutcome(change_plan.write(complete_record, doi, change_buffer, terms, variables), 0, 0)
+
+    sent_variables = sum(1 for edit in variables if edit['sent'])
+    accepted += sent_variables
+    rejected += len(variables) - sent_variables
+    with run_metrics.timer('push'):
+        sent = push_change_buffer(change_buffer, doi)
+    if sent is None:
+        rejected += 1
+    elif sent > 0:
+        accepted += 1
+    return PushOutcome(len(change_buffer), accepted, rejected)
+
+
+
+class DatasetWorkPool:
+    """
+    Bounded worker pool that keeps work for the same dataset in order.
+
+    Work is partitioned by DOI: each DOI has its own queue that is drained by at most
+    one worker at a time, so edits to one dataset are applied in submission order
+    while different datasets run in parallel. `submit` blocks once `max_pending`
+    rows are queued, so the CSV reader never runs far ahead of the workers.
+
+    Args:
+        max_workers (int): Number of worker threads
+        max_pending (int): Maximum number of queued or running work items
+        on_idle (callable): Called with the DOI whenever its queue runs empty
+    """
+
+    def __init__(self, max_workers, max_pending, on_idle=None):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._lock = threading.Condition()
+        self._queues = {}                                                       # doi -> deque of (func, args, holds_slot)
+        self._outstanding = 0
+        self._on_idle = on_idle
+
+    def submit(self, doi, func, *args):
+        """Queue func(*args) behind any earlier work for the same DOI."""
+        self._slots.acquire()
+        self._enqueue(doi, func, args, True)
+
+    def resubmit(self, doi, func, *args):
+        """
+        Queue work without waiting for a free slot. Used to hand back parked work,
+        which must never block on the read-ahead limit.
+        """
+        self._enqueue(doi, func, args, False)
+
+    def _enqueue(self, doi, func, args, holds_slot):
+        with self._lock:
+            self._outstanding += 1
+            if doi in self._queues:
+                self._queues[doi].append((func, args, holds_slot))
+                return
+            self._queues[doi] = deque([(func, args, holds_slot)])
+        self._executor.submit(self._drain, doi)
+
+    def busy(self, doi):
+        """Whether work for this DOI is queued or running."""
+        with self._lock:
+            return doi in self._queues
+
+    def _drain(self, doi):
+        while True:
+            with self._lock:
+                queue = self._queues[doi]
+                if len(queue) == 0:
+                    del self._queues[doi]
+                    break
+                func, args, holds_slot = queue[0]
+
+            try:
+                func(*args)
+            except ErrorBudgetExhausted as e:
+                logger.error("%s: not updated - %s", doi, e)
+                log_event('dataset', doi=doi, outcome='skipped')
+            except BaseException:
+                # Defensive: whatever the submitted work raises, letting it escape
+                # would leave this DOI's queue behind with nobody draining it
+                logger.exception("Error while processing %s", doi)
+                log_event('dataset', doi=doi, outcome='error')
+            finally:
+                with self._lock:
+                    queue.popleft()
+                    self._outstanding -= 1
+                    self._lock.notify_all()
+                if holds_slot:
+                    self._slots.release()
+
+        if self._on_idle is not None:
+            self._on_idle(doi)
+
+    def wait(self):
+        """Block until every submitted work item has finished."""
+        with self._lock:
+            while self._outstanding > 0:
+                self._lock.wait()
+
+    def shutdown(self):
+        """Wait for outstanding work and stop the worker threads."""
+        self.wait()
+        self._executor.shutdown(wait=True)
+
+
+
+
+# ============================================================================
+# METADATA BLOCK SCHEMAS
+# ============================================================================
 
-                    # Optional: Auto-publish dataset
-                    # publish_dataset(doi)
+# Built-in field definitions of the standard metadata blocks, keyed by the block's
+# marker column. Used when no metadata_block_schema_path snapshot is available.
+METADATA_BLOCK_FIELDS = {
+    # Citation metadata block configuration
+    'citation': {
+        'title': {"typeName": "title", "multiple": False, "typeClass": "primitive", "value": ""},
+        'subtitle': {"typeName": "subtitle", "multiple": False, "typeClass": "primitive", "value": ""},
+        'alternativeTitle': {"typeName": "alternativeTitle", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'otherId': {"typeName": "otherId", "multiple": True, "typeClass": "compound", "value": [""]},
+        'author': {"typeName": "author", "multiple": True, "typeClass": "compound", "value": [""]},
+        'datasetContact': {"typeName": "datasetContact", "multiple": True, "typeClass": "compound", "value": [""]},
+        'dsDescription': {"typeName": "dsDescription", "multiple": True, "typeClass": "compound", "value": [""]},
+        'subject': {"typeName": "subject", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
+        'keyword': {"typeName": "keyword", "multiple": True, "typeClass": "compound", "value": [""]},
+        'topicClassification': {"typeName": "topicClassification", "multiple": True, "typeClass": "compound", "value": [""]},
+        'publication': {"typeName": "publication", "multiple": True, "typeClass": "compound", "value": [""]},
+        'notesText': {"typeName": "notesText", "multiple": False, "typeClass": "primitive", "value": ""},
+        'language': {"typeName": "language", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
+        'producer': {"typeName": "producer", "multiple": True, "typeClass": "compound", "value": [""]},
+        'productionDate': {"typeName": "productionDate", "multiple": False, "typeClass": "primitive", "value": ""},
+        'productionPlace': {"typeName": "productionPlace", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'contributor': {"typeName": "contributor", "multiple": True, "typeClass": "compound", "value": [""]},
+        'grantNumber': {"typeName": "grantNumber", "multiple": True, "typeClass": "compound", "value": [""]},
+        'distributor': {"typeName": "distributor", "multiple": True, "typeClass": "compound", "value": [""]},
+        'distributionDate': {"typeName": "distributionDate", "multiple": False, "typeClass": "primitive", "value": ""},
+        'depositor': {"typeName": "depositor", "multiple": False, "typeClass": "primitive", "value": ""},
+        'dateOfDeposit': {"typeName": "dateOfDeposit", "multiple": False, "typeClass": "primitive", "value": ""},
+        'timePeriodCovered': {"typeName": "timePeriodCovered", "multiple": True, "typeClass": "compound", "value": [""]},
+        'dateOfCollection': {"typeName": "dateOfCollection", "multiple": True, "typeClass": "compound", "value": [""]},
+        'kindOfData': {"typeName": "kindOfData", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'series': {"typeName": "series", "multiple": True, "typeClass": "compound", "value": [""]},
+        'software': {"typeName": "software", "multiple": True, "typeClass": "compound", "value": [""]},
+        'relatedMaterial': {"typeName": "relatedMaterial", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'relatedDatasets': {"typeName": "relatedDatasets", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'otherReferences': {"typeName": "otherReferences", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'dataSources': {"typeName": "dataSources", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'originOfSources': {"typeName": "originOfSources", "multiple": False, "typeClass": "primitive", "value": ""},
+        'characteristicOfSources': {"typeName": "characteristicOfSources", "multiple": False, "typeClass": "primitive", "value": ""},
+        'accessToSources': {"typeName": "accessToSources", "multiple": False, "typeClass": "primitive", "value": ""}
+    },
+
+    # Social science metadata block configuration
+    'socialscience': {
+        'unitOfAnalysis': {"typeName": "unitOfAnalysis", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'universe': {"typeName": "universe", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'timeMethod': {"typeName": "timeMethod", "multiple": False, "typeClass": "primitive", "value": ""},
+        'dataCollector': {"typeName": "dataCollector", "multiple": False, "typeClass": "primitive", "value": ""},
+        'collectorTraining': {"typeName": "collectorTraining", "multiple": False, "typeClass": "primitive", "value": ""},
+        'frequencyOfDataCollection': {"typeName": "frequencyOfDataCollection", "multiple": False, "typeClass": "primitive", "value": ""},
+        'samplingProcedure': {"typeName": "samplingProcedure", "multiple": False, "typeClass": "primitive", "value": ""},
+        'targetSampleSize': {"typeName": "targetSampleSize", "multiple": False, "typeClass": "compound", "value": ['']},
+        'deviationsFromSampleDesign': {"typeName": "deviationsFromSampleDesign", "multiple": False, "typeClass": "primitive", "value": ""},
+        'collectionMode': {"typeName": "collectionMode", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'researchInstrument': {"typeName": "researchInstrument", "multiple": False, "typeClass": "primitive", "value": ""},
+        'dataCollectionSituation': {"typeName": "dataCollectionSituation", "multiple": False, "typeClass": "primitive", "value": ""},
+        'actionsToMinimizeLoss': {"typeName": "actionsToMinimizeLoss", "multiple": False, "typeClass": "primitive", "value": ""},
+        'controlOperations': {"typeName": "controlOperations", "multiple": False, "typeClass": "primitive", "value": ""},
+        'weighting': {"typeName": "weighting", "multiple": False, "typeClass": "primitive", "value": ""},
+        'cleaningOperations': {"typeName": "cleaningOperations", "multiple": False, "typeClass": "primitive", "value": ""},
+        'datasetLevelErrorNotes': {"typeName": "datasetLevelErrorNotes", "multiple": False, "typeClass": "primitive", "value": ""},
+        'responseRate': {"typeName": "responseRate", "multiple": False, "typeClass": "primitive", "value": ""},
+        'samplingErrorEstimates': {"typeName": "samplingErrorEstimates", "multiple": False, "typeClass": "primitive", "value": ""},
+        'otherDataAppraisal': {"typeName": "otherDataAppraisal", "multiple": False, "typeClass": "primitive", "value": ""},
+        'socialScienceNotes': {"typeName": "socialScienceNotes", "multiple": False, "typeClass": "compound", "value": ['']}
+    },
+
+    # Geospatial metadata block configuration
+    'geospatial': {
+        'geographicCoverage': {"typeName": "geographicCoverage", "multiple": True, "typeClass": "compound", "value": [""]},
+        'geographicUnit': {"typeName": "geographicUnit", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'geographicBoundingBox': {"typeName": "geographicBoundingBox", "multiple": True, "typeClass": "compound", "value": []}
+    },
+
+    # Astrophysics metadata block configuration
+    'astrophysics': {
+        'astroType': {"typeName": "astroType", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
+        'astroFacility': {"typeName": "astroFacility", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'astroInstrument': {"typeName": "astroInstrument", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'astroObject': {"typeName": "astroObject", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'resolution.Spatial': {"typeName": "resolution.Spatial", "multiple": False, "typeClass": "primitive", "value": ""},
+        'resolution.Spectral': {"typeName": "resolution.Spectral", "multiple": False, "typeClass": "primitive", "value": ""},
+        'resolution.Temporal': {"typeName": "resolution.Temporal", "multiple": False, "typeClass": "primitive", "value": ""},
+        'coverage.Spectral.Bandpass': { "typeName": "coverage.Spectral.Bandpass", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'coverage.Spectral.CentralWavelength': {"typeName": "coverage.Spectral.CentralWavelength", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'coverage.Spectral.Wavelength': {"typeName": "coverage.Spectral.Wavelength", "multiple": True, "typeClass": "compound", "value": [""]},
+        'coverage.Temporal': {"typeName": "coverage.Temporal", "multiple": True, "typeClass": "compound", "value": []},
+        'coverage.Spatial': {"typeName": "coverage.Spatial", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'coverage.Depth': {"typeName": "coverage.Depth", "multiple": False, "typeClass": "primitive", "value": ""},
+        'coverage.ObjectDensity': {"typeName": "coverage.ObjectDensity", "multiple": False, "typeClass": "primitive", "value": ""},
+        'coverage.ObjectCount': {"typeName": "coverage.ObjectCount", "multiple": False, "typeClass": "primitive", "value": ""},
+        'coverage.SkyFraction': {"typeName": "coverage.SkyFraction", "multiple": False, "typeClass": "primitive", "value": ""},
+        'coverage.Polarization': {"typeName": "coverage.Polarization", "multiple": False, "typeClass": "primitive", "value": ""},
+        'redshiftType': {"typeName": "redshiftType", "multiple": False, "typeClass": "primitive", "value": ""},
+        'resolution.Redshift': {"typeName": "resolution.Redshift", "multiple": False, "typeClass": "primitive", "value": ""},
+        'coverage.RedshiftValue': {"typeName": "coverage.RedshiftValue", "multiple": True, "typeClass": "compound", "value": [""]}
+    },
+
+    # Biomedical metadata block configuration
+    'biomedical': {
+        'studyDesignType': {"typeName": "studyDesignType", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
+        'studyOtherDesignType': {"typeName": "studyOtherDesignType", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'studyFactorType': {"typeName": "studyFactorType", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
+        'studyOtherFactorType': {"typeName": "studyOtherFactorType", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'studyAssayOrganism': {"typeName": "studyAssayOrganism", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
+        'studyAssayOtherOrganism': {"typeName": "studyAssayOtherOrganism", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'studyAssayMeasurementType': {"typeName": "studyAssayMeasurementType", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
+        'studyAssayOtherMeasurmentType': {"typeName": "studyAssayOtherMeasurmentType", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'studyAssayTechnologyType': {"typeName": "studyAssayTechnologyType", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
+        'studyAssayOtherTechnologyType': {"typeName": "studyAssayOtherTechnologyType", "multiple": True, "typeClass": "primitive","value": [""]},
+        'studyAssayPlatform': {"typeName": "studyAssayPlatform", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
+        'studyAssayOtherPlatform': {"typeName": "studyAssayOtherPlatform", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'studyAssayCellType': {"typeName": "studyAssayCellType", "multiple": True, "typeClass": "primitive", "value": [""]}
+    },
+
+    # Journal metadata block configuration
+    'journal': {
+        'journalVolumeIssue': {"typeName": "journalVolumeIssue", "multiple": True, "typeClass": "compound", "value": [""]},
+        'journalArticleType': {"typeName": "journalArticleType", "multiple": False, "typeClass": "controlledVocabulary", "value": ""}
+    },
+
+    # Computational Work Flow metadata block configuration
+    'computationalworkflow': {
+        'workflowType': {"typeName": "workflowType", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
+        'workflowCodeRepository': {"typeName": "workflowCodeRepository", "multiple": True, "typeClass": "primitive", "value": [""]},
+        'workflowDocumentation': {"typeName": "workflowDocumentation", "multiple": True, "typeClass": "primitive", "value": [""]},
+    },
 
+    # 3D Objects metadata block configuration
+    '3dobjects': {
+        '3d3DTechnique': {"typeName": "3d3DTechnique", "multiple": False, "typeClass": "controlledVocabulary", "value": ""},
+        '3dEquipment': {"typeName": "3dEquipment", "multiple": False, "typeClass": "primitive", "value": ""},
+        '3dLightingSetup': {"typeName": "3dLightingSetup", "multiple": False, "typeClass": "controlledVocabulary", "value": ""},
+        '3dMasterFilePolygonCount': {"typeName": "3dMasterFilePolygonCount", "multiple": False, "typeClass": "primitive", "value": ""},
+        '3dExportedFilePolygonCount': {"typeName": "3dExportedFilePolygonCount", "multiple": True, "typeClass": "primitive", "value": [""]},
+        '3dExportedFileFormat': {"typeName": "3dExportedFileFormat", "multiple": False, "typeClass": "controlledVocabulary", "value": ""},
+        '3dAltText': { "typeName": "3dAltText", "multiple": False, "typeClass": "primitive", "value": ""},
+        '3dMaterialComposition': {"typeName": "3dMaterialComposition", "multiple": True, "typeClass": "primitive", "value": [""]},
+        '3dObjectDimensions': {'typeName': '3dObjectDimensions', "multiple": False, "typeClass": "compound", "value": [""]},
+        '3dHandling': {"typeName": "3dHandling", "multiple": False, "typeClass": "primitive", "value": ""}
+    }
+}
+
+
+BUILTIN_BLOCK_DISPLAY_NAMES = {
+    'citation': "Citation Metadata",
+    'socialscience': "Social Science and Humanities Metadata",
+    'geospatial': "Geospatial Metadata",
+    'astrophysics': "Astronomy and Astrophysics Metadata",
+    'biomedical': "Life Sciences Metadata",
+    'journal': "Journal Metadata",
+    'computationalworkflow': "Computational Workflow Metadata",
+    '3dobjects': "3D Objects Metadata",
+}
+
+SCHEMA_SNAPSHOT_FORMAT = 1                                                      # Bumped when the snapshot layout changes
+
+# Definition of one metadata field. children are the sub-field names of a compound
+# field, vocabulary the allowed values of a controlled vocabulary field, and parent
+# the compound field a sub-field belongs to (None for top-level fields). template is
+# the field as it is added to a record; treat it as read-only.
+FieldSchema = namedtuple('FieldSchema', ['name', 'block', 'type_class', 'multiple', 'children', 'vocabulary', 'parent', 'template'])
+
+
+class SchemaRegistry:
+    """
+    Metadata block and field definitions, indexed by block and by field name.
 
-    if len(compilation_skipped_entries) > 0:
-        print()
-        print('UPDATING METADATA OF LOCKED DATASETS - THIS PROCESS MAY TAKE A WHILE IF THE DATASET IS STILL LOCKED')
-        print()
+    Everything is indexed once when the registry is built, so lookups are dict
+    lookups. Field names are unique across blocks in Dataverse, so one index covers
+    top-level and child fields of every block.
 
-        for locked_sets in compilation_skipped_entries:
-            lock_status = 1
+    Args:
+        blocks (list): Block definitions in the form returned by /api/metadatablocks/{name}
+        source (str): Where the definitions came from, for log messages
+    """
 
-            latest_version = locked_sets[0]
-            row = locked_sets[1]
-            doi = locked_sets[2]
-            headers = locked_sets[3]
-            field_directory = locked_sets[4]
-            master_lists = locked_sets[5]
-            block_name = locked_sets[6]
-            dataset_id = locked_sets[7]
+    def __init__(self, blocks, source):
+        self.source = source
+        self.display_names = {}                                                 # block -> displayName
+        self.fields = {}                                                        # field name -> FieldSchema
+        self._block_fields = {}                                                 # block -> {top-level field name: template}
+        self._block_configs = {}                                                # block -> [field_directory, block_name, master_lists]
+
+        for block in blocks:
+            name = block['name']
+            fields = list((block.get('fields') or {}).values())
+            self.display_names[name] = block.get('displayName', name)
+
+            # Some Dataverse versions also list child fields next to their parent
+            child_names = {child for field in fields for child in (field.get('childFields') or {})}
+            self._block_fields[name] = {
+                field['name']: self._add_field(field, name, None).template
+                for field in fields if field['name'] not in child_names
+            }
+
+    def _add_field(self, field, block, parent):
+        children = field.get('childFields') or {}
+        for child in children.values():
+            self._add_field(child, block, field['name'])
+
+        multiple = bool(field.get('multiple'))
+        template = {"typeName": field['name'], "multiple": multiple, "typeClass": field['typeClass'],
+                    "value": [""] if multiple else ""}
+        schema = FieldSchema(field['name'], block, field['typeClass'], multiple, tuple(children),
+                             frozenset(field.get('controlledVocabularyValues') or ()), parent, template)
+        self.fields[field['name']] = schema
+        return schema
+
+    @classmethod
+    def builtin(cls):
+        """Registry of the built-in METADATA_BLOCK_FIELDS."""
+        blocks = [{'name': name, 'displayName': BUILTIN_BLOCK_DISPLAY_NAMES.get(name, name),
+                   'fields': {field_name: {'name': field_name, 'typeClass': field['typeClass'], 'multiple': field['multiple']}
+                              for field_name, field in fields.items()}}
+                  for name, fields in METADATA_BLOCK_FIELDS.items()]
+        return cls(blocks, 'built-in definitions')
+
+    @classmethod
+    def from_snapshot(cls, path):
+        """
+        Load a snapshot written by refresh_schema_registry.
+
+        Raises:
+            ValueError: If the snapshot was written in another format
+        """
+        with open(path, encoding='utf-8') as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        if snapshot.get('format') != SCHEMA_SNAPSHOT_FORMAT:
+            raise ValueError(f"{path}: unsupported schema snapshot format {snapshot.get('format')} "
+                             f"(expected {SCHEMA_SNAPSHOT_FORMAT}) - refresh the snapshot")
+        return cls(snapshot['blocks'], f"{path} (Dataverse {snapshot.get('dataverseVersion')}, {snapshot.get('fetched')})")
+
+    @property
+    def block_names(self):
+        """Block names, in the order they are matched against marker columns."""
+        return tuple(self._block_fields)
+
+    def field(self, name):
+        """FieldSchema of a field, or None if no block defines it."""
+        return self.fields.get(name)
+
+    def block_fields(self, block_name):
+        """Top-level field templates of a block, keyed by field name."""
+        return self._block_fields[block_name]
+
+    def block_shell(self, block_name):
+        """An empty metadata block, to add to a record that does not have the block yet."""
+        return {"displayName": self.display_names[block_name], "name": block_name, "fields": []}
+
+    def block_config(self, block_name):
+        """
+        Field templates and field classes of a block, built on first use.
+
+        Returns:
+            list: [field_directory, block_name, master_lists] (see xml_selecter)
+        """
+        config = self._block_configs.get(block_name)
+        if config is None:
+            field_directory = self._block_fields[block_name]
+
+            # Build master lists of field types
+            primitive_fields = []
+            compound_fields = []
+            controlled_vocab_fields = []
+
+            for field_name, field_def in field_directory.items():
+                if field_def['typeClass'] == 'primitive':
+                    primitive_fields.append(field_name)
+                elif field_def['typeClass'] == 'compound':
+                    compound_fields.append(field_name)
+                elif field_def['typeClass'] == 'controlledVocabulary':
+                    #controlled_vocab_fields.append(field_name)
+                    primitive_fields.append(field_name) # CONTROLLED VOCAB ADDED TO PRIMITIVE LIST - WILL BE UPDATED IN THE FUTURE
+
+            master_lists = [primitive_fields, compound_fields, controlled_vocab_fields]
+            config = self._block_configs[block_name] = [field_directory, block_name, master_lists]
+        return config
+
+
+_schema_registry = None
+_schema_registry_lock = threading.Lock()
+
+
+def get_schema_registry():
+    """
+    Return the shared SchemaRegistry, loaded from metadata_block_schema_path on first
+    use (or built from METADATA_BLOCK_FIELDS when there is no snapshot).
+    """
+    global _schema_registry
 
-            status = check_lock(dataset_id, lock_status)
+    if _schema_registry is None:
+        with _schema_registry_lock:
+            if _schema_registry is None:
+                if metadata_block_schema_path is not None and os.path.exists(metadata_block_schema_path):
+                    registry = SchemaRegistry.from_snapshot(metadata_block_schema_path)
+                else:
+                    if metadata_block_schema_path is not None:
+                        logger.warning("No metadata block schema snapshot at %s - using the built-in definitions "
+                                       "(set refresh_metadata_block_schema = True to download one)", metadata_block_schema_path)
+                    registry = SchemaRegistry.builtin()
+                logger.debug("Metadata block schemas from %s", registry.source)
+                _schema_registry = registry
+    return _schema_registry
 
-            if status == True:
-                update_metadata(latest_version, row, doi, headers, field_directory, master_lists, block_name)
 
-                # Optional: Auto-publish dataset
-                # publish_dataset(doi)
+def refresh_schema_registry():
+    """
+    Download every block definition from /api/metadatablocks, write them to
+    metadata_block_schema_path (if set) and make them the shared registry.
 
+    Returns:
+        SchemaRegistry: The refreshed registry
 
+    Raises:
+        RuntimeError: If the block definitions could not be downloaded
+    """
+    global _schema_registry
+
+    resp = dataverse_get(f"{url_base_origin}/api/metadatablocks")
+    if resp.status_code != 200:
+        raise RuntimeError(f"Could not list metadata blocks (status {resp.status_code})")
+
+    blocks = []
+    for summary in resp.json()['data']:
+        block_resp = dataverse_get(f"{url_base_origin}/api/metadatablocks/{summary['name']}")
+        if block_resp.status_code != 200:
+            raise RuntimeError(f"Could not fetch metadata block {summary['name']} (status {block_resp.status_code})")
+        blocks.append(block_resp.json()['data'])
+
+    version_resp = dataverse_get(f"{url_base_origin}/api/info/version")
+    version = version_resp.json()['data'].get('version') if version_resp.status_code == 200 else None
+
+    snapshot = {
+        'format': SCHEMA_SNAPSHOT_FORMAT,
+        'server': url_base_origin,
+        'dataverseVersion': version,
+        'fetched': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'blocks': blocks,
+    }
+    source = f"{url_base_origin} (Dataverse {version}, {snapshot['fetched']})"
+
+    if metadata_block_schema_path is not None:
+        # Written to a temporary file first so an interrupted refresh keeps the old snapshot
+        temporary_path = metadata_block_schema_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.replace(temporary_path, metadata_block_schema_path)
+        source = metadata_block_schema_path
+
+    registry = SchemaRegistry(blocks, source)
+    with _schema_registry_lock:
+        _schema_registry = registry
+    logger.info("Metadata block schemas refreshed: %d block(s), %d field(s) from %s",
+                len(registry.block_names), len(registry.fields), source)
+    return registry
 
 
 def xml_selecter(headers):
@@ -660,7 +3566,9 @@ def xml_selecter(headers):
 
     Determines which metadata block (citation, socialscience, etc.) to use
     based on markers in the CSV headers and returns the corresponding
-    field definitions and configurations.
+    field definitions and configurations from the schema registry (see
+    get_schema_registry). The configuration for each block is built once and
+    shared, so the returned dicts and lists must not be modified.
 
     Args:
         headers (list): CSV column headers
@@ -668,270 +3576,338 @@ def xml_selecter(headers):
     Returns:
         list: [field_directory, block_name, master_lists]
     """
-    # Citation metadata block configuration
-    if 'citation' in headers:
-        field_directory = {
-            'title': {"typeName": "title", "multiple": False, "typeClass": "primitive", "value": ""},
-            'subtitle': {"typeName": "subtitle", "multiple": False, "typeClass": "primitive", "value": ""},
-            'alternativeTitle': {"typeName": "alternativeTitle", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'otherId': {"typeName": "otherId", "multiple": True, "typeClass": "compound", "value": [""]},
-            'author': {"typeName": "author", "multiple": True, "typeClass": "compound", "value": [""]},
-            'datasetContact': {"typeName": "datasetContact", "multiple": True, "typeClass": "compound", "value": [""]},
-            'dsDescription': {"typeName": "dsDescription", "multiple": True, "typeClass": "compound", "value": [""]},
-            'subject': {"typeName": "subject", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
-            'keyword': {"typeName": "keyword", "multiple": True, "typeClass": "compound", "value": [""]},
-            'topicClassification': {"typeName": "topicClassification", "multiple": True, "typeClass": "compound", "value": [""]},
-            'publication': {"typeName": "publication", "multiple": True, "typeClass": "compound", "value": [""]},
-            'notesText': {"typeName": "notesText", "multiple": False, "typeClass": "primitive", "value": ""},
-            'language': {"typeName": "language", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
-            'producer': {"typeName": "producer", "multiple": True, "typeClass": "compound", "value": [""]},
-            'productionDate': {"typeName": "productionDate", "multiple": False, "typeClass": "primitive", "value": ""},
-            'productionPlace': {"typeName": "productionPlace", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'contributor': {"typeName": "contributor", "multiple": True, "typeClass": "compound", "value": [""]},
-            'grantNumber': {"typeName": "grantNumber", "multiple": True, "typeClass": "compound", "value": [""]},
-            'distributor': {"typeName": "distributor", "multiple": True, "typeClass": "compound", "value": [""]},
-            'distributionDate': {"typeName": "distributionDate", "multiple": False, "typeClass": "primitive", "value": ""},
-            'depositor': {"typeName": "depositor", "multiple": False, "typeClass": "primitive", "value": ""},
-            'dateOfDeposit': {"typeName": "dateOfDeposit", "multiple": False, "typeClass": "primitive", "value": ""},
-            'timePeriodCovered': {"typeName": "timePeriodCovered", "multiple": True, "typeClass": "compound", "value": [""]},
-            'dateOfCollection': {"typeName": "dateOfCollection", "multiple": True, "typeClass": "compound", "value": [""]},
-            'kindOfData': {"typeName": "kindOfData", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'series': {"typeName": "series", "multiple": True, "typeClass": "compound", "value": [""]},
-            'software': {"typeName": "software", "multiple": True, "typeClass": "compound", "value": [""]},
-            'relatedMaterial': {"typeName": "relatedMaterial", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'relatedDatasets': {"typeName": "relatedDatasets", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'otherReferences': {"typeName": "otherReferences", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'dataSources': {"typeName": "dataSources", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'originOfSources': {"typeName": "originOfSources", "multiple": False, "typeClass": "primitive", "value": ""},
-            'characteristicOfSources': {"typeName": "characteristicOfSources", "multiple": False, "typeClass": "primitive", "value": ""},
-            'accessToSources': {"typeName": "accessToSources", "multiple": False, "typeClass": "primitive", "value": ""}
-        }
-        block_name = 'citation'
-
-
-    # Social science metadata block configuration
-    elif 'socialscience' in headers:
-        field_directory = {
-            'unitOfAnalysis': {"typeName": "unitOfAnalysis", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'universe': {"typeName": "universe", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'timeMethod': {"typeName": "timeMethod", "multiple": False, "typeClass": "primitive", "value": ""},
-            'dataCollector': {"typeName": "dataCollector", "multiple": False, "typeClass": "primitive", "value": ""},
-            'collectorTraining': {"typeName": "collectorTraining", "multiple": False, "typeClass": "primitive", "value": ""},
-            'frequencyOfDataCollection': {"typeName": "frequencyOfDataCollection", "multiple": False, "typeClass": "primitive", "value": ""},
-            'samplingProcedure': {"typeName": "samplingProcedure", "multiple": False, "typeClass": "primitive", "value": ""},
-            'targetSampleSize': {"typeName": "targetSampleSize", "multiple": False, "typeClass": "compound", "value": ['']},
-            'deviationsFromSampleDesign': {"typeName": "deviationsFromSampleDesign", "multiple": False, "typeClass": "primitive", "value": ""},
-            'collectionMode': {"typeName": "collectionMode", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'researchInstrument': {"typeName": "researchInstrument", "multiple": False, "typeClass": "primitive", "value": ""},
-            'dataCollectionSituation': {"typeName": "dataCollectionSituation", "multiple": False, "typeClass": "primitive", "value": ""},
-            'actionsToMinimizeLoss': {"typeName": "actionsToMinimizeLoss", "multiple": False, "typeClass": "primitive", "value": ""},
-            'controlOperations': {"typeName": "controlOperations", "multiple": False, "typeClass": "primitive", "value": ""},
-            'weighting': {"typeName": "weighting", "multiple": False, "typeClass": "primitive", "value": ""},
-            'cleaningOperations': {"typeName": "cleaningOperations", "multiple": False, "typeClass": "primitive", "value": ""},
-            'datasetLevelErrorNotes': {"typeName": "datasetLevelErrorNotes", "multiple": False, "typeClass": "primitive", "value": ""},
-            'responseRate': {"typeName": "responseRate", "multiple": False, "typeClass": "primitive", "value": ""},
-            'samplingErrorEstimates': {"typeName": "samplingErrorEstimates", "multiple": False, "typeClass": "primitive", "value": ""},
-            'otherDataAppraisal': {"typeName": "otherDataAppraisal", "multiple": False, "typeClass": "primitive", "value": ""},
-            'socialScienceNotes': {"typeName": "socialScienceNotes", "multiple": False, "typeClass": "compound", "value": ['']}
-        }
-        block_name = 'socialscience'
-
-
-    # Geospatial metadata block configuration
-    elif 'geospatial' in headers:
-        field_directory = {
-            'geographicCoverage': {"typeName": "geographicCoverage", "multiple": True, "typeClass": "compound", "value": [""]},
-            'geographicUnit': {"typeName": "geographicUnit", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'geographicBoundingBox': {"typeName": "geographicBoundingBox", "multiple": True, "typeClass": "compound", "value": []}
-        }
-        block_name = 'geospatial'
-
+    registry = get_schema_registry()
+    for block_name in registry.block_names:
+        if block_name in headers:
+            return registry.block_config(block_name)
 
-    # Astrophysics metadata block configuration
-    elif 'astrophysics' in headers:
-        field_directory = {
-            'astroType': {"typeName": "astroType", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
-            'astroFacility': {"typeName": "astroFacility", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'astroInstrument': {"typeName": "astroInstrument", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'astroObject': {"typeName": "astroObject", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'resolution.Spatial': {"typeName": "resolution.Spatial", "multiple": False, "typeClass": "primitive", "value": ""},
-            'resolution.Spectral': {"typeName": "resolution.Spectral", "multiple": False, "typeClass": "primitive", "value": ""},
-            'resolution.Temporal': {"typeName": "resolution.Temporal", "multiple": False, "typeClass": "primitive", "value": ""},
-            'coverage.Spectral.Bandpass': { "typeName": "coverage.Spectral.Bandpass", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'coverage.Spectral.CentralWavelength': {"typeName": "coverage.Spectral.CentralWavelength", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'coverage.Spectral.Wavelength': {"typeName": "coverage.Spectral.Wavelength", "multiple": True, "typeClass": "compound", "value": [""]},
-            'coverage.Temporal': {"typeName": "coverage.Temporal", "multiple": True, "typeClass": "compound", "value": []},
-            'coverage.Spatial': {"typeName": "coverage.Spatial", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'coverage.Depth': {"typeName": "coverage.Depth", "multiple": False, "typeClass": "primitive", "value": ""},
-            'coverage.ObjectDensity': {"typeName": "coverage.ObjectDensity", "multiple": False, "typeClass": "primitive", "value": ""},
-            'coverage.ObjectCount': {"typeName": "coverage.ObjectCount", "multiple": False, "typeClass": "primitive", "value": ""},
-            'coverage.SkyFraction': {"typeName": "coverage.SkyFraction", "multiple": False, "typeClass": "primitive", "value": ""},
-            'coverage.Polarization': {"typeName": "coverage.Polarization", "multiple": False, "typeClass": "primitive", "value": ""},
-            'redshiftType': {"typeName": "redshiftType", "multiple": False, "typeClass": "primitive", "value": ""},
-            'resolution.Redshift': {"typeName": "resolution.Redshift", "multiple": False, "typeClass": "primitive", "value": ""},
-            'coverage.RedshiftValue': {"typeName": "coverage.RedshiftValue", "multiple": True, "typeClass": "compound", "value": [""]}
-        }
-        block_name = 'astrophysics'
+    if 'terms' in headers:
+        return ["terms", "of", "use"]
+    if 'variables' in headers:
+        return ["variables", "of", "ddi"]
+    raise ValueError(f"No metadata block marker column found in headers: {headers}")
 
 
-    # Biomedical metadata block configuration
-    elif 'biomedical' in headers:
-        field_directory = {
-            'studyDesignType': {"typeName": "studyDesignType", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
-            'studyOtherDesignType': {"typeName": "studyOtherDesignType", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'studyFactorType': {"typeName": "studyFactorType", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
-            'studyOtherFactorType': {"typeName": "studyOtherFactorType", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'studyAssayOrganism': {"typeName": "studyAssayOrganism", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
-            'studyAssayOtherOrganism': {"typeName": "studyAssayOtherOrganism", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'studyAssayMeasurementType': {"typeName": "studyAssayMeasurementType", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
-            'studyAssayOtherMeasurmentType': {"typeName": "studyAssayOtherMeasurmentType", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'studyAssayTechnologyType': {"typeName": "studyAssayTechnologyType", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
-            'studyAssayOtherTechnologyType': {"typeName": "studyAssayOtherTechnologyType", "multiple": True, "typeClass": "primitive","value": [""]},
-            'studyAssayPlatform': {"typeName": "studyAssayPlatform", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
-            'studyAssayOtherPlatform': {"typeName": "studyAssayOtherPlatform", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'studyAssayCellType': {"typeName": "studyAssayCellType", "multiple": True, "typeClass": "primitive", "value": [""]}
-        }
-        block_name = 'biomedical'
 
 
-    # Journal metadata block configuration
-    elif 'journal' in headers:
-        field_directory = {
-            'journalVolumeIssue': {"typeName": "journalVolumeIssue", "multiple": True, "typeClass": "compound", "value": [""]},
-            'journalArticleType': {"typeName": "journalArticleType", "multiple": False, "typeClass": "controlledVocabulary", "value": ""}
-        }
-        block_name = 'journal'
+# One compiled column of a sheet: where its value sits in a row tuple, which field it
+# edits and how its cells are formatted. kind is 'doi', 'primitive', 'compound',
+# 'marker' or 'unknown'; template is the block's field definition (None if unknown).
+ColumnSpec = namedtuple('ColumnSpec', ['index', 'header', 'field_name', 'kind', 'children', 'multiple', 'template'])
 
+# Compiled, immutable description of a whole sheet
+SheetPlan = namedtuple('SheetPlan', ['headers', 'block_name', 'columns', 'is_terms'])
 
-    # Computational Work Flow metadata block configuration
-    elif 'computationalworkflow' in headers:
-        field_directory = {
-            'workflowType': {"typeName": "workflowType", "multiple": True, "typeClass": "controlledVocabulary", "value": [""]},
-            'workflowCodeRepository': {"typeName": "workflowCodeRepository", "multiple": True, "typeClass": "primitive", "value": [""]},
-            'workflowDocumentation': {"typeName": "workflowDocumentation", "multiple": True, "typeClass": "primitive", "value": [""]},
-        }
-        block_name = 'computationalworkflow'
 
+def compile_column_plan(headers):
+    """
+    Compile a sheet's headers into a column plan, once per sheet.
 
-    # 3D Objects metadata block configuration
-    elif '3dobjects' in headers:
-        field_directory = {
-            '3d3DTechnique': {"typeName": "3d3DTechnique", "multiple": False, "typeClass": "controlledVocabulary", "value": ""},
-            '3dEquipment': {"typeName": "3dEquipment", "multiple": False, "typeClass": "primitive", "value": ""},
-            '3dLightingSetup': {"typeName": "3dLightingSetup", "multiple": False, "typeClass": "controlledVocabulary", "value": ""},
-            '3dMasterFilePolygonCount': {"typeName": "3dMasterFilePolygonCount", "multiple": False, "typeClass": "primitive", "value": ""},
-            '3dExportedFilePolygonCount': {"typeName": "3dExportedFilePolygonCount", "multiple": True, "typeClass": "primitive", "value": [""]},
-            '3dExportedFileFormat': {"typeName": "3dExportedFileFormat", "multiple": False, "typeClass": "controlledVocabulary", "value": ""},
-            '3dAltText': { "typeName": "3dAltText", "multiple": False, "typeClass": "primitive", "value": ""},
-            '3dMaterialComposition': {"typeName": "3dMaterialComposition", "multiple": True, "typeClass": "primitive", "value": [""]},
-            '3dObjectDimensions': {'typeName': '3dObjectDimensions', "multiple": False, "typeClass": "compound", "value": [""]},
-            '3dHandling': {"typeName": "3dHandling", "multiple": False, "typeClass": "primitive", "value": ""}
-        }
-        block_name = '3dobjects'
+    Each header is parsed a single time into its parent field name, compound
+    sub-field names, field class and multiplicity, so formatting a row only has
+    to split cell values.
 
-    elif 'terms' in headers:
-        return ["terms", "of", "use"]
+    Args:
+        headers (list): CSV column headers
 
+    Returns:
+        SheetPlan: The sheet's headers, metadata block and ColumnSpec per column
+    """
+    field_directory, block_name, master_lists = xml_selecter(headers)
+
+    if master_lists == "use":
+        return SheetPlan(tuple(headers), 'terms', (), True)
+    if master_lists == "ddi":
+        return SheetPlan(tuple(headers), 'variables', (), False)
+
+    columns = []
+    for index, header in enumerate(headers):
+        field_name = header.split(':')[0].strip()
+        template = field_directory.get(field_name)
+
+        if index == 0:
+            kind = 'doi'
+        elif field_name in master_lists[0]:
+            kind = 'primitive'
+        elif field_name in master_lists[1]:
+            kind = 'compound'
+        elif field_name == block_name:
+            kind = 'marker'
+        else:
+            kind = 'unknown'
 
-    # Build master lists of field types
-    master_lists = []
-    primitive_fields = []
-    compound_fields = []
-    controlled_vocab_fields = []
+        children = parse_compound_children(header) if kind == 'compound' else ()
+        multiple = template['multiple'] if template is not None else False
+        columns.append(ColumnSpec(index, header, field_name, kind, children, multiple, template))
 
-    for field_name, field_def in field_directory.items():
-        if field_def['typeClass'] == 'primitive':
-            primitive_fields.append(field_name)
-        elif field_def['typeClass'] == 'compound':
-            compound_fields.append(field_name)
-        elif field_def['typeClass'] == 'controlledVocabulary':
-            #controlled_vocab_fields.append(field_name)
-            primitive_fields.append(field_name) # CONTROLLED VOCAB ADDED TO PRIMITIVE LIST - WILL BE UPDATED IN THE FUTURE
+    return SheetPlan(tuple(headers), block_name, tuple(columns), False)
 
-    master_lists = [primitive_fields, compound_fields, controlled_vocab_fields]
-    print(master_lists)
-    print(master_lists[1])
 
-    return [field_directory, block_name, master_lists]
+def row_as_dict(plan, row):
+    """Header -> value view of a row tuple, for code that works on named columns."""
+    return dict(zip(plan.headers, row))
 
 
 
 
 def metadatablock_generator(block):
+    """
+    Empty metadata block for a record that does not have the block yet.
 
-    if block == 'socialscience':
-        block_directory = {"socialscience": {"displayName": "Social Science and Humanities Metadata", "name": "socialscience", "fields": []}}
-    elif block == 'geospatial':
-        block_directory = {"geospatial": {"displayName": "Geospatial Metadata", "name": "geospatial", "fields": []}}
-    elif block == 'astrophysics':
-        block_directory = {"astrophysics": {"displayName": "Astronomy and Astrophysics Metadata", "name": "astrophysics", "fields": []}}
-    elif block == 'biomedical':
-        block_directory = {"biomedical": {"displayName": "Life Sciences Metadata", "name": "biomedical", "fields": []}}
-    elif block == 'journal':
-        block_directory = {"journal": {"displayName": "Journal Metadata", "name": "journal", "fields": []}}
-    elif block == 'computationalworkflow':
-        block_directory = {"computationalworkflow": {"displayName": "Computational Workflow Metadata", "name": "computationalworkflow", "fields": []}}
-    elif block == '3dobjects':
-        block_directory = {"3dobjects": {"displayName": "3D Objects Metadata", "name": "3dobjects", "fields": []}}
+    Args:
+        block (str): Block name
 
-    return block_directory
+    Returns:
+        dict: {block: {"displayName": ..., "name": block, "fields": []}}
+    """
+    return {block: get_schema_registry().block_shell(block)}
 
 
 
 def API_push_terms_of_use(field, doi):
-    print(json.dumps(field))
+    payload = json.dumps(field)
     url = f'{url_base_origin}/api/datasets/:persistentId/versions/:draft?persistentId={doi}&replace=true'
-    print(url)
+    terms_logger.debug("PUT %s %s", url, payload)
 
-    resp = requests.put(url, data=json.dumps(field), headers=headers_origin)
-    print(resp.json())
-    print(resp.status_code)
-    print()
+    resp = dataverse_put(url, data=payload)
+    if resp.status_code != 200:
+        terms_logger.warning("Terms of use update failed for %s: %s %s", doi, resp.status_code, resp.text)
+    else:
+        terms_logger.debug("Terms of use updated for %s", doi)
+    log_event('request', doi=doi, endpoint='versions/:draft', status=resp.status_code)
     
-    return True
+    return resp.status_code == 200
 
 
 
-def API_push(field, doi):
+def API_push(fields, doi):
     """
     Push metadata updates to the Dataverse API.
 
-    Sends a PUT request to update dataset metadata with the provided field changes.
+    Sends a single PUT request to update dataset metadata with all of the provided
+    field changes, wrapped in a {"fields": [...]} payload.
 
     Args:
-        field (dict): Field data to update
+        fields (list): Formatted field dictionaries to update
         doi (str): Dataset DOI
+
+    Returns:
+        bool: True if the update was accepted, False otherwise
     """
-    print(json.dumps(field))
+    payload = json.dumps({'fields': fields})
     url = f'{url_base_origin}/api/datasets/:persistentId/editMetadata?persistentId={doi}&replace=true'
-    print(url)
+    edit_logger.debug("PUT %s %s", url, payload)
 
-    resp = requests.put(url, data=json.dumps(field), headers=headers_origin)
-    print(resp.json())
-    print(resp.status_code)
-    print()
+    resp = dataverse_put(url, data=payload)
+    if resp.status_code != 200:
+        edit_logger.warning("editMetadata failed for %s: %s %s", doi, resp.status_code, resp.text)
+    else:
+        edit_logger.debug("editMetadata accepted for %s", doi)
+    log_event('request', doi=doi, endpoint='editMetadata', status=resp.status_code, fields=len(fields))
 
+    return resp.status_code == 200
 
 
-def publish_dataset(doi):
-    """
-    Publish dataset with a minor version increment.
 
-    Optional function to automatically publish datasets after metadata updates.
+# ============================================================================
+# PUBLISHING
+# ============================================================================
+
+def publish_dataset(doi, version_type='minor'):
+    """
+    Publish a dataset's draft.
 
     Args:
         doi (str): Dataset DOI
+        version_type (str): 'minor' or 'major' version increment
 
     Returns:
-        int: HTTP status code from the publish operation
+        int: HTTP status code from the publish operation (202 while Dataverse
+        finishes publishing in the background)
     """
-    resp = api_origin.publish_dataset(doi, "minor")
+    url = f'{url_base_origin}/api/datasets/:persistentId/actions/:publish'
+    resp = dataverse_post(url, params={'persistentId': doi, 'type': version_type})
+    if resp.status_code not in (200, 202):
+        logger.warning("%s: publish failed (status %s): %s", doi, resp.status_code, resp.text[:500])
     return resp.status_code
 
 
+
+class PublishQueue:
+    """
+    Publish stage that runs next to the edit workers.
+
+    Workers mark a dataset once they changed it; when the edit pool has no more
+    work for that DOI (see DatasetWorkPool on_idle) it is queued on its own small
+    pool. A dataset that is locked, typically by the edit that was just sent, is
+    parked in a LockScheduler of its own, so waiting to publish never holds up an
+    edit. A DOI edited again before it was published is published once.
+
+    Args:
+        edit_pool (DatasetWorkPool): Pool running the edits
+        edit_scheduler (LockScheduler): Where edits for locked datasets are parked
+        workers (int): Datasets published at once
+        deadline (float): Seconds to wait for a locked dataset before giving up
+        version_type (str): 'minor' or 'major'
+    """
+
+    def __init__(self, edit_pool, edit_scheduler, workers, deadline, version_type):
+        self._edit_pool = edit_pool
+        self._edit_scheduler = edit_scheduler
+        self._pool = DatasetWorkPool(workers, workers)
+        self._scheduler = LockScheduler(self._pool, deadline)
+        self._lock = threading.Lock()
+        self._edited = {}                                                       # doi -> dataset id, changed since last published
+        self.version_type = version_type
+        self.outcomes = {}                                                      # doi -> outcome of its last publish
+
+    def mark(self, doi, dataset_id):
+        """Record that a dataset was changed and should be published."""
+        with self._lock:
+            self._edited[doi] = dataset_id
+
+    def dataset_idle(self, doi):
+        """Queue a changed dataset once the edit pool is done with it."""
+        with self._lock:
+            if doi not in self._edited:
+                return
+        # Not bounded by a read-ahead slot: an edit worker must never wait here
+        self._pool.resubmit(doi, self._publish, doi)
+
+    def _publish(self, doi):
+        # Later edits queue the DOI again when they finish
+        if self._edit_scheduler.is_parked(doi) or self._edit_pool.busy(doi):
+            return
+        if self._scheduler.park_behind(doi, self._publish, doi):
+            return
+
+        with self._lock:
+            dataset_id = self._edited.get(doi)
+        if dataset_id is None:                                                  # Already published
+            return
+
+        if timed_check_lock(dataset_id) != True:
+            self._scheduler.park(doi, dataset_id, self._publish, doi)
+            lock_logger.info("%s: locked - will publish once the lock clears", doi)
+            return
+
+        with self._lock:
+            self._edited.pop(doi, None)
+        with run_metrics.timer('publish'):
+            status = publish_dataset(doi, self.version_type)
+
+        outcome = 'published' if status in (200, 202) else 'publish_failed'
+        self.outcomes[doi] = outcome
+        logger.info("%s: %s (%s version, status %s)", doi, outcome, self.version_type, status)
+        log_event('publish', doi=doi, outcome=outcome, status=status, version_type=self.version_type)
+
+    def wait(self):
+        """Block until every queued dataset was published, failed or expired."""
+        while True:
+            self._pool.wait()
+            if self._scheduler.pending() == 0:
+                break
+            logger.info("Waiting for %d locked dataset(s) to publish", self._scheduler.pending())
+            self._scheduler.wait()
+
+        for doi in self._scheduler.expired:
+            self.outcomes[doi] = 'lock_expired'
+            log_event('publish', doi=doi, outcome='lock_expired')
+        self._scheduler.expired.clear()
+        for doi in self._scheduler.unreadable:
+            self.outcomes[doi] = 'lock_unreadable'
+            log_event('publish', doi=doi, outcome='lock_unreadable')
+        self._scheduler.unreadable.clear()
+
+    def close(self):
+        """Stop the publish stage; datasets still waiting on a lock are not published."""
+        self._scheduler.close()
+        self._pool.shutdown()
+
+
 # ============================================================================
 # SCRIPT EXECUTION
 # ============================================================================
 
-if __name__ == "__main__":
+# Environment variables read by the command line (see Advanced-Shell-Instructions/README.md)
+ENVIRONMENT_SETTINGS = {
+    'DATAVERSE_BASE_URL': 'url_base_origin',
+    'DATAVERSE_API_TOKEN': 'api_token_origin',
+    'CSV_FILE_PATHS': 'file_directory',
+    'AUTO_PUBLISH': 'publish_after_edit',
+    'PUBLISH_TYPE': 'publish_type',
+    'LOG_LEVEL': 'log_level',
+}
+
+
+def parse_arguments(argv=None):
+    """
+    Parse the command line. Options left out keep the settings at the top of this file.
+
+    Args:
+        argv (list): Arguments (default: sys.argv[1:])
+
+    Returns:
+        argparse.Namespace: Parsed arguments
+    """
+    parser = argparse.ArgumentParser(description='Bulk edit Dataverse dataset metadata from CSV sheets.')
+    parser.add_argument('sheets', nargs='*', help='CSV sheets to apply (default: file_directory)')
+    parser.add_argument('--url', dest='url_base_origin', help='Dataverse base URL')
+    parser.add_argument('--token', dest='api_token_origin', help='API token (or set DATAVERSE_API_TOKEN)')
+    parser.add_argument('--mode', dest='run_mode', choices=['update', 'plan', 'apply'], help='run mode (see run_mode)')
+    parser.add_argument('--plan', dest='change_plan_path', help='change plan written by --mode plan, read by --mode apply')
+    parser.add_argument('--workers', dest='max_workers', type=int, help='datasets processed at once')
+    parser.add_argument('--publish', dest='publish_after_edit', action='store_const', const=True,
+                        help='publish every changed dataset')
+    parser.add_argument('--publish-type', dest='publish_type', choices=['minor', 'major'])
+    parser.add_argument('--cache', dest='dataset_cache_dir', help='directory for cached dataset records')
+    parser.add_argument('--report', dest='run_report_path', help='write the run report (JSON) here')
+    parser.add_argument('--log-level', dest='log_level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    return parser.parse_args(argv)
+
+
+def apply_settings(arguments, environ=None):
+    """
+    Override the settings at the top of this file, first from the environment (and a
+    .env file, if python-dotenv is installed), then from the command line.
+
+    Args:
+        arguments (argparse.Namespace): Parsed command line (see parse_arguments)
+        environ (dict): Environment variables (default: os.environ)
+    """
+    if environ is None:
+        try:
+            from dotenv import load_dotenv
+            load_dotenv()
+        except ImportError:
+            pass
+        environ = os.environ
+
+    settings = {}
+    for variable, setting in ENVIRONMENT_SETTINGS.items():
+        value = environ.get(variable)
+        if value is None or value == '':
+            continue
+        if setting == 'file_directory':
+            value = [path.strip() for path in value.split(',') if path.strip()]
+        elif setting == 'publish_after_edit':
+            value = value.strip().lower() in ('1', 'true', 'yes', 'on')
+        settings[setting] = value
+
+    settings.update({name: value for name, value in vars(arguments).items() if value is not None and name != 'sheets'})
+    if len(arguments.sheets) > 0:
+        settings['file_directory'] = arguments.sheets
+
+    globals().update(settings)
+
+
+def main(argv=None):
+    """Command line entry point: apply the settings, then run file_loader."""
+    apply_settings(parse_arguments(argv))
+    configure_logging()
     file_loader()
+    return 1 if get_error_budget().exhausted else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())